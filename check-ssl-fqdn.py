@@ -1,36 +1,69 @@
+import argparse
+import asyncio
 import csv
-import ssl
-import socket
+import importlib.util
+import os
+
+# The scan engine lives in check-ssl-jump-host.py.
+_spec = importlib.util.spec_from_file_location(
+    "check_ssl_jump_host", os.path.join(os.path.dirname(os.path.abspath(__file__)), "check-ssl-jump-host.py"))
+scanner = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(scanner)
 
 def get_ssl_issuer(fqdn, port=443):
-    try:
-        ctx = ssl.create_default_context()
-        with ctx.wrap_socket(socket.socket(), server_hostname=fqdn) as s:
-            s.settimeout(5)
-            s.connect((fqdn, port))
-            cert = s.getpeercert()
-            issuer = dict(x[0] for x in cert['issuer'])
-            return issuer.get('organizationName', '')
-    except Exception as e:
-        return f"Error: {e}"
-
-def process_csv(file_path):
-    fqdn_list = []
+    result = asyncio.run(scanner.probe(fqdn, port))
+    if result["error"]:
+        return f"Error: {result['error']}"
+    return result["issuer"]
 
+def prod_fqdns(file_path):
     with open(file_path, newline='', encoding='utf-8') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
             if "Application - PROD" in row.get("Deployment Name", ""):
                 fqdn = row.get("Certificate Name", "").strip()
                 if fqdn:
-                    fqdn_list.append(fqdn)
+                    yield fqdn, 443
 
-    for fqdn in fqdn_list:
-        issuer = get_ssl_issuer(fqdn)
-        if "G1" in issuer:
-            print(f"{fqdn} => Issuer: {issuer} (G1 Found)")
-        else:
-            print(f"{fqdn} => Issuer: {issuer}")
+def print_result(result):
+    issuer = f"Error: {result['error']}" if result["error"] else result["issuer"]
+    if "G1" in issuer:
+        print(f"{result['fqdn']} => Issuer: {issuer} (G1 Found)")
+    else:
+        print(f"{result['fqdn']} => Issuer: {issuer}")
+
+async def _scan_csv(file_path, concurrency, inventory, ttl_hours, expiry_days):
+    if inventory:
+        results = scanner.inventory_scan(prod_fqdns(file_path), inventory, ttl_hours * 3600, expiry_days * 86400, concurrency)
+    else:
+        results = scanner.scan(prod_fqdns(file_path), concurrency)
+    async for result in results:
+        print_result(result)
 
-# Example usage
-process_csv('your_file.csv')
\ No newline at end of file
+def process_csv(file_path, concurrency=200, inventory=None, ttl_hours=24.0, expiry_days=30.0):
+    asyncio.run(_scan_csv(file_path, concurrency, inventory, ttl_hours, expiry_days))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prints the issuer of every PROD certificate in a certificate export CSV.")
+    parser.add_argument("csv", nargs="?", help="certificate export with 'Deployment Name' and 'Certificate Name' columns")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--inventory", help="SQLite inventory shared with check-ssl-jump-host.py")
+    parser.add_argument("--ttl-hours", type=float, default=24.0)
+    parser.add_argument("--expiry-days", type=float, default=30.0)
+    parser.add_argument("--g1-only", action="store_true", help="list G1-issued certificates from the inventory, no scan")
+    args = parser.parse_args()
+
+    inventory = scanner.CertInventory(args.inventory) if args.inventory else None
+    try:
+        if args.g1_only:
+            if not inventory:
+                parser.error("--g1-only needs --inventory")
+            for result in inventory.by_issuer("G1"):
+                print_result(result)
+        elif args.csv:
+            process_csv(args.csv, args.concurrency, inventory, args.ttl_hours, args.expiry_days)
+        else:
+            parser.error("a CSV file is required unless --g1-only")
+    finally:
+        if inventory:
+            inventory.close()
@@ -1,50 +1,532 @@
 #!/usr/bin/env python3
+"""
+Scans TLS certificates for a list of FQDNs and writes one row per host
+(issuer, CN, notAfter, SANs, serial, SHA-256 fingerprint or the error).
 
+Hosts are probed concurrently with asyncio, at most --concurrency at a time,
+with separate TCP connect and TLS handshake timeouts, so dead hosts cost one
+connect timeout each instead of holding up the scan. Input is read lazily
+from a JSON array, JSON Lines, CSV or stdin (one FQDN or fqdn:port per line),
+and each result is written to the CSV or JSONL output as soon as it completes.
+
+With --inventory, results are kept in a SQLite file keyed by FQDN, port and
+resolved IP. Later scans only re-probe hosts last seen more than --ttl-hours
+ago, expiring within --expiry-days or previously errored, and answer the rest
+from the inventory. --query-issuer and --query-expiring read the inventory
+without touching the network.
+
+With --all-ips, every A/AAAA address of each FQDN is probed (with the FQDN
+as SNI), still at most --concurrency connections in total, and FQDNs whose
+addresses serve different certificates are listed at the end, e.g. a stale
+backend behind a load balancer or DNS round robin. An address whose
+certificate fails verification is probed again without verification, so
+its certificate still counts, and a name that verifies on some addresses
+and not on others is listed even if every address serves the same leaf.
+
+Usage: python3 check-ssl-jump-host.py fqdns.json output.csv [--concurrency 200]
+       cat fqdns.txt | python3 check-ssl-jump-host.py - results.jsonl
+       python3 check-ssl-jump-host.py fqdns.json out.csv --inventory certs.db
+       python3 check-ssl-jump-host.py --inventory certs.db --query-expiring 30
+       python3 check-ssl-jump-host.py fqdns.json out.csv --all-ips
+
+Needs Python 3.11 or later.
+"""
+
+import argparse
+import asyncio
 import json
 import csv
-import ssl
+import hashlib
+import sqlite3
 import socket
+import ssl
 import sys
 import os
+import re
+import time
+
+if sys.version_info < (3, 11):
+    # probe() upgrades the connection with StreamWriter.start_tls, added in 3.11.
+    sys.exit("check-ssl-jump-host.py needs Python 3.11 or later")
+
+DEFAULT_PORT = 443
+FIELDS = ["fqdn", "port", "ip", "issuer", "common_name", "not_after", "sans", "serial", "fingerprint", "error", "last_seen", "ms"]
+
+def iso_time(ts):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts))
+
+def cert_fields(cert, der):
+    issuer = dict(x[0] for x in cert.get('issuer', ()))
+    subject = dict(x[0] for x in cert.get('subject', ()))
+    return {
+        "issuer": issuer.get('organizationName', ''),
+        "common_name": subject.get('commonName', ''),
+        "not_after": cert.get('notAfter', ''),
+        "sans": [value for kind, value in cert.get('subjectAltName', ()) if kind == 'DNS'],
+        "serial": cert.get('serialNumber', ''),
+        "fingerprint": hashlib.sha256(der).hexdigest() if der else '',
+    }
+
+async def probe(fqdn, port=DEFAULT_PORT, ctx=None, connect_timeout=3.0, handshake_timeout=5.0, ip=None):
+    """
+    Connects to fqdn (or to ip, with fqdn as SNI) and returns a result dict
+    with FIELDS as keys. Failures are reported in "error", never raised.
+    TLS starts after the TCP connect, via StreamWriter.start_tls (3.11+),
+    so each phase gets its own timeout.
+    """
+    result = dict.fromkeys(FIELDS, '')
+    result.update(fqdn=fqdn, port=port, ip=ip or '', sans=[], last_seen=iso_time(time.time()))
+    started = time.monotonic()
+    writer = None
+    try:
+        phase = 'connect'
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip or fqdn, port), connect_timeout)
+        result["ip"] = writer.get_extra_info('peername')[0]
+        phase = 'handshake'
+        await asyncio.wait_for(writer.start_tls(ctx or ssl.create_default_context(), server_hostname=fqdn), handshake_timeout)
+        ssl_object = writer.get_extra_info('ssl_object')
+        result.update(cert_fields(ssl_object.getpeercert(), ssl_object.getpeercert(binary_form=True)))
+    except asyncio.TimeoutError:
+        result["error"] = f"{phase} timeout"
+    except Exception as e:
+        result["error"] = f"{phase}: {e}"
+    finally:
+        result["ms"] = round((time.monotonic() - started) * 1000)
+        if writer is not None:
+            # Don't hold a concurrency slot for a polite shutdown of a broken connection.
+            if result["error"]:
+                writer.transport.abort()
+            else:
+                writer.close()
+    return result
+
+async def scan(targets, concurrency=200, probe_fn=probe, **probe_args):
+    """
+    Probes (fqdn, port) targets with at most `concurrency` in flight and
+    yields result dicts as they complete. `targets` is consumed lazily.
+    probe_fn may also return a list of results (see MultiIpProber).
+    """
+    pending = set()
+    targets = iter(targets)
+    exhausted = False
+    while pending or not exhausted:
+        while not exhausted and len(pending) < concurrency:
+            target = next(targets, None)
+            if target is None:
+                exhausted = True
+            else:
+                pending.add(asyncio.ensure_future(probe_fn(*target, **probe_args)))
+        if not pending:
+            break
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            result = task.result()
+            for item in (result if isinstance(result, list) else [result]):
+                yield item
+
+def count_variants(results):
+    """Distinct certificates among one name's results; the same one verified and unverified counts twice."""
+    return len({(r["fingerprint"], bool(r["error"])) for r in results if r["fingerprint"]})
+
+class MultiIpProber:
+    """
+    probe_fn for scan() that probes every address a name resolves to, with
+    the name as SNI. Lookups are shared and cached for dns_ttl seconds, and
+    a semaphore caps connections across all names at `limit`. Each result
+    gets "variants": how many distinct certificates the name served, where
+    the same certificate verified on one address and not on another counts
+    twice. When verification fails the address is probed again without it,
+    and only "fingerprint" is filled in from that second handshake; "error"
+    keeps the verification failure.
+    """
+
+    def __init__(self, limit, dns_ttl=300.0):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.dns_ttl = dns_ttl
+        self.dns = {}  # fqdn -> (expires, future of addresses)
+        self.unverified = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.unverified.check_hostname = False
+        self.unverified.verify_mode = ssl.CERT_NONE
+
+    async def resolve(self, fqdn):
+        entry = self.dns.get(fqdn)
+        if entry is None or entry[0] < time.monotonic():
+            lookup = asyncio.get_running_loop().getaddrinfo(fqdn, None, type=socket.SOCK_STREAM)
+            entry = self.dns[fqdn] = (time.monotonic() + self.dns_ttl, asyncio.ensure_future(lookup))
+        # Shielded: a caller timing out must not cancel the lookup for everyone else.
+        infos = await asyncio.shield(entry[1])
+        return list(dict.fromkeys(info[4][0] for info in infos))
+
+    async def _probe(self, fqdn, port, ip, probe_args):
+        async with self.semaphore:
+            result = await probe(fqdn, port, ip=ip, **probe_args)
+            if "CERTIFICATE_VERIFY_FAILED" in result["error"]:
+                # getpeercert() is empty without verification; only the DER form is there.
+                retry = await probe(fqdn, port, **dict(probe_args, ctx=self.unverified, ip=result["ip"] or ip))
+                result["fingerprint"] = retry["fingerprint"]
+            return result
+
+    async def __call__(self, fqdn, port=DEFAULT_PORT, **probe_args):
+        try:
+            ips = await asyncio.wait_for(self.resolve(fqdn), probe_args.get('connect_timeout', 3.0))
+        except Exception as e:
+            result = dict.fromkeys(FIELDS, '')
+            result.update(fqdn=fqdn, port=port, sans=[], last_seen=iso_time(time.time()), variants=0,
+                          error='resolve timeout' if isinstance(e, asyncio.TimeoutError) else f"resolve: {e}")
+            return [result]
+        results = await asyncio.gather(*(self._probe(fqdn, port, ip, probe_args) for ip in ips))
+        variants = count_variants(results)
+        for r in results:
+            r["variants"] = variants
+        return results
 
 def get_ssl_cert_info(fqdn, port=443):
+    result = asyncio.run(probe(fqdn, port))
+    if result["error"]:
+        return f"Error: {result['error']}", ""
+    return result["issuer"], result["common_name"]
+
+# --------------------------
+# Input
+# --------------------------
+def parse_target(value, port=DEFAULT_PORT):
+    """'host', 'host:port' or {"fqdn": ..., "port": ...} -> (fqdn, port), or None for blanks."""
+    if isinstance(value, dict):
+        fqdn = str(value.get('fqdn') or value.get('FQDN') or '').strip()
+        return (fqdn, int(value.get('port') or port)) if fqdn else None
+    value = str(value).strip()
+    host, sep, suffix = value.rpartition(':')
+    if sep and suffix.isdigit() and ':' not in host:
+        return host, int(suffix)
+    return (value, port) if value else None
+
+def iter_json_array(f, chunk_size=1 << 16):
+    """Yields the elements of a top-level JSON array without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buf, pos, started = '', 0, False
+    while True:
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if not started and pos < len(buf):
+                if buf[pos] != '[':
+                    raise ValueError("expected a JSON array")
+                started, pos = True, pos + 1
+                continue
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break
+            # A number could continue past the buffer end; wait for a delimiter.
+            if end == len(buf) and not isinstance(value, (str, dict, list)):
+                break
+            yield value
+            pos = end
+        more = f.read(chunk_size)
+        if not more:
+            if buf[pos:].strip():
+                raise ValueError("truncated JSON array")
+            return
+        buf, pos = buf[pos:] + more, 0
+
+def read_targets(path, port=DEFAULT_PORT, column=None):
+    """
+    Lazily yields (fqdn, port) from a JSON array, JSON Lines, CSV (`column`,
+    else an fqdn/FQDN/"Certificate Name" column, else the first) or plain
+    lines; "-" reads stdin.
+    """
+    f = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
     try:
-        ctx = ssl.create_default_context()
-        with ctx.wrap_socket(socket.socket(), server_hostname=fqdn) as s:
-            s.settimeout(5)
-            s.connect((fqdn, port))
-            cert = s.getpeercert()
+        head = f.read(1)
+        while head.isspace():
+            head = f.read(1)
+        if head == '[':
+            rows = iter_json_array(_Prepend(head, f))
+        elif path.lower().endswith('.csv'):
+            reader = csv.DictReader(_Prepend(head, f))
+            key = column or next((c for c in ('fqdn', 'FQDN', 'Certificate Name') if c in (reader.fieldnames or ())), None)
+            key = key or (reader.fieldnames or [''])[0]
+            rows = (row.get(key, '') for row in reader)
+        else:
+            rows = (json.loads(line) if line.lstrip().startswith(('{', '"')) else line
+                    for line in _Prepend(head, f))
+        for row in rows:
+            target = parse_target(row, port)
+            if target:
+                yield target
+    finally:
+        if f is not sys.stdin:
+            f.close()
 
-            issuer = dict(x[0] for x in cert['issuer']).get('organizationName', '')
-            subject = dict(x[0] for x in cert['subject'])
-            common_name = subject.get('commonName', '')
+class _Prepend:
+    """A text stream with already-consumed leading characters put back."""
 
-            return issuer, common_name
-    except Exception as e:
-        return f"Error: {e}", ""
+    def __init__(self, head, f):
+        self.head, self.f = head, f
 
-def main(json_path, output_csv):
-    if not os.path.isfile(json_path):
-        print(f"Error: File '{json_path}' does not exist.")
-        sys.exit(1)
+    def read(self, size=-1):
+        head, self.head = self.head, ''
+        return head + self.f.read(size if size < 0 else max(size - len(head), 0))
 
-    with open(json_path, 'r', encoding='utf-8') as f:
-        fqdns = json.load(f)
+    def __iter__(self):
+        head, self.head = self.head, ''
+        first = head + self.f.readline()
+        if first:
+            yield first
+        yield from self.f
 
-    with open(output_csv, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["FQDN", "Issuer", "Common Name"])
+# --------------------------
+# Inventory
+# --------------------------
+def issuer_terms(issuer):
+    """Lowercased words of an issuer name, as indexed by CertInventory."""
+    return sorted(set(re.findall(r"\w+", issuer.lower())))
 
-        for fqdn in fqdns:
-            issuer, common_name = get_ssl_cert_info(fqdn)
-            writer.writerow([fqdn, issuer, common_name])
-            print(f"{fqdn} => Issuer: {issuer}, CN: {common_name}")
+class CertInventory:
+    """
+    SQLite record of the last probe per (fqdn, port, resolved ip). A failed
+    probe keeps the last certificate seen on that address and only updates
+    the error and last_seen. Each lowercased word of the issuer is indexed
+    in issuer_terms, so issuer queries are index range scans.
+    """
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python3 ssl_issuer_to_csv.py fqdns.json output.csv")
-        sys.exit(1)
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS certs (
+            fqdn TEXT NOT NULL, port INTEGER NOT NULL, ip TEXT NOT NULL,
+            issuer TEXT NOT NULL DEFAULT '', common_name TEXT NOT NULL DEFAULT '',
+            not_after TEXT NOT NULL DEFAULT '', expires REAL, sans TEXT NOT NULL DEFAULT '[]',
+            serial TEXT NOT NULL DEFAULT '', fingerprint TEXT NOT NULL DEFAULT '',
+            error TEXT NOT NULL DEFAULT '', last_seen REAL NOT NULL,
+            PRIMARY KEY (fqdn, port, ip)
+        );
+        CREATE INDEX IF NOT EXISTS certs_expires ON certs (expires);
+        CREATE TABLE IF NOT EXISTS issuer_terms (
+            term TEXT NOT NULL, fqdn TEXT NOT NULL, port INTEGER NOT NULL, ip TEXT NOT NULL,
+            PRIMARY KEY (term, fqdn, port, ip)
+        ) WITHOUT ROWID;
+    """
+    COLUMNS = ("fqdn", "port", "ip", "issuer", "common_name", "not_after", "expires", "sans",
+               "serial", "fingerprint", "error", "last_seen")
+    COMMIT_EVERY = 200
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.SCHEMA)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] < 1:
+            # Inventories written before issuer_terms existed.
+            for row in self.db.execute("SELECT fqdn, port, ip, issuer FROM certs").fetchall():
+                self._index_issuer(row[:3], row[3])
+            self.db.execute("PRAGMA user_version = 1")
+            self.db.commit()
+        self.uncommitted = 0
+
+    def _index_issuer(self, key, issuer):
+        self.db.execute("DELETE FROM issuer_terms WHERE fqdn = ? AND port = ? AND ip = ?", key)
+        self.db.executemany("INSERT OR IGNORE INTO issuer_terms (term, fqdn, port, ip) VALUES (?, ?, ?, ?)",
+                            ((term,) + key for term in issuer_terms(issuer)))
+
+    def needs_probe(self, fqdn, port, now, ttl, window):
+        """True unless every entry for fqdn:port is fresh, error-free and not expiring within `window` seconds."""
+        count, oldest, soonest, errors = self.db.execute(
+            "SELECT count(*), min(last_seen), min(expires), sum(error != '') FROM certs WHERE fqdn = ? AND port = ?",
+            (fqdn, port)).fetchone()
+        return bool(not count or oldest < now - ttl or errors or (soonest is not None and soonest < now + window))
+
+    def rows(self, where, params=()):
+        """Inventory entries as scan result dicts."""
+        for row in self.db.execute(f"SELECT {', '.join(self.COLUMNS)} FROM certs WHERE {where}", params):
+            entry = dict(zip(self.COLUMNS, row))
+            del entry["expires"]
+            entry.update(sans=json.loads(entry["sans"]), last_seen=iso_time(entry["last_seen"]), ms='', cached=True)
+            yield entry
+
+    def by_issuer(self, text):
+        """Entries whose issuer has a word starting with each word of text, case-insensitively ("G1", "digicert global")."""
+        terms = issuer_terms(text)
+        if not terms:
+            return self.rows("1 ORDER BY fqdn, port, ip")
+        # Each word is a range over the issuer_terms primary key: term >= 'g1' AND term < 'g2'.
+        matches = " INTERSECT ".join(["SELECT fqdn, port, ip FROM issuer_terms WHERE term >= ? AND term < ?"] * len(terms))
+        params = [bound for term in terms for bound in (term, term[:-1] + chr(ord(term[-1]) + 1))]
+        return self.rows(f"(fqdn, port, ip) IN ({matches}) ORDER BY fqdn, port, ip", params)
+
+    def expiring(self, days, now=None):
+        return self.rows("expires < ? ORDER BY expires", ((now or time.time()) + days * 86400,))
+
+    def record(self, result, scan_started):
+        """Stores a probe result; scan_started is when the current scan began."""
+        key = (result["fqdn"], result["port"], result["ip"])
+        now = time.time()
+        if result["error"]:
+            self.db.execute(
+                "INSERT INTO certs (fqdn, port, ip, error, last_seen) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (fqdn, port, ip) DO UPDATE SET error = excluded.error, last_seen = excluded.last_seen",
+                key + (result["error"], now))
+        else:
+            expires = ssl.cert_time_to_seconds(result["not_after"]) if result["not_after"] else None
+            self.db.execute(
+                f"INSERT OR REPLACE INTO certs ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                key + (result["issuer"], result["common_name"], result["not_after"], expires,
+                       json.dumps(result["sans"]), result["serial"], result["fingerprint"], '', now))
+            self._index_issuer(key, result["issuer"])
+            # Addresses the name no longer resolves to, and earlier connect
+            # errors, weren't refreshed by this scan.
+            self.db.execute("DELETE FROM issuer_terms WHERE fqdn = ? AND port = ? AND ip IN "
+                            "(SELECT ip FROM certs WHERE fqdn = ? AND port = ? AND ip != ? AND last_seen < ?)",
+                            key[:2] + key + (scan_started,))
+            self.db.execute("DELETE FROM certs WHERE fqdn = ? AND port = ? AND ip != ? AND last_seen < ?",
+                            key + (scan_started,))
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+async def inventory_scan(targets, inventory, ttl, window, concurrency=200, **probe_args):
+    """
+    scan() through a CertInventory: targets whose entries are fresh come
+    back from the inventory (marked "cached"), the rest are probed and
+    recorded. ttl and window are in seconds.
+    """
+    started = time.time()
+    cached = []
 
-    json_path = sys.argv[1]
-    output_csv = sys.argv[2]
-    main(json_path, output_csv)
\ No newline at end of file
+    def due():
+        for target in targets:
+            if inventory.needs_probe(*target, started, ttl, window):
+                yield target
+            else:
+                rows = list(inventory.rows("fqdn = ? AND port = ?", target))
+                variants = count_variants(rows)
+                cached.extend(dict(r, variants=variants) for r in rows)
+
+    async for result in scan(due(), concurrency, **probe_args):
+        inventory.record(result, started)
+        yield result
+        while cached:
+            yield cached.pop()
+    while cached:
+        yield cached.pop()
+    inventory.commit()
+
+# --------------------------
+# Output
+# --------------------------
+class ResultWriter:
+    """Writes results as CSV or JSON Lines, flushing each one."""
+
+    def __init__(self, f, fmt, fields=FIELDS):
+        self.f, self.fmt = f, fmt
+        if fmt == 'csv':
+            self.csv = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+            self.csv.writeheader()
+
+    def write(self, result):
+        if self.fmt == 'csv':
+            self.csv.writerow(dict(result, sans=' '.join(result["sans"])))
+        else:
+            self.f.write(json.dumps(result) + '\n')
+        self.f.flush()
+
+async def run(args, inventory):
+    ctx = ssl.create_default_context(cafile=args.cafile)
+    fmt = args.format or ('jsonl' if args.output.endswith(('.jsonl', '.json')) else 'csv')
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    writer = ResultWriter(out, fmt, FIELDS + ["variants"] if args.all_ips else FIELDS)
+    counts = {"ok": 0, "error": 0, "cached": 0}
+    mismatched = {}
+    started = time.monotonic()
+    try:
+        targets = read_targets(args.input, args.port, args.column)
+        probe_args = dict(ctx=ctx, connect_timeout=args.connect_timeout, handshake_timeout=args.handshake_timeout)
+        if args.all_ips:
+            probe_args["probe_fn"] = MultiIpProber(args.concurrency, args.dns_ttl)
+        if inventory:
+            results = inventory_scan(targets, inventory, args.ttl_hours * 3600, args.expiry_days * 86400,
+                                     args.concurrency, **probe_args)
+        else:
+            results = scan(targets, args.concurrency, **probe_args)
+        async for result in results:
+            writer.write(result)
+            counts["error" if result["error"] else "ok"] += 1
+            counts["cached"] += bool(result.get("cached"))
+            if args.all_ips and result.get("variants", 0) > 1:
+                mismatched.setdefault((result["fqdn"], result["port"]), []).append(result)
+            if out is not sys.stdout:
+                suffix = " (inventory)" if result.get("cached") else ""
+                name = f"{result['fqdn']} [{result['ip']}]" if args.all_ips and result['ip'] else result['fqdn']
+                if result["error"]:
+                    print(f"{name} => Error: {result['error']}{suffix}")
+                else:
+                    print(f"{name} => Issuer: {result['issuer']}, CN: {result['common_name']}, notAfter: {result['not_after']}{suffix}")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if mismatched:
+        print(f"Certificates differ across addresses for {len(mismatched)} hosts:", file=sys.stderr)
+        for (fqdn, port), results in sorted(mismatched.items()):
+            print(f"  {fqdn}:{port}", file=sys.stderr)
+            for r in sorted(results, key=lambda r: r["ip"]):
+                if not r["fingerprint"]:
+                    detail = f"error: {r['error']}"
+                elif r["error"]:
+                    detail = f"{r['fingerprint'][:16]} unverified, {r['error']}"
+                else:
+                    detail = f"{r['fingerprint'][:16]} issuer {r['issuer']!r}, notAfter {r['not_after']}, serial {r['serial']}"
+                print(f"    {r['ip']:<39} {detail}", file=sys.stderr)
+    print(f"Scanned {counts['ok'] + counts['error']} hosts ({counts['error']} errors, {counts['cached']} from inventory) "
+          f"in {time.monotonic() - started:.1f}s", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", nargs="?", help="JSON array, JSON Lines, CSV or text file of FQDNs; - for stdin")
+    parser.add_argument("output", nargs="?", default="-", help="CSV or JSONL file; - (default) for stdout")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="default: from the output extension, else csv")
+    parser.add_argument("--column", help="CSV column holding the FQDN")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="for entries without one")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--connect-timeout", type=float, default=3.0, help="seconds for DNS + TCP connect")
+    parser.add_argument("--handshake-timeout", type=float, default=5.0, help="seconds for the TLS handshake")
+    parser.add_argument("--cafile", help="extra CA bundle, e.g. for internal CAs")
+    parser.add_argument("--all-ips", action="store_true", help="probe every A/AAAA address and report certificate mismatches")
+    parser.add_argument("--dns-ttl", type=float, default=300.0, help="seconds to reuse a name's addresses in --all-ips mode")
+    parser.add_argument("--inventory", help="SQLite file to keep results in and skip fresh hosts")
+    parser.add_argument("--ttl-hours", type=float, default=24.0, help="re-probe entries older than this")
+    parser.add_argument("--expiry-days", type=float, default=30.0, help="re-probe certificates expiring within this")
+    parser.add_argument("--query-issuer", metavar="TEXT",
+                        help="list inventory entries whose issuer has words starting with those of TEXT")
+    parser.add_argument("--query-expiring", metavar="DAYS", type=float, help="list inventory entries expiring within DAYS")
+    args = parser.parse_args()
+
+    querying = args.query_issuer is not None or args.query_expiring is not None
+    if querying and not args.inventory:
+        parser.error("--query-issuer/--query-expiring need --inventory")
+    if not querying and args.input is None:
+        parser.error("input is required unless querying the inventory")
+    inventory = CertInventory(args.inventory) if args.inventory else None
+    try:
+        if querying:
+            writer = ResultWriter(sys.stdout, args.format or 'csv')
+            rows = inventory.by_issuer(args.query_issuer) if args.query_issuer is not None else inventory.expiring(args.query_expiring)
+            for row in rows:
+                writer.write(row)
+            return
+        if args.input != '-' and not os.path.isfile(args.input):
+            print(f"Error: File '{args.input}' does not exist.")
+            sys.exit(1)
+        asyncio.run(run(args, inventory))
+    finally:
+        if inventory:
+            inventory.close()
+
+if __name__ == "__main__":
+    main()
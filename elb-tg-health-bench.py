@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Benchmark for elb-tg-health.py against a moto ELBv2 backend. Nothing here
+talks to AWS.
+
+Builds --regions regions of --lbs network load balancers with --tgs target
+groups of --targets targets each, then times the original serial walk (one
+describe_target_groups per load balancer, one describe_target_health per
+target group) against snapshot() at each of --workers, paced at
+--client-rate, and checks that all of them saw the same targets.
+
+moto answers in microseconds, so every request is held for --latency-ms
+before it is sent, like a real round trip, and describe_target_health calls
+beyond --rate per second per region are answered with a Throttling error.
+Both hooks sit in front of moto on the client's event system, so throttled
+calls go through botocore's real adaptive retry handling.
+
+Examples:
+  python3 elb-tg-health-bench.py
+  python3 elb-tg-health-bench.py --regions 3 --lbs 20 --tgs 10 --rate 50 --client-rate 40 --workers 4,16,64
+  python3 elb-tg-health-bench.py --rate 20 --client-rate 0     # unpaced, adaptive retries only
+
+Needs boto3 and moto (pip install 'moto[ec2,elbv2]').
+"""
+
+import argparse
+import collections
+import importlib.util
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# requests.py in this folder would shadow the library moto imports.
+sys.path = [p for p in sys.path if os.path.abspath(p or ".") != HERE]
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from moto import mock_aws
+
+_spec = importlib.util.spec_from_file_location("elb_tg_health", os.path.join(HERE, "elb-tg-health.py"))
+engine = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(engine)
+
+REGIONS = ("us-east-1", "us-west-2", "eu-west-1", "eu-central-1", "ap-southeast-1", "ap-northeast-1")
+_THROTTLE_BODY = (b'<ErrorResponse xmlns="http://elasticloadbalancing.amazonaws.com/doc/2015-12-01/">'
+                  b'<Error><Type>Sender</Type><Code>Throttling</Code><Message>Rate exceeded</Message></Error>'
+                  b'<RequestId>bench</RequestId></ErrorResponse>')
+
+# --------------------------
+# Fixture
+# --------------------------
+def build(region, lbs, tgs, targets, prefix="klb"):
+    ec2 = boto3.client("ec2", region_name=region)
+    elb = boto3.client("elbv2", region_name=region)
+    vpc = ec2.create_vpc(CidrBlock="10.0.0.0/16")["Vpc"]["VpcId"]
+    zone = ec2.describe_availability_zones()["AvailabilityZones"][0]["ZoneName"]
+    subnet = ec2.create_subnet(VpcId=vpc, CidrBlock="10.0.0.0/20", AvailabilityZone=zone)["Subnet"]["SubnetId"]
+    for i in range(lbs):
+        lb_arn = elb.create_load_balancer(Name=f"{prefix}-{i:03d}", Type="network",
+                                          Subnets=[subnet])["LoadBalancers"][0]["LoadBalancerArn"]
+        for j in range(tgs):
+            tg_arn = elb.create_target_group(Name=f"{prefix}-{i:03d}-{j:03d}", Protocol="TCP", Port=443,
+                                             VpcId=vpc, TargetType="ip")["TargetGroups"][0]["TargetGroupArn"]
+            elb.register_targets(TargetGroupArn=tg_arn, Targets=[
+                {"Id": f"10.0.{(k >> 8) & 15}.{k & 255}", "Port": 443} for k in range(targets)])
+            elb.create_listener(LoadBalancerArn=lb_arn, Protocol="TCP", Port=1024 + j,
+                                DefaultActions=[{"Type": "forward", "TargetGroupArn": tg_arn}])
+    # Unmatched load balancers the prefix filter has to skip.
+    elb.create_load_balancer(Name="other-000", Type="network", Subnets=[subnet])
+
+# --------------------------
+# Latency and throttling in front of moto
+# --------------------------
+class Backend:
+    def __init__(self, latency_ms, rate):
+        self.latency = latency_ms / 1000.0
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.counts = collections.Counter()
+
+    def reset(self):
+        with self.lock:
+            self.buckets.clear()
+            self.counts.clear()
+
+    def _take(self, region):
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(region, (self.rate, now))
+            tokens = min(self.rate, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            self.buckets[region] = (tokens - allowed, now)
+            return allowed
+
+    def _before_send(self, request, region, **kwargs):
+        operation = kwargs["event_name"].rsplit(".", 1)[-1]
+        time.sleep(self.latency)
+        with self.lock:
+            self.counts[operation] += 1
+        if self.rate and operation == "DescribeTargetHealth" and not self._take(region):
+            with self.lock:
+                self.counts["throttled"] += 1
+            return AWSResponse(request.url, 400, {}, _Raw(_THROTTLE_BODY))
+        return None
+
+    def client(self, region, workers=16, max_attempts=10, rate=0):
+        client = engine.make_client(region, workers, max_attempts, rate)
+        client.meta.events.register_first(
+            "before-send.elastic-load-balancing-v2",
+            lambda request, **kwargs: self._before_send(request, region, **kwargs))
+        return client
+
+class _Raw:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+# --------------------------
+# Runs
+# --------------------------
+def serial_walk(regions, name_prefix, client_factory):
+    """The original script: no pagination, one call per load balancer and per target group."""
+    seen = set()
+    for region in regions:
+        client = client_factory(region, 1)
+        for lb in client.describe_load_balancers()["LoadBalancers"]:
+            if not lb["LoadBalancerName"].startswith(name_prefix):
+                continue
+            for tg in client.describe_target_groups(LoadBalancerArn=lb["LoadBalancerArn"])["TargetGroups"]:
+                for desc in client.describe_target_health(TargetGroupArn=tg["TargetGroupArn"])["TargetHealthDescriptions"]:
+                    seen.add((region, lb["LoadBalancerName"], tg["TargetGroupName"], desc["Target"]["Id"]))
+    return seen
+
+def snapshot_walk(regions, name_prefix, client_factory, workers, rate):
+    seen, errors = set(), 0
+    for row in engine.snapshot(regions, name_prefix, workers=workers, rate=rate, client_factory=client_factory):
+        errors += bool(row["error"])
+        if row["target"]:
+            seen.add((row["region"], row["load_balancer"], row["target_group"], row["target"]))
+    return seen, errors
+
+def _report(name, elapsed, backend, targets, errors=0):
+    counts = backend.counts
+    calls = sum(v for k, v in counts.items() if k != "throttled")
+    print(f"{name:16} {elapsed:8.2f}s {calls:7d} requests {counts['throttled']:6d} throttled "
+          f"{targets:7d} targets {errors:4d} errors")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--regions", type=int, default=2)
+    parser.add_argument("--lbs", type=int, default=10, help="matching load balancers per region")
+    parser.add_argument("--tgs", type=int, default=10, help="target groups per load balancer")
+    parser.add_argument("--targets", type=int, default=4, help="targets per target group")
+    parser.add_argument("--latency-ms", type=float, default=30.0)
+    parser.add_argument("--rate", type=float, default=0, help="describe_target_health calls/sec per region (0 = unlimited)")
+    parser.add_argument("--client-rate", type=float, default=20.0, help="elb-tg-health.py --rate (0 = unpaced)")
+    parser.add_argument("--workers", default="4,16,32", help="comma-separated pool sizes to try")
+    parser.add_argument("--skip-serial", action="store_true")
+    args = parser.parse_args()
+
+    regions = list(REGIONS[:args.regions])
+    with mock_aws():
+        start = time.perf_counter()
+        for region in regions:
+            build(region, args.lbs, args.tgs, args.targets)
+        print(f"{len(regions)} regions x {args.lbs} load balancers x {args.tgs} target groups x "
+              f"{args.targets} targets, built in {time.perf_counter() - start:.1f}s; "
+              f"{args.latency_ms:g} ms per request, backend rate {args.rate or 'unlimited'}, "
+              f"client rate {args.client_rate or 'unpaced'}\n")
+
+        backend = Backend(args.latency_ms, args.rate)
+        expected = None
+        if not args.skip_serial:
+            start = time.perf_counter()
+            expected = serial_walk(regions, "klb", backend.client)
+            _report("serial", time.perf_counter() - start, backend, len(expected))
+        for workers in map(int, args.workers.split(",")):
+            backend.reset()
+            start = time.perf_counter()
+            seen, errors = snapshot_walk(regions, "klb", backend.client, workers, args.client_rate)
+            _report(f"snapshot x{workers}", time.perf_counter() - start, backend, len(seen), errors)
+            if expected is not None and seen != expected:
+                print(f"  mismatch: {len(expected - seen)} missing, {len(seen - expected)} unexpected")
+            expected = expected if expected is not None else seen
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,458 @@
+#!/usr/bin/env python3
+"""
+Target health snapshot for ELBv2 load balancers, across regions.
+
+For every load balancer matching --name-prefix and --type it lists the
+attached target groups and the health of every registered target:
+
+  1. describe_load_balancers, paginated, filtered client-side
+  2. describe_target_groups, paginated over the whole region (400 per page)
+     and joined to the load balancers on LoadBalancerArns, instead of one
+     call per load balancer
+  3. describe_tags, 20 ARNs per call (--tags only)
+  4. describe_target_health, one call per target group
+
+Steps 2-4 for all regions run on one bounded thread pool (--workers),
+submitted round-robin across regions. ELB throttles per account and region,
+so each region's requests are paced to --rate per second whatever the pool
+size, and a throttled call is retried by botocore's adaptive retry mode,
+which also slows the client down if --rate is set too high. Without the
+pacing, adaptive mode alone cuts its rate so far after the first burst of
+throttles that a large pool ends up slower than the serial walk. A target
+group whose health call still fails gets a row with `error` set.
+
+Examples:
+  python3 elb-tg-health.py
+  python3 elb-tg-health.py --regions us-east-1,us-west-2 --format csv --out health.csv
+  python3 elb-tg-health.py --name-prefix '' --type all --tags --format json
+  python3 elb-tg-health.py --watch --interval 5 --max-interval 60
+
+--watch keeps the last state of every target in memory and prints only
+transitions (healthy -> draining, registrations, deregistrations), each
+transition to healthy with the time it took. Target groups that are
+changing are polled every --interval seconds and stable ones back off to
+--max-interval, so a deploy touching a few groups doesn't cost a full
+re-list of all of them every few seconds. Ctrl-C prints a summary.
+
+See elb-tg-health-bench.py for a benchmark against a moto backend.
+"""
+
+import argparse
+import csv
+import heapq
+import itertools
+import json
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+FIELDS = ("region", "load_balancer", "type", "target_group", "protocol", "port",
+          "target", "target_port", "zone", "state", "reason", "description",
+          "lb_tags", "tg_tags", "error")
+PAGE_SIZE = 400   # describe_load_balancers / describe_target_groups maximum
+TAGS_BATCH = 20   # describe_tags accepts at most 20 ARNs
+
+class RateLimiter:
+    """Spaces calls at most `rate` per second apart, across threads (0 = unlimited)."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next = 0.0
+
+    def wait(self, **kwargs):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next, now)
+            self.next = slot + self.interval
+        time.sleep(slot - now)
+
+def make_client(region, workers=16, max_attempts=10, rate=0):
+    client = boto3.client("elbv2", region_name=region, config=Config(
+        retries={"mode": "adaptive", "max_attempts": max_attempts},
+        max_pool_connections=workers))
+    # Every attempt, retries included, waits for its slot.
+    client.meta.events.register("before-send.elastic-load-balancing-v2", RateLimiter(rate).wait)
+    return client
+
+def paginate(client, operation, key, **kwargs):
+    for page in client.get_paginator(operation).paginate(**kwargs):
+        yield from page[key]
+
+def discover(client, name_prefix="", lb_type="network"):
+    """
+    Returns (load balancers, {load balancer ARN: [target groups]}) for the
+    matching load balancers of one region.
+    """
+    lbs = [lb for lb in paginate(client, "describe_load_balancers", "LoadBalancers",
+                                 PaginationConfig={"PageSize": PAGE_SIZE})
+           if lb["LoadBalancerName"].startswith(name_prefix) and lb_type in ("all", lb["Type"])]
+    tgs_by_lb = {lb["LoadBalancerArn"]: [] for lb in lbs}
+    if lbs:
+        for tg in paginate(client, "describe_target_groups", "TargetGroups",
+                           PaginationConfig={"PageSize": PAGE_SIZE}):
+            for arn in tg["LoadBalancerArns"]:
+                if arn in tgs_by_lb:
+                    tgs_by_lb[arn].append(tg)
+    return lbs, tgs_by_lb
+
+def target_health(client, tg_arn):
+    return client.describe_target_health(TargetGroupArn=tg_arn)["TargetHealthDescriptions"]
+
+def tags(client, arns):
+    """{ARN: {key: value}} for up to TAGS_BATCH ARNs."""
+    return {d["ResourceArn"]: {t["Key"]: t["Value"] for t in d["Tags"]}
+            for d in client.describe_tags(ResourceArns=arns)["TagDescriptions"]}
+
+def _row(region, lb=None, tg=None, **values):
+    row = dict.fromkeys(FIELDS, "")
+    row.update(region=region, lb_tags={}, tg_tags={})
+    if lb:
+        row.update(load_balancer=lb["LoadBalancerName"], type=lb["Type"])
+    if tg:
+        row.update(target_group=tg["TargetGroupName"], protocol=tg.get("Protocol", ""), port=tg.get("Port", ""))
+    row.update(values)
+    return row
+
+def _target_values(desc):
+    health = desc["TargetHealth"]
+    return dict(target=desc["Target"]["Id"], target_port=desc["Target"].get("Port", ""),
+                zone=desc["Target"].get("AvailabilityZone", ""), state=health.get("State", ""),
+                reason=health.get("Reason", ""), description=health.get("Description", ""))
+
+def snapshot(regions, name_prefix="", lb_type="network", workers=16, with_tags=False,
+             max_attempts=10, rate=0, client_factory=make_client):
+    """
+    Yields one row per (load balancer, target group, target), in region,
+    load balancer, target group and target order. Empty target groups get a
+    row without a target; failed regions and target groups a row with error.
+    """
+    clients = {region: client_factory(region, workers, max_attempts, rate) for region in regions}
+    with ThreadPoolExecutor(workers) as pool:
+        layouts = {region: pool.submit(discover, client, name_prefix, lb_type) for region, client in clients.items()}
+        calls, tag_keys = [], {}
+        for region, client in clients.items():
+            try:
+                lbs, tgs_by_lb = layouts[region].result()
+            except (BotoCoreError, ClientError) as e:
+                layouts[region] = e
+                continue
+            layouts[region] = lbs, tgs_by_lb
+            tg_arns = sorted({tg["TargetGroupArn"] for tgs in tgs_by_lb.values() for tg in tgs})
+            region_calls = [(arn, target_health, client, arn) for arn in tg_arns]
+            if with_tags:
+                arns = sorted(tgs_by_lb) + tg_arns
+                tag_keys[region] = [("tags", region, i) for i in range(0, len(arns), TAGS_BATCH)]
+                region_calls += [(key, tags, client, arns[key[2]:key[2] + TAGS_BATCH]) for key in tag_keys[region]]
+            calls.append(region_calls)
+
+        # Round-robin across regions, so one paced region doesn't hold every
+        # worker while the others wait in the queue.
+        futures = {}
+        for batch in itertools.zip_longest(*calls):
+            for key, fn, client, arg in filter(None, batch):
+                futures[key] = pool.submit(fn, client, arg)
+
+        for region in regions:
+            layout = layouts[region]
+            if isinstance(layout, Exception):
+                yield _row(region, error=str(layout))
+                continue
+            lbs, tgs_by_lb = layout
+            tag_map = {}
+            for key in tag_keys.get(region, ()):
+                try:
+                    tag_map.update(futures[key].result())
+                except (BotoCoreError, ClientError) as e:
+                    print(f"{region}: describe_tags failed: {e}", file=sys.stderr)
+            for lb in sorted(lbs, key=lambda lb: lb["LoadBalancerName"]):
+                lb_tags = tag_map.get(lb["LoadBalancerArn"], {})
+                for tg in sorted(tgs_by_lb[lb["LoadBalancerArn"]], key=lambda tg: tg["TargetGroupName"]):
+                    tg_tags = tag_map.get(tg["TargetGroupArn"], {})
+                    try:
+                        descs = futures[tg["TargetGroupArn"]].result()
+                    except (BotoCoreError, ClientError) as e:
+                        yield _row(region, lb, tg, lb_tags=lb_tags, tg_tags=tg_tags, error=str(e))
+                        continue
+                    if not descs:
+                        yield _row(region, lb, tg, lb_tags=lb_tags, tg_tags=tg_tags)
+                    for desc in sorted(descs, key=lambda d: (d["Target"]["Id"], d["Target"].get("Port", 0))):
+                        yield _row(region, lb, tg, lb_tags=lb_tags, tg_tags=tg_tags, **_target_values(desc))
+
+def _flat_tags(tag_map):
+    return ";".join(f"{k}={v}" for k, v in sorted(tag_map.items()))
+
+def write_rows(rows, fmt, f):
+    """Writes rows as text (the original indented listing), csv or json; returns the row count."""
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, lb_tags=_flat_tags(row["lb_tags"]), tg_tags=_flat_tags(row["tg_tags"])))
+            count += 1
+    elif fmt == "json":
+        f.write("[")
+        for row in rows:
+            f.write(("," if count else "") + "\n" + json.dumps(row))
+            count += 1
+        f.write("\n]\n")
+    else:
+        lb_key = tg_key = None
+        for row in rows:
+            count += 1
+            if not row["load_balancer"]:
+                print(f"\nRegion {row['region']}: {row['error']}", file=f)
+                continue
+            if (row["region"], row["load_balancer"]) != lb_key:
+                lb_key, tg_key = (row["region"], row["load_balancer"]), None
+                print(f"\nLoad Balancer: {row['load_balancer']} ({row['region']})", file=f)
+            if row["target_group"] != tg_key:
+                tg_key = row["target_group"]
+                print(f"  Target Group: {tg_key}", file=f)
+            if row["error"]:
+                print(f"    Error: {row['error']}", file=f)
+            elif row["target"]:
+                print(f"    Target: {row['target']} - State: {row['state']}", file=f)
+    return count
+
+# --------------------------
+# Watch mode
+# --------------------------
+EVENT_FIELDS = ("time", "region", "load_balancer", "target_group", "target", "port", "from", "to", "reason",
+                "time_to_healthy")
+# States a target passes through on its own; a group holding one is polled at
+# the fastest interval. unhealthy and unused can last indefinitely, so groups
+# stuck in them back off like healthy ones once --pending-window has passed.
+TRANSITIONAL = {"initial", "draining", "unhealthy.draining"}
+
+class Watcher:
+    """
+    Polls each target group on its own schedule and emits an event per
+    target state transition, registration and deregistration. A group that
+    changed on its last poll, holds a TRANSITIONAL target or has had a
+    target on its way to healthy for less than `pending_window` seconds is
+    polled every `interval` seconds; otherwise its interval doubles up to
+    `max_interval`, so a target stuck unhealthy doesn't pin its group to the
+    fast rate. Load balancers and target groups are re-discovered every
+    `discover_interval` seconds.
+
+    time_to_healthy is measured from the poll that first saw the target
+    registered or leave healthy, to the poll that saw it healthy. The end is
+    accurate to about `interval` within `pending_window`, and to about
+    `max_interval` after it. The start is only as accurate as the
+    group's interval when it happened: a target leaving healthy in a group
+    that had backed off is seen up to `max_interval` late, and its
+    time_to_healthy is short by as much. Targets already unhealthy when
+    watching started have no known start and get none.
+    """
+
+    def __init__(self, clients, pool, name_prefix="", lb_type="network", interval=5.0, max_interval=60.0,
+                 discover_interval=300.0, emit=print, pending_window=300.0):
+        self.clients, self.pool = clients, pool
+        self.name_prefix, self.lb_type = name_prefix, lb_type
+        self.interval, self.max_interval, self.discover_interval = interval, max_interval, discover_interval
+        self.pending_window = pending_window
+        self.emit = emit
+        self.groups = {}          # target group ARN -> region, names, schedule, target keys
+        self.targets = {}         # (target group ARN, id, port) -> {"state", "pending"}
+        self.heap = []            # (due, target group ARN); stale entries are skipped
+        self.calls = 0
+        self.healthy_after = []   # time_to_healthy measurements
+        self.discovered = False
+
+    def _schedule(self, arn, now, interval):
+        group = self.groups[arn]
+        group["interval"], group["due"] = interval, now + interval
+        heapq.heappush(self.heap, (group["due"], arn))
+
+    def _event(self, group, key, old, new, reason="", time_to_healthy=None):
+        self.emit({"time": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), "region": group["region"],
+                   "load_balancer": ",".join(group["lbs"]), "target_group": group["name"],
+                   "target": key[1], "port": key[2], "from": old, "to": new, "reason": reason,
+                   "time_to_healthy": None if time_to_healthy is None else round(time_to_healthy, 1)})
+
+    def discover(self, now):
+        futures = {region: self.pool.submit(discover, client, self.name_prefix, self.lb_type)
+                   for region, client in self.clients.items()}
+        for region, future in futures.items():
+            try:
+                lbs, tgs_by_lb = future.result()
+            except (BotoCoreError, ClientError) as e:
+                print(f"{region}: discovery failed, keeping the previous layout: {e}", file=sys.stderr)
+                continue
+            found = {}
+            for lb in sorted(lbs, key=lambda lb: lb["LoadBalancerName"]):
+                for tg in tgs_by_lb[lb["LoadBalancerArn"]]:
+                    found.setdefault(tg["TargetGroupArn"], (tg["TargetGroupName"], []))[1].append(lb["LoadBalancerName"])
+            for arn in [arn for arn, group in self.groups.items() if group["region"] == region and arn not in found]:
+                group = self.groups.pop(arn)
+                for key in group["keys"]:
+                    self._event(group, key, self.targets.pop(key)["state"], None, "target group removed")
+            for arn, (name, lb_names) in found.items():
+                if arn in self.groups:
+                    self.groups[arn].update(name=name, lbs=lb_names)
+                    continue
+                # Targets of groups that show up after the first discovery
+                # are reported as registrations; the rest are the baseline.
+                self.groups[arn] = {"region": region, "name": name, "lbs": lb_names, "keys": set(),
+                                    "baseline": not self.discovered}
+                self._schedule(arn, now, 0.0)
+        self.discovered = True
+
+    def update(self, arn, descs, now):
+        group = self.groups[arn]
+        current = {(arn, d["Target"]["Id"], d["Target"].get("Port")): d["TargetHealth"] for d in descs}
+        changed = False
+        for key, health in current.items():
+            state, prev = health.get("State", ""), self.targets.get(key)
+            old = prev["state"] if prev else None
+            if state == old:
+                continue
+            if group["baseline"]:
+                self.targets[key] = {"state": state, "pending": None}
+                continue
+            changed = True
+            pending = prev["pending"] if prev else None
+            time_to_healthy = None
+            if state == "healthy":
+                if pending is not None:
+                    time_to_healthy = now - pending
+                    self.healthy_after.append(time_to_healthy)
+                pending = None
+            elif old in (None, "healthy"):
+                pending = now
+            self.targets[key] = {"state": state, "pending": pending}
+            self._event(group, key, old, state, health.get("Reason", ""), time_to_healthy)
+        for key in group["keys"] - current.keys():
+            changed = True
+            self._event(group, key, self.targets.pop(key)["state"], None, "deregistered")
+        group["keys"] = set(current)
+        group["baseline"] = False
+
+        unstable = (changed or any(h.get("State") in TRANSITIONAL for h in current.values())
+                    or any(now - pending < self.pending_window
+                           for pending in (self.targets[key]["pending"] for key in current) if pending is not None))
+        self._schedule(arn, now, self.interval if unstable else min(group["interval"] * 2 or self.interval,
+                                                                    self.max_interval))
+
+    def run(self, duration=0):
+        """Polls until `duration` seconds have passed (0 = until interrupted)."""
+        start = time.monotonic()
+        stop = start + duration if duration else float("inf")
+        next_discovery, inflight = start, {}
+        while time.monotonic() < stop:
+            now = time.monotonic()
+            if now >= next_discovery:
+                self.discover(now)
+                next_discovery = now + self.discover_interval
+            while self.heap and self.heap[0][0] <= now:
+                due, arn = heapq.heappop(self.heap)
+                group = self.groups.get(arn)
+                if group and group["due"] == due:
+                    inflight[self.pool.submit(target_health, self.clients[group["region"]], arn)] = arn
+                    self.calls += 1
+            wake = min(self.heap[0][0] if self.heap else stop, next_discovery, stop)
+            timeout = max(0.0, wake - time.monotonic())
+            if not inflight:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(inflight, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                arn = inflight.pop(future)
+                if arn not in self.groups:
+                    continue
+                try:
+                    descs = future.result()
+                except (BotoCoreError, ClientError) as e:
+                    print(f"{self.groups[arn]['name']}: {e}", file=sys.stderr)
+                    self._schedule(arn, time.monotonic(), self.max_interval)
+                    continue
+                self.update(arn, descs, time.monotonic())
+        return time.monotonic() - start
+
+    def summary(self, elapsed):
+        line = f"{self.calls} health calls for {len(self.groups)} target groups in {elapsed:.0f}s"
+        if self.healthy_after:
+            line += (f"; time to healthy over {len(self.healthy_after)} targets: "
+                     f"p50 {statistics.median(self.healthy_after):.0f}s, max {max(self.healthy_after):.0f}s")
+        return line
+
+class EventWriter:
+    """Watch events as text lines, csv rows or JSON lines, flushed one by one."""
+
+    def __init__(self, f, fmt="text"):
+        self.f, self.fmt = f, fmt
+        if fmt == "csv":
+            self.writer = csv.DictWriter(f, fieldnames=EVENT_FIELDS)
+            self.writer.writeheader()
+
+    def write(self, event):
+        if self.fmt == "csv":
+            self.writer.writerow(event)
+        elif self.fmt == "json":
+            self.f.write(json.dumps(event) + "\n")
+        else:
+            line = (f"{event['time']} {event['region']} {event['load_balancer']}/{event['target_group']} "
+                    f"{event['target']}:{event['port']} {event['from'] or '-'} -> {event['to'] or '-'}")
+            if event["reason"]:
+                line += f" ({event['reason']})"
+            if event["time_to_healthy"] is not None:
+                line += f" after {event['time_to_healthy']:.0f}s"
+            print(line, file=self.f)
+        self.f.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--regions", help="comma-separated (default: the configured region)")
+    parser.add_argument("--name-prefix", default="klb", help="load balancer name prefix ('' for all)")
+    parser.add_argument("--type", default="network", choices=("network", "application", "gateway", "all"))
+    parser.add_argument("--workers", type=int, default=16, help="concurrent API calls across all regions")
+    parser.add_argument("--rate", type=float, default=20.0, help="API requests/sec per region (0 = unpaced)")
+    parser.add_argument("--max-attempts", type=int, default=10, help="per call, including throttled retries")
+    parser.add_argument("--tags", action="store_true", help="add load balancer and target group tags")
+    parser.add_argument("--format", default="text", choices=("text", "csv", "json"))
+    parser.add_argument("--out", default="-")
+    parser.add_argument("--watch", action="store_true", help="keep polling and print state transitions only")
+    parser.add_argument("--interval", type=float, default=5.0, help="--watch: poll interval for changing groups")
+    parser.add_argument("--max-interval", type=float, default=60.0, help="--watch: back-off limit for stable groups")
+    parser.add_argument("--discover-interval", type=float, default=300.0,
+                        help="--watch: re-list load balancers and target groups this often")
+    parser.add_argument("--pending-window", type=float, default=300.0,
+                        help="--watch: poll a group at --interval for at most this long while a target is on its way to healthy")
+    parser.add_argument("--duration", type=float, default=0, help="--watch: stop after this many seconds")
+    args = parser.parse_args()
+
+    regions = args.regions.split(",") if args.regions else [boto3.session.Session().region_name]
+    start = time.perf_counter()
+    out = sys.stdout if args.out == "-" else open(args.out, "w", newline="", encoding="utf-8")
+    try:
+        if args.watch:
+            clients = {region: make_client(region, args.workers, args.max_attempts, args.rate) for region in regions}
+            with ThreadPoolExecutor(args.workers) as pool:
+                watcher = Watcher(clients, pool, args.name_prefix, args.type, args.interval, args.max_interval,
+                                  args.discover_interval, EventWriter(out, args.format).write,
+                                  pending_window=args.pending_window)
+                try:
+                    watcher.run(args.duration)
+                except KeyboardInterrupt:
+                    pass
+            print(watcher.summary(time.perf_counter() - start), file=sys.stderr)
+        else:
+            rows = snapshot(regions, args.name_prefix, args.type, args.workers, args.tags, args.max_attempts, args.rate)
+            count = write_rows(rows, args.format, out)
+            print(f"{count} rows from {len(regions)} region(s) in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
 
-# Create an ELBv2 client
-elb_client = boto3.client('elbv2')
-
-# Get all NLBs with name suffix 'klb'
-nlbs = elb_client.describe_load_balancers(
-    Names=[
-        {'Prefix': 'klb'}
-    ]
-)['LoadBalancers']
-
-for nlb in nlbs:
-    nlb_name = nlb['LoadBalancerName']
-    print(f"\nLoad Balancer: {nlb_name}")
-
-    # Get target groups for this NLB
-    target_groups = elb_client.describe_target_groups(
-        LoadBalancerArn=nlb['LoadBalancerArn']
-    )['TargetGroups']
-
-    for tg in target_groups:
-        tg_name = tg['TargetGroupName']
-        print(f"  Target Group: {tg_name}")
-
-        # Get health of targets in this target group
-        target_health = elb_client.describe_target_health(
-            TargetGroupArn=tg['TargetGroupArn']
-        )['TargetHealthDescriptions']
-
-        for target in target_health:
-            target_id = target['Target']['Id']
-            target_state = target['TargetHealth']['State']
-            print(f"    Target: {target_id} - State: {target_state}")
+if __name__ == "__main__":
+    main()
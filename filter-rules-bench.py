@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the filter rule engine in kinesis-lambda.py. Builds rule
+sets of increasing size (a mix of substring, regex, JSON field and
+record-scoped rules, most of which miss, as in a real noise-filter list) and
+reports per-event cost of rule evaluation with and without the combined
+prefilter, next to the cost of turning the whole record into HEC lines.
+
+Usage: python3 filter-rules-bench.py [--events 5000] [--repeat 5] [--rules 0,1,5,10,25,50,100,200]
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def _load_lambda():
+    # Rules under test are swapped in directly; never pick up a configured set.
+    os.environ.pop("FILTER_RULES", None)
+    os.environ["FILTER_RULES_FILE"] = ""
+    os.environ.setdefault("SPLUNK_HEC_TOKEN", "00000000-0000-0000-0000-000000000000")
+    spec = importlib.util.spec_from_file_location("kinesis_lambda", os.path.join(HERE, "kinesis-lambda.py"))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+def _rules(n):
+    """n rules; the first drops health checks, the rest are unlikely to match."""
+    out = [{"contains": "GET /healthz", "action": "drop"}][:n]
+    for k in range(1, n):
+        kind = k % 4
+        if kind == 0:
+            out.append({"contains": f"noise-token-{k}", "action": "drop"})
+        elif kind == 1:
+            out.append({"contains": f"E{k:04d}: ", "regex": rf"\bE{k:04d}: .*(timeout|refused)",
+                        "action": "sample", "percent": 10})
+        elif kind == 2:
+            out.append({"field": "service", "equals": f"svc-{k}", "action": "route", "index": f"idx{k}"})
+        else:
+            out.append({"logGroup": f"/other/group-{k}*", "action": "drop"})
+    return out
+
+def _record(n, seed=7):
+    rng = random.Random(seed)
+    events = []
+    for i in range(n):
+        r = rng.random()
+        if r < 0.05:
+            msg = f'10.0.{i % 255}.1 - - "GET /healthz HTTP/1.1" 200 2'
+        elif r < 0.5:
+            msg = json.dumps({"level": rng.choice(("INFO", "DEBUG", "WARN")), "service": "orders",
+                              "path": f"/api/v1/items/{i}", "latency_ms": round(rng.random() * 80, 2)})
+        else:
+            msg = f"INFO request {i:08d} completed status=200 code=2{i % 1000:03d} bytes={rng.randint(100, 9000)}"
+        events.append({"id": f"{i:056d}", "timestamp": 1700000000123 + i, "message": msg})
+    return {"messageType": "DATA_MESSAGE", "owner": "123456789012", "logGroup": "/aws/lambda/orders",
+            "logStream": "2024/01/01/[$LATEST]abc", "subscriptionFilters": ["to-kinesis"], "logEvents": events}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--rules", default="0,1,5,10,25,50,100,200")
+    args = parser.parse_args()
+
+    mod = _load_lambda()
+    record = _record(args.events)
+    events = record["logEvents"]
+    n = len(events)
+
+    print(f"{'rules':>5} {'prefilter':>10} {'per-rule':>10} {'to_lines':>10} {'kept':>6}   (ns/event, best of {args.repeat})")
+    for count in (int(c) for c in args.rules.split(",")):
+        mod._rules = mod.RuleSet(_rules(count), mod._parse_message)
+        selected = mod._rules.for_record(record["logGroup"], record["logStream"])
+
+        def evaluate(rr=selected):
+            if rr is None:
+                return
+            for e in events:
+                rr.evaluate(e, e["message"])
+
+        if selected is not None:
+            fast = min(timeit.repeat(evaluate, number=1, repeat=args.repeat)) / n
+            prefilter, selected.prefilter = selected.prefilter, None
+            slow = min(timeit.repeat(evaluate, number=1, repeat=args.repeat)) / n
+            selected.prefilter = prefilter
+        else:
+            fast = slow = 0.0
+        lines = min(timeit.repeat(lambda: list(mod._to_splunk_lines(record)), number=1, repeat=args.repeat)) / n
+        kept = len(list(mod._to_splunk_lines(record)))
+        print(f"{count:5d} {fast * 1e9:10.0f} {slow * 1e9:10.0f} {lines * 1e9:10.0f} {kept:6d}")
+
+if __name__ == "__main__":
+    main()
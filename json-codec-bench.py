@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the JSON backends used by kinesis-lambda.py and
+kinesis-claude-lambda.py. Reports per-event cost of the three JSON steps on
+the Lambda hot path (record parse, message parse, event serialize) for each
+installed backend, built by kinesis_common.load_codec() exactly as the
+Lambdas build it. Checks that every backend's output decodes to the same
+value as stdlib, and that message parsing (exact_loads) returns what stdlib
+returns for text fast backends read differently: integers wider than 64 bits,
+NaN/Infinity and out-of-range floats. Where the record parse differs it is
+listed; that is expected, since message text never goes through it. Float
+spellings that differ from stdlib (orjson writes 2.5e-7 for 2.5e-07, the
+same value) are listed too but are not an error.
+
+Usage: python3 json-codec-bench.py [--events 2000] [--repeat 5]
+"""
+
+import argparse
+import json
+import timeit
+
+import kinesis_common
+
+def _backends():
+    """(loads, message loads, dumps) for each installed backend."""
+    out = {}
+    for name in ("json", "orjson", "ujson"):
+        try:
+            _, loads, dumps = kinesis_common.load_codec(name)
+        except ImportError:
+            continue
+        out[name] = (loads, kinesis_common.exact_loads(loads), dumps)
+    return out
+
+# Message text a fast backend's loads may not read the way stdlib does.
+FIDELITY = {
+    "wide int": '{"id":123456789012345678901234567890,"n":-9223372036854775809}',
+    "u64 max": '{"n":18446744073709551615}',
+    "nan/inf": '{"v":NaN,"w":Infinity,"x":-Infinity}',
+    "1e400": '{"big":1e400}',
+    "floats": '{"f":2.5e-07,"g":1e+22,"h":0.1}',
+}
+
+def _decoded(loads, text):
+    """What loads returns, spelled by stdlib so NaN compares equal and 1 != 1.0; or the error."""
+    try:
+        return json.dumps(loads(text))
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+def _sample(n):
+    """A CloudWatch Logs record with a mix of plain, JSON and non-ASCII messages."""
+    events = []
+    for i in range(n):
+        if i % 3 == 0:
+            msg = f"START RequestId: 3f1c{i:08d} Version: $LATEST path=/api/v1/items/{i}"
+        elif i % 3 == 1:
+            msg = json.dumps({
+                "level": "INFO", "ts": 1700000000.123 + i, "latency_ms": i * 0.37,
+                "path": f"/api/v1/items/{i}", "user": "jürgen", "tags": ["a", "b"],
+            })
+        else:
+            msg = f"WARN 请求超时 retry={i % 5} host=ip-10-0-{i % 255}-1"
+        events.append({"id": f"{i:056d}", "timestamp": 1700000000123 + i, "message": msg})
+    record = {
+        "messageType": "DATA_MESSAGE", "owner": "123456789012",
+        "logGroup": "/aws/lambda/orders", "logStream": "2024/01/01/[$LATEST]abc",
+        "subscriptionFilters": ["to-kinesis"], "logEvents": events,
+    }
+    hec_events = [
+        {
+            "source": "cloudwatch", "sourcetype": "aws:cloudwatchlogs", "index": "main",
+            "time": e["timestamp"] / 1000.0,
+            "event": {"message": e["message"], "owner": record["owner"],
+                      "logGroup": record["logGroup"], "logStream": record["logStream"]},
+        }
+        for e in events
+    ]
+    return json.dumps(record).encode("utf-8"), [e["message"] for e in events], hec_events
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    payload, messages, hec_events = _sample(args.events)
+    json_msgs = [m for m in messages if m.startswith("{")]
+    n = len(hec_events)
+
+    print(f"{'backend':8} {'record parse':>14} {'msg parse':>12} {'serialize':>12}   (ns/event, best of {args.repeat})")
+    floats = json.loads(FIDELITY["floats"])
+    notes = []
+    for name, (loads, loads_message, dumps) in _backends().items():
+        for evt in hec_events:
+            if json.loads(dumps(evt)) != evt:
+                raise SystemExit(f"{name}: output differs from stdlib for {evt!r}")
+        plain_differs = []
+        for case, text in FIDELITY.items():
+            expected = _decoded(json.loads, text)
+            if _decoded(loads_message, text) != expected:
+                raise SystemExit(f"{name}: message parse of {case} {text} gives {_decoded(loads_message, text)}, "
+                                 f"stdlib {expected}")
+            if _decoded(loads, text) != expected:
+                plain_differs.append(case)
+        if plain_differs:
+            notes.append(f"{name}: record parse differs from stdlib on {', '.join(plain_differs)}")
+        if dumps(floats) != json.dumps(floats, separators=(",", ":")).encode("utf-8"):
+            notes.append(f"{name}: writes {dumps(floats).decode()} for stdlib's {json.dumps(floats, separators=(',', ':'))}")
+
+        parse = min(timeit.repeat(lambda: loads(payload), number=1, repeat=args.repeat)) / n
+        msgs = min(timeit.repeat(lambda: [loads_message(m) for m in json_msgs], number=1, repeat=args.repeat)) / max(len(json_msgs), 1)
+        ser = min(timeit.repeat(lambda: [dumps(e) for e in hec_events], number=1, repeat=args.repeat)) / n
+        print(f"{name:8} {parse * 1e9:14.0f} {msgs * 1e9:12.0f} {ser * 1e9:12.0f}")
+    for note in notes:
+        print(note)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the Kinesis -> Splunk Lambdas (kinesis-lambda.py and
+kinesis-claude-lambda.py). Nothing here talks to AWS or a real Splunk.
+
+  gen    write a Lambda Kinesis event of synthetic CloudWatch Logs records
+  serve  run a local HEC stand-in with injectable latency, 5xx and 413s
+  run    start the stand-in, invoke each Lambda N times in its own process
+         and report events/sec, p50/p99 invocation time, peak RSS and a
+         per-stage time breakdown
+
+Examples:
+  python3 kinesis-bench.py run --records 100 --events-per-record 500 --invocations 20
+  python3 kinesis-bench.py run --lambda kinesis-lambda.py --latency-ms 40 --error-rate 0.02
+  python3 kinesis-bench.py serve --port 8088 --latency-ms 25
+
+Lambda settings (HEC_CONCURRENCY, HEC_MAX_BYTES, HEC_GZIP, ...) are read from
+the environment as usual, so sweep them by exporting before `run`.
+
+Stage times come from wrapping the Lambda's own functions and are exclusive
+(a stage excludes the stages nested inside it). `post` is summed across
+worker threads, so it can exceed wall time when POSTs run concurrently. The
+wrappers add a little overhead per call; compare runs against each other,
+not against production durations.
+"""
+
+import argparse
+import base64
+import contextlib
+import gzip
+import importlib.util
+import io
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDAS = ("kinesis-lambda.py", "kinesis-claude-lambda.py")
+
+# --------------------------
+# Synthetic CloudWatch Logs records
+# --------------------------
+_LEVELS = ("INFO", "INFO", "INFO", "DEBUG", "WARN", "ERROR")
+_PATHS = ("/api/v1/orders", "/api/v1/items", "/healthz", "/api/v2/users", "/login")
+
+def _message(rng, i, size, as_json):
+    if as_json:
+        msg = {
+            "level": rng.choice(_LEVELS),
+            "ts": 1700000000.0 + i / 1000.0,
+            "requestId": str(uuid.UUID(int=rng.getrandbits(128))),
+            "path": rng.choice(_PATHS),
+            "status": rng.choice((200, 200, 200, 201, 404, 500)),
+            "latency_ms": round(rng.random() * 250, 3),
+            "detail": "",
+        }
+        pad = size - len(json.dumps(msg))
+        msg["detail"] = "%x" % rng.getrandbits(max(pad, 1) * 4) if pad > 0 else ""
+        return json.dumps(msg)
+    head = "%s %s %s status=%d" % (
+        rng.choice(_LEVELS), rng.choice(_PATHS),
+        uuid.UUID(int=rng.getrandbits(128)), rng.choice((200, 404, 500)),
+    )
+    pad = size - len(head) - 1
+    return head + (" " + "%x" % rng.getrandbits(pad * 4) if pad > 0 else "")
+
+def make_record(rng, seq, events_per_record=100, message_bytes=256, json_ratio=0.5, log_group=None):
+    """One Kinesis record as delivered to the Lambda: base64(gzip(CWL subscription JSON))."""
+    ts = 1700000000000 + seq * 1000
+    payload = {
+        "messageType": "DATA_MESSAGE",
+        "owner": "123456789012",
+        "logGroup": log_group or "/aws/lambda/bench-%d" % (seq % 4),
+        "logStream": "2024/01/01/[$LATEST]%032x" % rng.getrandbits(128),
+        "subscriptionFilters": ["to-kinesis"],
+        "logEvents": [
+            {
+                "id": "%056d" % rng.getrandbits(180),
+                "timestamp": ts + i,
+                "message": _message(rng, i, message_bytes, rng.random() < json_ratio),
+            }
+            for i in range(events_per_record)
+        ],
+    }
+    data = base64.b64encode(gzip.compress(json.dumps(payload).encode("utf-8"))).decode("ascii")
+    return {
+        "kinesis": {
+            "kinesisSchemaVersion": "1.0",
+            "partitionKey": "%032x" % rng.getrandbits(128),
+            "sequenceNumber": "4959%052d" % seq,
+            "data": data,
+            "approximateArrivalTimestamp": ts / 1000.0,
+        },
+        "eventSource": "aws:kinesis",
+        "eventID": "shardId-000000000000:4959%052d" % seq,
+    }
+
+def make_event(records=100, seed=1, **kwargs):
+    rng = random.Random(seed)
+    return {"Records": [make_record(rng, seq, **kwargs) for seq in range(records)]}
+
+# --------------------------
+# Local HEC stand-in
+# --------------------------
+class HecStandIn(ThreadingHTTPServer):
+    """
+    Accepts /services/collector[/event|/raw] and /services/collector/ack like
+    HEC does. Every request sleeps latency_ms (+/- jitter_ms), then fails with
+    503 at error_rate or 413 at too_large_rate (or when the uncompressed body
+    exceeds max_content_length). Acks are confirmed on the first poll.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, addr, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, too_large_rate=0.0,
+                 max_content_length=0, seed=None):
+        super().__init__(addr, _HecHandler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.too_large_rate = too_large_rate
+        self.max_content_length = max_content_length
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ack_ids = {}
+        self.stats = {"requests": 0, "events": 0, "bytes": 0, "5xx": 0, "413": 0, "acks": 0}
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+    def bump(self, **counts):
+        with self.lock:
+            for k, v in counts.items():
+                self.stats[k] += v
+
+class _HecHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        srv = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        url = urlparse(self.path)
+        channel = self.headers.get("X-Splunk-Request-Channel") or parse_qs(url.query).get("channel", [""])[0]
+
+        if url.path.endswith("/ack"):
+            acks = json.loads(body).get("acks", [])
+            srv.bump(acks=len(acks))
+            return self._reply(200, {"acks": {str(a): True for a in acks}})
+
+        with srv.lock:
+            delay = srv.latency_ms + srv.rng.uniform(-srv.jitter_ms, srv.jitter_ms)
+            roll = srv.rng.random()
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        srv.bump(requests=1)
+        if roll < srv.error_rate:
+            srv.bump(**{"5xx": 1})
+            return self._reply(503, {"text": "Server is busy", "code": 9})
+        if roll < srv.error_rate + srv.too_large_rate or (srv.max_content_length and len(body) > srv.max_content_length):
+            srv.bump(**{"413": 1})
+            return self._reply(413, {"text": "Content length exceeded", "code": 27})
+
+        srv.bump(events=body.count(b"\n") + 1, bytes=len(body))
+        with srv.lock:
+            ack_id = srv.ack_ids.get(channel, 0)
+            srv.ack_ids[channel] = ack_id + 1
+        self._reply(200, {"text": "Success", "code": 0, "ackId": ack_id})
+
+def start_server(port=0, **kwargs):
+    srv = HecStandIn(("127.0.0.1", port), **kwargs)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+# --------------------------
+# Per-stage timing
+# --------------------------
+class _Stages:
+    """Exclusive wall time per stage; nested calls are charged to the inner stage only."""
+
+    def __init__(self):
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stack = self._stack()
+        frame = [time.perf_counter(), 0.0]
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            elapsed = time.perf_counter() - frame[0]
+            if stack:
+                stack[-1][1] += elapsed
+            with self.lock:
+                self.totals[name] = self.totals.get(name, 0.0) + elapsed - frame[1]
+
+    def wrap(self, name, fn):
+        def _wrapped(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return _wrapped
+
+    def wrap_gen(self, name, fn):
+        def _wrapped(*args, **kwargs):
+            it = iter(fn(*args, **kwargs))
+            while True:
+                with self.stage(name):
+                    try:
+                        item = next(it)
+                    except StopIteration:
+                        return
+                yield item
+        return _wrapped
+
+def _instrument(mod, stages):
+    base64.b64decode = stages.wrap("b64decode", base64.b64decode)
+    gzip.decompress = stages.wrap("gunzip", gzip.decompress)
+    if hasattr(mod, "handler"):
+        mod._json_loads = stages.wrap("json_parse", mod._json_loads)
+        mod._json_loads_exact = stages.wrap("json_parse", mod._json_loads_exact)
+        mod._json_dumps = stages.wrap("serialize", mod._json_dumps)
+        mod._to_splunk_lines = stages.wrap_gen("build", mod._to_splunk_lines)
+        mod._post_hec = stages.wrap("post", mod._post_hec)
+        return mod.handler
+    mod.json_loads = stages.wrap("json_parse", mod.json_loads)
+    mod.json_loads_exact = stages.wrap("json_parse", mod.json_loads_exact)
+    mod.json_dumps = stages.wrap("serialize", mod.json_dumps)
+    mod.iter_splunk_events = stages.wrap_gen("build", mod.iter_splunk_events)
+    mod.send_to_splunk = stages.wrap("post", mod.send_to_splunk)
+    return mod.lambda_handler
+
+class FakeContext:
+    """Just enough of the Lambda context object for the handlers."""
+
+    function_name = "kinesis-bench"
+    memory_limit_in_mb = 512
+    aws_request_id = "bench"
+
+    def __init__(self, timeout_sec):
+        self._deadline = time.monotonic() + timeout_sec
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+# --------------------------
+# Runner
+# --------------------------
+def _worker(args):
+    """Runs inside a fresh interpreter so ru_maxrss belongs to one Lambda only."""
+    with open(args.event_file, encoding="utf-8") as f:
+        event = json.load(f)
+    n_events = sum(
+        len(json.loads(gzip.decompress(base64.b64decode(r["kinesis"]["data"])))["logEvents"])
+        for r in event["Records"]
+    )
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec = importlib.util.spec_from_file_location("bench_lambda", os.path.join(HERE, args.lambda_file))
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+    import_ms = (time.perf_counter() - t0) * 1000
+
+    stages = _Stages()
+    fn = _instrument(mod, stages)
+    durations, failures = [], 0
+    for _ in range(args.invocations):
+        sink = io.StringIO()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sink):
+            result = fn(event, FakeContext(args.timeout_sec))
+        durations.append(time.perf_counter() - start)
+        failures += len((result or {}).get("batchItemFailures", []))
+        sink.truncate(0)
+
+    durations.sort()
+    total = sum(durations)
+    print(json.dumps({
+        "lambda": args.lambda_file,
+        "import_ms": import_ms,
+        "invocations": args.invocations,
+        "events_per_sec": n_events * args.invocations / total if total else 0.0,
+        "p50_ms": statistics.median(durations) * 1000,
+        "p99_ms": durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "rss_before_mb": rss_before / 1024.0,
+        "failed_records": failures,
+        "stages_ms": {k: v * 1000 / args.invocations for k, v in sorted(stages.totals.items())},
+    }))
+
+def _run(args):
+    lambdas = LAMBDAS if args.lambda_file == "both" else (args.lambda_file,)
+    event = make_event(
+        records=args.records, seed=args.seed, events_per_record=args.events_per_record,
+        message_bytes=args.message_bytes, json_ratio=args.json_ratio,
+    )
+    srv = None
+    hec_url = args.hec_url
+    if not hec_url:
+        srv = start_server(
+            latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+            too_large_rate=args.too_large_rate, max_content_length=args.max_content_length, seed=args.seed,
+        )
+        hec_url = srv.url
+
+    n_events = args.records * args.events_per_record
+    print(f"{args.records} records x {args.events_per_record} events "
+          f"({n_events} events, ~{args.message_bytes} B/message, json_ratio={args.json_ratio}), "
+          f"{args.invocations} invocations, HEC at {hec_url}")
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(event, f)
+        event_file = f.name
+    try:
+        for name in lambdas:
+            env = dict(os.environ)
+            env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+            env.setdefault("SPLUNK_HEC_TOKEN", "00000000-0000-0000-0000-000000000000")
+            # kinesis-claude-lambda.py posts to SPLUNK_HEC_URL as-is; kinesis-lambda.py appends the path.
+            env["SPLUNK_HEC_URL"] = hec_url + ("/services/collector/event" if "claude" in name else "")
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "_worker", "--lambda", name,
+                 "--event-file", event_file, "--invocations", str(args.invocations),
+                 "--timeout-sec", str(args.timeout_sec)],
+                env=env, capture_output=True, text=True,
+            )
+            if out.returncode != 0:
+                print(f"\n{name}: worker failed\n{out.stderr}")
+                continue
+            r = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"\n{name}")
+            print(f"  events/sec     {r['events_per_sec']:12.0f}")
+            print(f"  p50 / p99 ms   {r['p50_ms']:12.1f} / {r['p99_ms']:.1f}")
+            print(f"  peak RSS MB    {r['peak_rss_mb']:12.1f}  (before import {r['rss_before_mb']:.1f})")
+            print(f"  import ms      {r['import_ms']:12.1f}")
+            print(f"  failed records {r['failed_records']:12d}")
+            print("  stage ms/invocation:")
+            for stage, ms in sorted(r["stages_ms"].items(), key=lambda kv: -kv[1]):
+                print(f"    {stage:12} {ms:10.1f}")
+    finally:
+        os.unlink(event_file)
+        if srv is not None:
+            print(f"\nHEC stand-in: {srv.stats}")
+            srv.shutdown()
+
+def _add_gen_args(p):
+    p.add_argument("--records", type=int, default=100)
+    p.add_argument("--events-per-record", type=int, default=100)
+    p.add_argument("--message-bytes", type=int, default=256)
+    p.add_argument("--json-ratio", type=float, default=0.5)
+    p.add_argument("--seed", type=int, default=1)
+
+def _add_server_args(p):
+    p.add_argument("--latency-ms", type=float, default=5.0)
+    p.add_argument("--jitter-ms", type=float, default=0.0)
+    p.add_argument("--error-rate", type=float, default=0.0, help="fraction of POSTs answered with 503")
+    p.add_argument("--too-large-rate", type=float, default=0.0, help="fraction of POSTs answered with 413")
+    p.add_argument("--max-content-length", type=int, default=0, help="413 any body larger than this (0 = off)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("gen", help="write a synthetic Kinesis event to a file")
+    _add_gen_args(p)
+    p.add_argument("--out", default="-")
+
+    p = sub.add_parser("serve", help="run the HEC stand-in in the foreground")
+    _add_server_args(p)
+    p.add_argument("--port", type=int, default=8088)
+
+    p = sub.add_parser("run", help="benchmark the Lambdas")
+    _add_gen_args(p)
+    _add_server_args(p)
+    p.add_argument("--lambda", dest="lambda_file", default="both", choices=LAMBDAS + ("both",))
+    p.add_argument("--invocations", type=int, default=10)
+    p.add_argument("--timeout-sec", type=float, default=300.0, help="simulated Lambda timeout")
+    p.add_argument("--hec-url", help="use an already running HEC (stand-in) instead of starting one")
+
+    p = sub.add_parser("_worker")
+    p.add_argument("--lambda", dest="lambda_file", required=True)
+    p.add_argument("--event-file", required=True)
+    p.add_argument("--invocations", type=int, required=True)
+    p.add_argument("--timeout-sec", type=float, required=True)
+
+    args = parser.parse_args()
+    if args.cmd == "gen":
+        event = make_event(
+            records=args.records, seed=args.seed, events_per_record=args.events_per_record,
+            message_bytes=args.message_bytes, json_ratio=args.json_ratio,
+        )
+        if args.out == "-":
+            json.dump(event, sys.stdout)
+        else:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(event, f)
+    elif args.cmd == "serve":
+        srv = HecStandIn(
+            ("127.0.0.1", args.port), latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+            error_rate=args.error_rate, too_large_rate=args.too_large_rate,
+            max_content_length=args.max_content_length,
+        )
+        print(f"HEC stand-in listening on {srv.url}")
+        try:
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            print(srv.stats)
+    elif args.cmd == "run":
+        _run(args)
+    else:
+        _worker(args)
+
+if __name__ == "__main__":
+    main()
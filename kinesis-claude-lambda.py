@@ -1,232 +1,419 @@
-import json
 import gzip
 import base64
 import os
+import random
+import time
 import urllib3
 from datetime import datetime
 
+# Shared with kinesis-lambda.py: JSON codec (orjson, then ujson, then stdlib),
+# metrics, retries, dedupe, filter rules and the streaming decoder.
+from kinesis_common import (
+    DEDUPE_CACHE_SIZE, DROP, STREAM_DECODE_MIN_BYTES, UNPARSED, CircuitBreaker, Deadline, DedupeCache,
+    Metrics, Retryable, RuleSet, StreamDecoder, json_dumps, json_loads, json_loads_exact, load_rules, retry_call,
+)
+
+# Optional per-invocation metrics as one CloudWatch Embedded Metric Format line,
+# emitted for METRICS_SAMPLE_RATE of invocations. LOG_RECORDS restores the
+# per-record/per-POST log lines (off by default; they cost ingestion).
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '1.0'))
+LOG_RECORDS = os.environ.get('LOG_RECORDS', 'false').lower() == 'true'
+
+metrics = Metrics(False)
+
+# Retries: full-jitter exponential backoff between up to MAX_RETRIES attempts,
+# never sleeping past the invocation deadline. The circuit breaker lives at module
+# level, so it carries over between warm invocations; backoff, breaker and
+# deadline margin settings are read by kinesis_common.py.
+
+MAX_RETRIES = max(1, int(os.environ.get('MAX_RETRIES', '3')))
+
+breaker = CircuitBreaker()
+deadline = Deadline()
+
 # Initialize HTTP client
 
 http = urllib3.PoolManager()
 
 # Get environment variables
 
-SPLUNK_HEC_URL = os.environ[‘SPLUNK_HEC_URL’]
-SPLUNK_HEC_TOKEN = os.environ[‘SPLUNK_HEC_TOKEN’]
+SPLUNK_HEC_URL = os.environ['SPLUNK_HEC_URL']
+SPLUNK_HEC_TOKEN = os.environ['SPLUNK_HEC_TOKEN']
 
-def lambda_handler(event, context):
-“””
-Process records from Kinesis and send to Splunk HEC
-
-```
-Args:
-    event: Kinesis event containing records
-    context: Lambda context
-    
-Returns:
-    Response with batch item failures for retry
-"""
-print(f"Processing {len(event['Records'])} records from Kinesis")
-
-batch_item_failures = []
-successful_records = 0
-failed_records = 0
-
-for record in event['Records']:
+# Chunk limits for a single HEC POST; keep HEC_MAX_BYTES under HEC's
+# max_content_length (1 MB by default). HEC_MAX_EVENTS=0 disables the event cap.
+HEC_MAX_BYTES = int(os.environ.get('HEC_MAX_BYTES', '900000'))
+HEC_MAX_EVENTS = int(os.environ.get('HEC_MAX_EVENTS', '2000'))
+
+# Optional gzip request bodies (Content-Encoding: gzip)
+HEC_GZIP = os.environ.get('HEC_GZIP', 'false').lower() == 'true'
+HEC_GZIP_LEVEL = int(os.environ.get('HEC_GZIP_LEVEL', '1'))
+HEC_GZIP_MIN_BYTES = int(os.environ.get('HEC_GZIP_MIN_BYTES', '1024'))
+
+# Optional duplicate suppression across warm invocations (DEDUPE_CACHE_SIZE, see
+# kinesis_common.py): IDs of log events HEC accepted are remembered and events
+# found there are skipped before they are built.
+
+dedupe_cache = DedupeCache(DEDUPE_CACHE_SIZE)
+
+# Drop/sample/route filter rules (FILTER_RULES / FILTER_RULES_FILE) use the
+# same format and engine as kinesis-lambda.py; see kinesis_common.Rule.
+
+NOT_JSON = object()  # the message did not parse as JSON
+
+def parse_message(message):
+    """
+    Parse a log message as JSON
+
+    Args:
+        message: Log event message
+
+    Returns:
+        The decoded value, or NOT_JSON
+    """
     try:
-        # Extract Kinesis data
+        return json_loads_exact(message)
+    except (ValueError, TypeError):
+        return NOT_JSON
+
+# A malformed rule set fails container init instead of forwarding everything
+filter_rules = RuleSet(load_rules(), parse_message)
+
+GZIP_MAGIC = b'\x1f\x8b'
+# Header fields needed before the first log event can be built
+_STREAM_HEADER_KEYS = frozenset(('logGroup', 'logStream'))
+
+def decode_gzip_json(raw):
+    """
+    Decompress and parse a gzipped JSON record
+
+    Args:
+        raw: Gzipped bytes
+
+    Returns:
+        Parsed record; large CloudWatch Logs records get a lazy logEvents iterator
+    """
+    # ISIZE, the last four bytes of a gzip member, is the inflated size mod 2**32
+    if STREAM_DECODE_MIN_BYTES and int.from_bytes(raw[-4:], 'little') >= STREAM_DECODE_MIN_BYTES:
+        metrics.count('StreamedRecords')
+        with metrics.time('JsonParse'):
+            return StreamDecoder(raw, _STREAM_HEADER_KEYS, metrics).parse()
+    with metrics.time('Gunzip'):
+        data = gzip.decompress(raw)
+    metrics.count('BytesDecompressed', len(data))
+    with metrics.time('JsonParse'):
+        return json_loads(data)
+
+class Chunk:
+    """
+    Serialized events for one HEC POST, the Kinesis sequence numbers that fed
+    them and (with the dedupe cache on) their event IDs
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.size = 0
+        self.sequence_numbers = set()
+        self.event_ids = []
+
+    def fits(self, line):
+        if not self.lines:
+            return True
+        if HEC_MAX_EVENTS and len(self.lines) >= HEC_MAX_EVENTS:
+            return False
+        return self.size + len(line) <= HEC_MAX_BYTES
+
+    def add(self, sequence_number, line, event_id=None):
+        self.lines.append(line)
+        self.size += len(line) + 1  # newline separator
+        self.sequence_numbers.add(sequence_number)
+        if dedupe_cache.enabled:
+            self.event_ids.append(event_id)
+
+def lambda_handler(event, context):
+    """
+    Process records from Kinesis and send to Splunk HEC
+
+    Events from all records are packed into size-bounded chunks (HEC_MAX_BYTES /
+    HEC_MAX_EVENTS), so a batch costs a handful of POSTs instead of one per record.
+    If a chunk fails, every record that contributed to it is reported for retry,
+    as are records left unprocessed when the invocation deadline approaches.
+
+    Args:
+        event: Kinesis event containing records
+        context: Lambda context
+
+    Returns:
+        Response with batch item failures for retry
+    """
+    global metrics, deadline
+    metrics = Metrics(METRICS_ENABLED and random.random() < METRICS_SAMPLE_RATE)
+    deadline = Deadline(context)
+    invocation_start = time.perf_counter()
+    print(f"Processing {len(event['Records'])} records from Kinesis")
+
+    failed_sequence_numbers = set()
+    chunk = Chunk()
+
+    def flush(chunk):
+        if not chunk.lines:
+            return
+        if deadline.expired():
+            failed_sequence_numbers.update(chunk.sequence_numbers)
+            return
+        try:
+            send_to_splunk(b"\n".join(chunk.lines), len(chunk.lines))
+        except Exception as e:
+            print(f"Error sending {len(chunk.lines)} events from "
+                  f"{len(chunk.sequence_numbers)} records: {str(e)}")
+            failed_sequence_numbers.update(chunk.sequence_numbers)
+            return
+        dedupe_cache.add(chunk.event_ids)
+
+    for record in event['Records']:
         sequence_number = record['kinesis']['sequenceNumber']
-        partition_key = record['kinesis']['partitionKey']
-        data = record['kinesis']['data']
-        
-        # Decode base64 data
-        decoded_data = base64.b64decode(data)
-        
-        # Decompress if gzipped (CloudWatch Logs sends gzipped data)
+        if deadline.expired():
+            # Out of time: leave the rest of the batch for the retry
+            failed_sequence_numbers.add(sequence_number)
+            continue
         try:
-            decompressed_data = gzip.decompress(decoded_data)
-            log_data = json.loads(decompressed_data.decode('utf-8'))
-        except (OSError, gzip.BadGzipFile):
-            # Not gzipped, treat as plain text
-            log_data = decoded_data.decode('utf-8')
-        
-        # Process log data
-        events = process_log_data(log_data)
-        
-        # Send to Splunk
-        if events:
-            send_to_splunk(events)
-            successful_records += 1
-            print(f"Successfully processed record: {sequence_number}")
-        else:
+            # Extract Kinesis data
+            data = record['kinesis']['data']
+
+            # Decode base64 data
+            with metrics.time('B64Decode'):
+                decoded_data = base64.b64decode(data)
+            metrics.count('BytesIn', len(decoded_data))
+
+            # Decompress if gzipped (CloudWatch Logs sends gzipped data)
+            if decoded_data[:2] == GZIP_MAGIC:
+                log_data = decode_gzip_json(decoded_data)
+            else:
+                # Not gzipped, treat as plain text
+                log_data = decoded_data.decode('utf-8')
+
+            # Build and serialize one event at a time, straight into the chunk
+            has_ids = isinstance(log_data, dict) and 'logEvents' in log_data
+            lines = (
+                (e['event']['id'] if has_ids else None, json_dumps(e))
+                for e in iter_splunk_events(log_data)
+            )
+            if metrics.enabled:
+                lines = metrics.timed_iter('Serialize', lines)
+            event_count = 0
+            for event_id, line in lines:
+                if not chunk.fits(line):
+                    flush(chunk)
+                    chunk = Chunk()
+                chunk.add(sequence_number, line, event_id)
+                event_count += 1
+            metrics.count('Events', event_count)
+
+        except Exception as e:
+            # Events already chunked from this record are still sent (at-least-once)
+            print(f"Error processing record {sequence_number}: {str(e)}")
+            # Add to batch item failures for retry
+            failed_sequence_numbers.add(sequence_number)
+            continue
+
+        if not event_count and LOG_RECORDS:
             print(f"No events to send for record: {sequence_number}")
-            successful_records += 1
-            
-    except Exception as e:
-        print(f"Error processing record {sequence_number}: {str(e)}")
-        failed_records += 1
-        # Add to batch item failures for retry
-        batch_item_failures.append({
-            "itemIdentifier": sequence_number
-        })
-
-print(f"Processing complete. Successful: {successful_records}, Failed: {failed_records}")
-
-# Return batch item failures for partial batch response
-return {
-    "batchItemFailures": batch_item_failures
-}
-```
+
+    flush(chunk)
+
+    # Return batch item failures for partial batch response, in batch order
+    batch_item_failures = [
+        {"itemIdentifier": record['kinesis']['sequenceNumber']}
+        for record in event['Records']
+        if record['kinesis']['sequenceNumber'] in failed_sequence_numbers
+    ]
+    failed_records = len(batch_item_failures)
+    successful_records = len(event['Records']) - failed_records
+    print(f"Processing complete. Successful: {successful_records}, Failed: {failed_records}")
+
+    metrics.count('Records', len(event['Records']))
+    metrics.count('FailedRecords', failed_records)
+    if dedupe_cache.enabled:
+        metrics.count('DedupeEntries', len(dedupe_cache))
+        metrics.count('DedupeCacheBytes', dedupe_cache.memory_bytes())
+    metrics.add_time('Total', time.perf_counter() - invocation_start)
+    metrics.emit(context)
+
+    return {
+        "batchItemFailures": batch_item_failures
+    }
 
 def process_log_data(log_data):
-“””
-Process log data and convert to Splunk HEC format
-
-```
-Args:
-    log_data: Raw log data (dict or string)
-    
-Returns:
-    List of events in Splunk HEC format
-"""
-events = []
-
-# Handle CloudWatch Logs format
-if isinstance(log_data, dict) and 'logEvents' in log_data:
-    log_group = log_data.get('logGroup', 'unknown')
-    log_stream = log_data.get('logStream', 'unknown')
-    
-    for log_event in log_data['logEvents']:
-        event = {
-            "time": log_event['timestamp'] / 1000,  # Convert to seconds
-            "source": log_stream,
-            "sourcetype": "aws:cloudwatch",
-            "event": {
-                "message": log_event['message'],
-                "logGroup": log_group,
-                "logStream": log_stream,
-                "id": log_event.get('id', '')
+    """
+    Process log data and convert to Splunk HEC format
+
+    Args:
+        log_data: Raw log data (dict or string)
+
+    Returns:
+        List of events in Splunk HEC format
+    """
+    return list(iter_splunk_events(log_data))
+
+def iter_splunk_events(log_data):
+    """
+    Convert log data to Splunk HEC events one at a time
+
+    Args:
+        log_data: Raw log data (dict or string); logEvents may be a lazy iterator
+
+    Yields:
+        Events in Splunk HEC format
+    """
+    # Handle CloudWatch Logs format
+    if isinstance(log_data, dict) and 'logEvents' in log_data:
+        log_group = log_data.get('logGroup', 'unknown')
+        log_stream = log_data.get('logStream', 'unknown')
+
+        # Filter rules run before anything is parsed or built
+        rules = filter_rules.for_record(log_group, log_stream)
+        if rules is not None and rules.drops_all:
+            metrics.count('DroppedEvents', sum(1 for _ in log_data['logEvents']))
+            return
+
+        dedupe = dedupe_cache if dedupe_cache.enabled else None
+        dropped = duplicates = 0
+        for log_event in log_data['logEvents']:
+            if dedupe is not None and dedupe.seen(log_event.get('id')):
+                duplicates += 1
+                continue
+            parsed_message = UNPARSED
+            verdict = None
+            if rules is not None:
+                verdict, parsed_message = rules.evaluate(log_event, log_event['message'])
+                if verdict is DROP:
+                    dropped += 1
+                    continue
+
+            event = {
+                "time": log_event['timestamp'] / 1000,  # Convert to seconds
+                "source": log_stream,
+                "sourcetype": "aws:cloudwatch",
+                "event": {
+                    "message": log_event['message'],
+                    "logGroup": log_group,
+                    "logStream": log_stream,
+                    "id": log_event.get('id', '')
+                }
             }
+            if verdict is not None:
+                index, sourcetype = verdict
+                if sourcetype:
+                    event['sourcetype'] = sourcetype
+                if index:
+                    event['index'] = index
+
+            # Try to parse JSON messages (a field rule may already have)
+            if parsed_message is UNPARSED:
+                parsed_message = parse_message(log_event['message'])
+            if parsed_message is not NOT_JSON:
+                event['event']['parsed'] = parsed_message
+
+            yield event
+        if dropped:
+            metrics.count('DroppedEvents', dropped)
+        if duplicates:
+            metrics.count('DedupeHits', duplicates)
+
+    # Handle generic JSON format
+    elif isinstance(log_data, dict):
+        event = {
+            "time": datetime.utcnow().timestamp(),
+            "sourcetype": "_json",
+            "event": log_data
         }
-        
-        # Try to parse JSON messages
-        try:
-            parsed_message = json.loads(log_event['message'])
-            event['event']['parsed'] = parsed_message
-        except (json.JSONDecodeError, TypeError):
-            pass
-        
-        events.append(event)
-
-# Handle generic JSON format
-elif isinstance(log_data, dict):
-    event = {
-        "time": datetime.utcnow().timestamp(),
-        "sourcetype": "_json",
-        "event": log_data
-    }
-    events.append(event)
-
-# Handle plain text
-elif isinstance(log_data, str):
-    event = {
-        "time": datetime.utcnow().timestamp(),
-        "sourcetype": "text",
-        "event": log_data
+        yield event
+
+    # Handle plain text
+    elif isinstance(log_data, str):
+        event = {
+            "time": datetime.utcnow().timestamp(),
+            "sourcetype": "text",
+            "event": log_data
+        }
+        yield event
+
+def send_to_splunk(body, event_count, max_retries=MAX_RETRIES):
+    """
+    Send a chunk of events to Splunk HEC endpoint
+
+    Args:
+        body: Newline-delimited HEC events, already serialized
+        event_count: Number of events in body (for logging)
+        max_retries: Maximum number of attempts (see retry_call)
+
+    Raises:
+        Exception: On a 4xx, or once retry_call gives up
+    """
+    headers = {
+        'Authorization': f'Splunk {SPLUNK_HEC_TOKEN}',
+        'Content-Type': 'application/json'
     }
-    events.append(event)
-
-return events
-```
-
-def send_to_splunk(events, max_retries=3):
-“””
-Send events to Splunk HEC endpoint
-
-```
-Args:
-    events: List of events in Splunk HEC format
-    max_retries: Maximum number of retry attempts
-    
-Raises:
-    Exception: If all retry attempts fail
-"""
-headers = {
-    'Authorization': f'Splunk {SPLUNK_HEC_TOKEN}',
-    'Content-Type': 'application/json'
-}
-
-# Prepare payload - send events in batch
-payload = ""
-for event in events:
-    payload += json.dumps(event) + "\n"
-
-# Remove trailing newline
-payload = payload.rstrip()
-
-for attempt in range(max_retries):
-    try:
-        response = http.request(
-            'POST',
-            SPLUNK_HEC_URL,
-            body=payload.encode('utf-8'),
-            headers=headers,
-            timeout=30.0,
-            retries=False
-        )
-        
+
+    raw_size = len(body)
+
+    if HEC_GZIP and raw_size >= HEC_GZIP_MIN_BYTES:
+        with metrics.time('Compress'):
+            body = gzip.compress(body, compresslevel=HEC_GZIP_LEVEL, mtime=0)
+        headers['Content-Encoding'] = 'gzip'
+    metrics.count('BytesRaw', raw_size)
+
+    def attempt():
+        try:
+            with metrics.time('HttpPost'):
+                response = http.request(
+                    'POST',
+                    SPLUNK_HEC_URL,
+                    body=body,
+                    headers=headers,
+                    timeout=deadline.http_timeout(connect=30.0, read=30.0),
+                    retries=False
+                )
+        except urllib3.exceptions.HTTPError as e:
+            print(f"HTTP error occurred: {str(e)}")
+            raise Retryable(f"HTTP error: {str(e)}")
+
         if response.status == 200:
-            response_data = json.loads(response.data.decode('utf-8'))
-            print(f"Successfully sent {len(events)} events to Splunk")
+            response_data = json_loads(response.data)
+            metrics.count('BytesSent', len(body))
+            if LOG_RECORDS:
+                print(f"Successfully sent {event_count} events to Splunk "
+                      f"({raw_size} bytes raw, {len(body)} bytes sent)")
             return
-        else:
-            error_message = response.data.decode('utf-8')
-            print(f"Splunk HEC returned status {response.status}: {error_message}")
-            
-            # Don't retry on client errors (4xx)
-            if 400 <= response.status < 500:
-                raise Exception(f"Client error from Splunk: {response.status} - {error_message}")
-            
-            # Retry on server errors (5xx)
-            if attempt < max_retries - 1:
-                print(f"Retrying... (attempt {attempt + 2}/{max_retries})")
-                continue
-            else:
-                raise Exception(f"Failed to send to Splunk after {max_retries} attempts")
-                
-    except urllib3.exceptions.HTTPError as e:
-        print(f"HTTP error occurred: {str(e)}")
-        if attempt < max_retries - 1:
-            print(f"Retrying... (attempt {attempt + 2}/{max_retries})")
-            continue
-        else:
-            raise Exception(f"Failed to send to Splunk after {max_retries} attempts: {str(e)}")
-    
-    except Exception as e:
-        print(f"Error sending to Splunk: {str(e)}")
-        if attempt < max_retries - 1:
-            print(f"Retrying... (attempt {attempt + 2}/{max_retries})")
-            continue
-        else:
-            raise
-```
+
+        error_message = response.data.decode('utf-8', 'replace')
+        print(f"Splunk HEC returned status {response.status}: {error_message}")
+
+        # Don't retry on client errors (4xx)
+        if 400 <= response.status < 500:
+            raise Exception(f"Client error from Splunk: {response.status} - {error_message}")
+
+        # Retry on server errors (5xx)
+        raise Retryable(f"Server error from Splunk: {response.status} - {error_message}")
+
+    retry_call(attempt, max_retries, deadline, breaker, metrics)
 
 def validate_environment():
-“””
-Validate required environment variables are set
+    """
+    Validate required environment variables are set
 
-```
-Raises:
-    ValueError: If required environment variables are missing
-"""
-if not SPLUNK_HEC_URL:
-    raise ValueError("SPLUNK_HEC_URL environment variable is not set")
+    Raises:
+        ValueError: If required environment variables are missing
+    """
+    if not SPLUNK_HEC_URL:
+        raise ValueError("SPLUNK_HEC_URL environment variable is not set")
 
-if not SPLUNK_HEC_TOKEN:
-    raise ValueError("SPLUNK_HEC_TOKEN environment variable is not set")
+    if not SPLUNK_HEC_TOKEN:
+        raise ValueError("SPLUNK_HEC_TOKEN environment variable is not set")
 
-print(f"Environment validated. HEC URL: {SPLUNK_HEC_URL}")
-```
+    print(f"Environment validated. HEC URL: {SPLUNK_HEC_URL}")
 
 # Validate environment on cold start
 
@@ -1,18 +1,35 @@
+import time
+
+# Start of container init, for the cold-start report.
+_INIT_START = time.perf_counter()
+
 import base64
 import gzip
+import itertools
 import json
 import os
-import time
+import random
+import threading
 import uuid
-from typing import List, Dict, Any
+from urllib.parse import urlencode
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar
 
-import boto3
-from botocore.config import Config
 import urllib3
 
+from kinesis_common import (
+    DEDUPE_CACHE_SIZE, DROP, STREAM_DECODE_MIN_BYTES, UNPARSED, CircuitBreaker, Deadline, DedupeCache,
+    Metrics, Retryable, RuleSet, StreamDecoder, load_rules, retry_call,
+)
+from kinesis_common import json_dumps as _json_dumps, json_loads as _json_loads
+from kinesis_common import json_loads_exact as _json_loads_exact
+
+# Number of HEC POSTs in flight at once; the connection pool is sized to match.
+HEC_CONCURRENCY = max(1, int(os.environ.get("HEC_CONCURRENCY", "4")))
+
 # Reuse connections
-_http = urllib3.PoolManager(cert_reqs="CERT_REQUIRED")
-_sm   = boto3.client("secretsmanager", config=Config(retries={"max_attempts": 5, "mode": "standard"}))
+_http = urllib3.PoolManager(cert_reqs="CERT_REQUIRED", maxsize=HEC_CONCURRENCY)
+_pool = ThreadPoolExecutor(max_workers=HEC_CONCURRENCY, thread_name_prefix="hec")
 
 HEC_URL   = os.environ.get("SPLUNK_HEC_URL")  # e.g., https://http-inputs.<stack>.splunkcloud.com:8088
 VERIFY_TLS = os.environ.get("VERIFY_TLS", "true").lower() == "true"
@@ -22,111 +39,665 @@ SPLUNK_INDEX      = os.environ.get("SPLUNK_INDEX", "main")
 SPLUNK_SOURCETYPE = os.environ.get("SPLUNK_SOURCETYPE", "aws:cloudwatchlogs")
 SPLUNK_SOURCE     = os.environ.get("SPLUNK_SOURCE", "cloudwatch")
 
-TOKEN_SECRET_ARN = os.environ["SPLUNK_HEC_TOKEN_SECRET_ARN"]
-HEC_TOKEN = _sm.get_secret_value(SecretId=TOKEN_SECRET_ARN)["SecretString"]
+# Chunk limits for a single HEC POST. Keep HEC_MAX_BYTES under the HEC
+# max_content_length (1 MB by default) to avoid 413s; HEC_MAX_EVENTS=0 disables the event cap.
+HEC_MAX_BYTES  = int(os.environ.get("HEC_MAX_BYTES", "900000"))
+HEC_MAX_EVENTS = int(os.environ.get("HEC_MAX_EVENTS", "2000"))
+
+# Log groups whose messages are posted verbatim to /services/collector/raw instead
+# of being wrapped in /event envelopes. Comma-separated names; a trailing "*" matches
+# a prefix (e.g. "/ecs/orders-*"). Raw events carry no "time", so Splunk takes the
+# timestamp from the message per the sourcetype's props (or index time).
+HEC_RAW_LOG_GROUPS = [g.strip() for g in os.environ.get("HEC_RAW_LOG_GROUPS", "").split(",") if g.strip()]
+
+# Retries: full-jitter exponential backoff for 5xx and network errors, at most
+# HEC_MAX_ATTEMPTS per chunk and never past the invocation deadline. Backoff,
+# circuit breaker and deadline margin settings (HEC_BACKOFF_*, HEC_BREAKER_*,
+# DEADLINE_MARGIN_SEC) are read by kinesis_common.py.
+HEC_MAX_ATTEMPTS = max(1, int(os.environ.get("HEC_MAX_ATTEMPTS", "6")))
+
+# Chunks go out on a small pool of long-lived request channels. With HEC_ACK=true
+# (indexer acknowledgement must be enabled on the token) a chunk only counts as
+# delivered once its ackId is confirmed via /services/collector/ack; acks are polled
+# in bulk every HEC_ACK_POLL_SEC while later chunks keep sending, and anything still
+# unacknowledged HEC_ACK_TIMEOUT_SEC after the last send (or at the invocation
+# deadline) is reported as failed.
+HEC_CHANNELS        = max(1, int(os.environ.get("HEC_CHANNELS", "4")))
+HEC_ACK             = os.environ.get("HEC_ACK", "false").lower() == "true"
+HEC_ACK_POLL_SEC    = float(os.environ.get("HEC_ACK_POLL_SEC", "1.0"))
+HEC_ACK_TIMEOUT_SEC = float(os.environ.get("HEC_ACK_TIMEOUT_SEC", "30"))
+
+# Opt-in gzip request bodies (Content-Encoding: gzip). Bodies smaller than
+# HEC_GZIP_MIN_BYTES are sent as-is since the header overhead isn't worth it.
+HEC_GZIP           = os.environ.get("HEC_GZIP", "false").lower() == "true"
+HEC_GZIP_LEVEL     = int(os.environ.get("HEC_GZIP_LEVEL", "1"))
+HEC_GZIP_MIN_BYTES = int(os.environ.get("HEC_GZIP_MIN_BYTES", "1024"))
+
+# Optional per-invocation metrics: stage timings and byte counts aggregated into a
+# single CloudWatch Embedded Metric Format line (namespace METRICS_NAMESPACE).
+# METRICS_SAMPLE_RATE is the fraction of invocations that are timed and emitted;
+# the rest pay only a flag check.
+METRICS_ENABLED     = os.environ.get("METRICS_ENABLED", "false").lower() == "true"
+METRICS_SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", "1.0"))
+
+# The HEC token is fetched from Secrets Manager on first use (not at import) and
+# cached for HEC_TOKEN_TTL_SEC; SPLUNK_HEC_TOKEN skips Secrets Manager entirely and
+# is meant for local runs such as kinesis-bench.py.
+TOKEN_SECRET_ARN  = os.environ.get("SPLUNK_HEC_TOKEN_SECRET_ARN", "")
+STATIC_HEC_TOKEN  = os.environ.get("SPLUNK_HEC_TOKEN", "")
+HEC_TOKEN_TTL_SEC = float(os.environ.get("HEC_TOKEN_TTL_SEC", "3600"))
+if not TOKEN_SECRET_ARN and not STATIC_HEC_TOKEN:
+    # Fail the cold start, not every chunk after it.
+    raise RuntimeError("SPLUNK_HEC_TOKEN_SECRET_ARN (or SPLUNK_HEC_TOKEN for local runs) must be set")
+
+# Streamed decoding of large records (STREAM_DECODE_MIN_BYTES), duplicate
+# suppression (DEDUPE_CACHE_SIZE) and drop/sample/route rules (FILTER_RULES or
+# FILTER_RULES_FILE) are configured in kinesis_common.py.
+
+# Reused across warm invocations so Splunk sees a stable set of channels.
+_channels = itertools.cycle([str(uuid.uuid4()) for _ in range(HEC_CHANNELS)])
 
 if CA_BUNDLE_PATH:
     # If you supply a custom CA bundle, create a separate HTTP manager that uses it.
     _http = urllib3.PoolManager(
         cert_reqs="CERT_REQUIRED",
         ca_certs=CA_BUNDLE_PATH,
+        maxsize=HEC_CONCURRENCY,
     )
 
+# --------------------------
+# HEC token
+# --------------------------
+class _TokenCache:
+    """
+    Lazily fetched, TTL-cached HEC token. The first get() blocks on Secrets
+    Manager (importing boto3 only then); after the TTL the cached token keeps
+    being served while a background thread fetches the new one. invalidate()
+    re-fetches synchronously after HEC rejects a token (e.g. rotation).
+    """
+
+    # Wait this long before retrying a failed background refresh.
+    RETRY_SEC = 30.0
+
+    def __init__(self) -> None:
+        self._token: Optional[str] = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._client = None
+        self.fetch_ms: Optional[float] = None  # duration of the first fetch, for the cold-start report
+
+    def _fetch(self) -> str:
+        if STATIC_HEC_TOKEN:
+            return STATIC_HEC_TOKEN
+        if self._client is None:
+            import boto3
+            from botocore.config import Config
+            self._client = boto3.client("secretsmanager", config=Config(retries={"max_attempts": 5, "mode": "standard"}))
+        return self._client.get_secret_value(SecretId=TOKEN_SECRET_ARN)["SecretString"]
+
+    def _store(self, token: str) -> None:
+        self._token = token
+        self._fetched_at = time.monotonic()
+
+    def get(self) -> str:
+        token = self._token
+        if token is None:
+            with self._lock:
+                if self._token is None:
+                    start = time.perf_counter()
+                    self._store(self._fetch())
+                    self.fetch_ms = (time.perf_counter() - start) * 1000
+                return self._token
+        if time.monotonic() - self._fetched_at > HEC_TOKEN_TTL_SEC and not self._refreshing:
+            with self._lock:
+                # Re-checked under the lock so concurrent workers start one refresh between them.
+                if time.monotonic() - self._fetched_at > HEC_TOKEN_TTL_SEC and not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh, name="hec-token-refresh", daemon=True).start()
+        return token
+
+    def _refresh(self) -> None:
+        try:
+            token = self._fetch()
+        except Exception as e:
+            print(f"HEC token refresh failed, keeping cached token: {e}")
+            with self._lock:
+                self._fetched_at = time.monotonic() - HEC_TOKEN_TTL_SEC + self.RETRY_SEC
+                self._refreshing = False
+            return
+        with self._lock:
+            self._store(token)
+            self._refreshing = False
+
+    def invalidate(self, rejected: str) -> str:
+        """Re-fetches unless another thread already replaced `rejected`; returns the current token."""
+        with self._lock:
+            if self._token == rejected:
+                self._store(self._fetch())
+            return self._token
+
+_token = _TokenCache()
+
+# --------------------------
+# Retries, metrics and dedupe (kinesis_common.py)
+# --------------------------
+T = TypeVar("T")
+
+_breaker = CircuitBreaker()
+# Replaced at the start of every invocation; module-level so worker threads see it.
+_deadline = Deadline()
+# Replaced at the start of every sampled invocation; module-level so worker threads see it.
+_metrics = Metrics(False)
+_dedupe = DedupeCache(DEDUPE_CACHE_SIZE)
+
+def _retry_call(attempt: Callable[[], T]) -> T:
+    return retry_call(attempt, HEC_MAX_ATTEMPTS, _deadline, _breaker, _metrics)
+
+# --------------------------
+# Filter rules
+# --------------------------
+def _parse_message(message: str) -> Any:
+    """The message as a JSON object if it looks like one, else None."""
+    msg = message.strip()
+    if msg.startswith("{") and msg.endswith("}"):
+        try:
+            return _json_loads_exact(msg)
+        except Exception:
+            return None
+    return None
+
+# A malformed rule set fails container init rather than silently shipping everything.
+_rules = RuleSet(load_rules(), _parse_message)
+
+_GZIP_MAGIC = b"\x1f\x8b"
+# Header fields _to_splunk_lines reads before touching logEvents.
+_STREAM_HEADER_KEYS = frozenset(("messageType", "owner", "logGroup", "logStream"))
+
+
 def _decode_record(b64_gz_payload: str) -> Dict[str, Any]:
-    raw = base64.b64decode(b64_gz_payload)
-    data = gzip.decompress(raw)
-    return json.loads(data)
+    m = _metrics
+    with m.time("B64Decode"):
+        raw = base64.b64decode(b64_gz_payload)
+    m.count("BytesIn", len(raw))
+    if raw[:2] != _GZIP_MAGIC:
+        # Not compressed (e.g. a producer writing JSON straight to the stream).
+        with m.time("JsonParse"):
+            return _json_loads(raw)
+    # ISIZE, the last four bytes of a gzip member, is the inflated size mod 2**32.
+    if STREAM_DECODE_MIN_BYTES and int.from_bytes(raw[-4:], "little") >= STREAM_DECODE_MIN_BYTES:
+        m.count("StreamedRecords")
+        # Events are decoded as they are consumed, so that time lands in Serialize.
+        with m.time("JsonParse"):
+            return StreamDecoder(raw, _STREAM_HEADER_KEYS, m).parse()
+    with m.time("Gunzip"):
+        data = gzip.decompress(raw)
+    with m.time("JsonParse"):
+        record = _json_loads(data)
+    m.count("BytesDecompressed", len(data))
+    return record
+
+# Keys of the nested "event" object; parsed JSON messages that redefine one of
+# these are merged the slow way so field order and precedence stay the same.
+_ENVELOPE_KEYS = frozenset(("message", "owner", "logGroup", "logStream"))
+
+def _to_splunk_lines(record: Dict[str, Any]) -> Iterator[Tuple[Optional[str], bytes]]:
+    """
+    Yields (event id, serialized HEC event) per log event. Everything that is constant
+    for the record (source/sourcetype/index and owner/logGroup/logStream) is
+    encoded once; per event only time, message and any parsed JSON fields are
+    encoded and spliced in, which is byte-for-byte what serializing
 
-def _to_splunk_events(record: Dict[str, Any]) -> List[Dict[str, Any]]:
+        {**common, "time": t, "event": {"message": m, "owner": ..., "logGroup": ...,
+                                        "logStream": ..., **parsed_json}}
+
+    with _json_dumps would produce (tests/test_kinesis_lambda.py checks this).
+    Already-delivered duplicates and filter rules are checked first, so
+    skipped events are never parsed or encoded.
+    """
     if record.get("messageType") != "DATA_MESSAGE":
-        return []
+        return
     owner = record.get("owner")
     log_group = record.get("logGroup")
     log_stream = record.get("logStream")
+    events = record.get("logEvents", [])
+    rules = _rules.for_record(log_group or "", log_stream or "")
+    if rules is not None and rules.drops_all:
+        _metrics.count("DroppedEvents", sum(1 for _ in events))
+        return
     common = {
         "source": SPLUNK_SOURCE or log_group,
         "sourcetype": SPLUNK_SOURCETYPE,
         "index": SPLUNK_INDEX,
         # You can set "host" here if your tenancy model needs it.
     }
-    out = []
-    for e in record.get("logEvents", []):
-        evt = {
-            **common,
-            "time": e.get("timestamp", int(time.time() * 1000)) / 1000.0,
-            "event": {
-                "message": e.get("message", ""),
-                "owner": owner,
-                "logGroup": log_group,
-                "logStream": log_stream,
-            },
-        }
-        # If message looks like JSON, optionally parse and replace/augment:
-        msg = e.get("message", "").strip()
-        if msg.startswith("{") and msg.endswith("}"):
-            try:
-                j = json.loads(msg)
-                evt["event"] = {**evt["event"], **j}
-            except Exception:
-                pass
-        out.append(evt)
-    return out
+    mid = b',"event":{"message":'
+    tail = b"".join((
+        b',"owner":', _json_dumps(owner),
+        b',"logGroup":', _json_dumps(log_group),
+        b',"logStream":', _json_dumps(log_stream),
+    ))
+    # Per routing verdict (None = unchanged): the common fields and their encoded head.
+    heads = {None: (common, _json_dumps(common)[:-1] + b',"time":')}
+
+    dedupe = _dedupe if _dedupe.enabled else None
+    dropped = duplicates = 0
+    for e in events:
+        event_id = e.get("id")
+        if dedupe is not None and dedupe.seen(event_id):
+            duplicates += 1
+            continue
+        message = e.get("message", "")
+        j = UNPARSED
+        verdict = None
+        if rules is not None:
+            verdict, j = rules.evaluate(e, message)
+            if verdict is DROP:
+                dropped += 1
+                continue
+        try:
+            fields, head = heads[verdict]
+        except KeyError:
+            fields = {**common, "index": verdict[0] or SPLUNK_INDEX, "sourcetype": verdict[1] or SPLUNK_SOURCETYPE}
+            head = _json_dumps(fields)[:-1] + b',"time":'
+            heads[verdict] = (fields, head)
+        ts = e.get("timestamp", int(time.time() * 1000)) / 1000.0
+        extra = b""
+        # If message looks like JSON, optionally parse and augment:
+        if j is UNPARSED:
+            j = _parse_message(message)
+        if j and not _ENVELOPE_KEYS.isdisjoint(j):
+            evt = {
+                **fields,
+                "time": ts,
+                "event": {
+                    **{"message": message, "owner": owner, "logGroup": log_group, "logStream": log_stream},
+                    **j,
+                },
+            }
+            yield event_id, _json_dumps(evt)
+            continue
+        if j:
+            extra = b"," + _json_dumps(j)[1:-1]
+        yield event_id, b"".join((head, _json_dumps(ts), mid, _json_dumps(message), tail, extra, b"}}"))
+    if dropped:
+        _metrics.count("DroppedEvents", dropped)
+    if duplicates:
+        _metrics.count("DedupeHits", duplicates)
+
+# (source, sourcetype, index) query parameters of a /raw chunk; None means /event.
+_Route = Optional[Tuple[str, str, str]]
+
+def _raw_route(record: Dict[str, Any]) -> _Route:
+    log_group = record.get("logGroup") or ""
+    if record.get("messageType") != "DATA_MESSAGE" or not HEC_RAW_LOG_GROUPS:
+        return None
+    for pattern in HEC_RAW_LOG_GROUPS:
+        if log_group == pattern or (pattern.endswith("*") and log_group.startswith(pattern[:-1])):
+            return (SPLUNK_SOURCE or log_group, SPLUNK_SOURCETYPE, SPLUNK_INDEX)
+    return None
 
-def _post_hec(events: List[Dict[str, Any]]) -> None:
+def _to_raw_lines(record: Dict[str, Any], route: Tuple[str, str, str]) -> Iterator[Tuple[_Route, Optional[str], bytes]]:
     """
-    Sends events to Splunk HEC /services/collector/event
-    Payload: one JSON per line (newline-delimited)
-    Retries on 5xx with exponential backoff. For 4xx, raises.
+    Yields (route, event id, message bytes) with the message untouched; nothing is parsed
+    or re-encoded unless a field rule needs to look inside it. Rerouted events
+    get their own route, so they land in a separate /raw chunk.
     """
-    if not events:
+    events = record.get("logEvents", [])
+    rules = _rules.for_record(record.get("logGroup") or "", record.get("logStream") or "")
+    if rules is not None and rules.drops_all:
+        _metrics.count("DroppedEvents", sum(1 for _ in events))
         return
+    routes: Dict[Any, _Route] = {None: route}
+    dedupe = _dedupe if _dedupe.enabled else None
+    dropped = duplicates = 0
+    for e in events:
+        message = e.get("message")
+        if not message:
+            continue
+        event_id = e.get("id")
+        if dedupe is not None and dedupe.seen(event_id):
+            duplicates += 1
+            continue
+        verdict = None
+        if rules is not None:
+            verdict, _ = rules.evaluate(e, message)
+            if verdict is DROP:
+                dropped += 1
+                continue
+        r = routes.get(verdict)
+        if r is None:
+            r = routes[verdict] = (route[0], verdict[1] or route[1], verdict[0] or route[2])
+        yield r, event_id, message.encode("utf-8")
+    if dropped:
+        _metrics.count("DroppedEvents", dropped)
+    if duplicates:
+        _metrics.count("DedupeHits", duplicates)
+
+def _iter_events(records: Iterable[Dict[str, Any]], failed: Set[str]) -> Iterator[Tuple[str, _Route, Optional[str], bytes]]:
+    """
+    Decodes Kinesis records one at a time and yields (sequence_number, route,
+    event id, line), so only a single expanded record is held in memory. Records that
+    cannot be decoded are added to `failed` instead of aborting the batch;
+    lines already yielded for such a record are still sent (at-least-once).
+    """
+    for rec in records:
+        seq = rec["kinesis"]["sequenceNumber"]
+        if _deadline.expired():
+            # Out of time: hand the rest back to Lambda without decoding it.
+            _metrics.count("DeadlineSkippedRecords")
+            failed.add(seq)
+            continue
+        try:
+            decoded = _decode_record(rec["kinesis"]["data"])
+            route = _raw_route(decoded)
+            if route:
+                pairs = _to_raw_lines(decoded, route)
+                if _metrics.enabled:
+                    pairs = _metrics.timed_iter("Serialize", pairs)
+                for r, event_id, line in pairs:
+                    yield seq, r, event_id, line
+                continue
+            lines = _to_splunk_lines(decoded)
+            if _metrics.enabled:
+                # Event build and serialization are one step since the line template.
+                lines = _metrics.timed_iter("Serialize", lines)
+            for event_id, line in lines:
+                yield seq, None, event_id, line
+        except Exception as e:
+            print(f"Failed to decode record {seq}: {e}")
+            failed.add(seq)
+
+class _Chunk:
+    """
+    One HEC POST body plus its route, the Kinesis sequence numbers that fed
+    it and, with the dedupe cache on, the IDs of its events.
+    """
+
+    __slots__ = ("route", "lines", "size", "seqs", "ids")
+
+    def __init__(self, route: _Route = None) -> None:
+        self.route = route
+        self.lines: List[bytes] = []
+        self.size = 0
+        self.seqs: Set[str] = set()
+        self.ids: List[Optional[str]] = []
+
+    def add(self, seq: str, event_id: Optional[str], line: bytes) -> None:
+        self.lines.append(line)
+        self.size += len(line) + 1  # newline separator
+        self.seqs.add(seq)
+        if _dedupe.enabled:
+            self.ids.append(event_id)
 
-    body_lines = []
-    for evt in events:
-        body_lines.append(json.dumps(evt, separators=(",", ":")))
-    body = "\n".join(body_lines).encode("utf-8")
+    def fits(self, line: bytes) -> bool:
+        if not self.lines:
+            return True
+        if HEC_MAX_EVENTS and len(self.lines) >= HEC_MAX_EVENTS:
+            return False
+        return self.size + len(line) <= HEC_MAX_BYTES
 
+    def body(self) -> bytes:
+        return b"\n".join(self.lines)
+
+def _iter_chunks(lines: Iterable[Tuple[str, _Route, Optional[str], bytes]]) -> Iterator[_Chunk]:
+    """
+    Packs serialized events into one open chunk per route as they are
+    produced and yields a chunk whenever the next line would push it past
+    HEC_MAX_BYTES or HEC_MAX_EVENTS. Peak memory is bounded by the chunk size
+    (times the number of routes), not the batch. An event larger than
+    HEC_MAX_BYTES is sent on its own.
+    """
+    open_chunks: Dict[_Route, _Chunk] = {}
+    for seq, route, event_id, line in lines:
+        chunk = open_chunks.get(route)
+        if chunk is None:
+            chunk = open_chunks[route] = _Chunk(route)
+        elif not chunk.fits(line):
+            yield chunk
+            chunk = open_chunks[route] = _Chunk(route)
+        chunk.add(seq, event_id, line)
+    yield from open_chunks.values()
+
+def _post_hec(body: bytes, route: _Route, channel: str) -> Tuple[int, Optional[int]]:
+    """
+    Sends one pre-serialized chunk to Splunk HEC on the given channel.
+    route None → /services/collector/event, one JSON per line (newline-delimited)
+    route set  → /services/collector/raw, message lines with source/sourcetype/index
+                 and channel as query parameters
+    Body is gzipped if HEC_GZIP is set.
+    Retries 5xx and network errors through _retry_call; re-fetches the token
+    once on 401/403; any other 4xx raises.
+    Returns (bytes put on the wire, ackId or None when acks are off).
+    """
+    if not body:
+        return 0, None
+
+    token = _token.get()
     headers = {
-        "Authorization": f"Splunk {HEC_TOKEN}",
+        "Authorization": f"Splunk {token}",
         "Content-Type": "application/json",
         # Helps with at-least-once idempotency
-        "X-Splunk-Request-Channel": str(uuid.uuid4()),
+        "X-Splunk-Request-Channel": channel,
     }
+    url = f"{HEC_URL}/services/collector/event"
+    if route is not None:
+        source, sourcetype, index = route
+        params = {"channel": channel, "source": source, "sourcetype": sourcetype, "index": index}
+        url = f"{HEC_URL}/services/collector/raw?{urlencode(params)}"
+        headers["Content-Type"] = "text/plain"
+    if HEC_GZIP and len(body) >= HEC_GZIP_MIN_BYTES:
+        # Runs on the worker thread; zlib releases the GIL while compressing.
+        with _metrics.time("Compress"):
+            body = gzip.compress(body, compresslevel=HEC_GZIP_LEVEL, mtime=0)
+        headers["Content-Encoding"] = "gzip"
+
+    token_refreshed = False
 
-    backoff = 0.5
-    for attempt in range(6):
-        r = _http.request(
-            "POST",
-            f"{HEC_URL}/services/collector/event",
-            headers=headers,
-            body=body,
-            timeout=urllib3.Timeout(connect=5.0, read=10.0),
-            preload_content=True,
-            retries=False,  # we do our own
-        )
+    def _attempt() -> Tuple[int, Optional[int]]:
+        nonlocal token, token_refreshed
+        try:
+            with _metrics.time("HttpPost"):
+                r = _http.request(
+                    "POST",
+                    url,
+                    headers=headers,
+                    body=body,
+                    timeout=_deadline.http_timeout(connect=5.0, read=10.0),
+                    preload_content=True,
+                    retries=False,  # we do our own
+                )
+        except urllib3.exceptions.HTTPError as e:
+            raise Retryable(f"HEC request failed: {e}") from e
         status = r.status
         data = r.data[:512]
         if status in (200, 201):
-            return
+            ack_id = _json_loads(r.data).get("ackId") if HEC_ACK else None
+            if HEC_ACK and ack_id is None:
+                print("HEC_ACK is set but HEC returned no ackId; is indexer acknowledgement enabled on the token?")
+            return len(body), ack_id
         if 500 <= status < 600:
-            time.sleep(backoff)
-            backoff = min(backoff * 2.0, 8.0)
-            continue
+            raise Retryable(f"HEC {status}: {data!r}")
+        if status in (401, 403) and not token_refreshed:
+            # Token may have been rotated since it was cached; re-fetch once.
+            token_refreshed = True
+            token = _token.invalidate(token)
+            headers["Authorization"] = f"Splunk {token}"
+            raise Retryable(f"HEC {status}: {data!r}", immediate=True)
         # 4xx is caller error; raise with small payload for CWL
         raise RuntimeError(f"HEC {status}: {data!r}")
-    raise RuntimeError("HEC retries exhausted")
+
+    return _retry_call(_attempt)
+
+class _AckTracker:
+    """
+    Chunks awaiting indexer acknowledgement, grouped by channel so each poll
+    is a single /services/collector/ack request per channel covering all of
+    its outstanding ack IDs. Only (event count, sequence numbers, event IDs)
+    is kept per chunk; the body is released once it has been sent.
+    """
+
+    def __init__(self) -> None:
+        self.pending: Dict[str, Dict[int, Tuple[int, Set[str], List[Optional[str]]]]] = {}
+        self.last_poll = time.monotonic()
+
+    def __len__(self) -> int:
+        return sum(len(acks) for acks in self.pending.values())
+
+    def add(self, channel: str, ack_id: int, chunk: _Chunk) -> None:
+        self.pending.setdefault(channel, {})[ack_id] = (len(chunk.lines), chunk.seqs, chunk.ids)
+
+    def poll(self) -> List[Tuple[int, Set[str], List[Optional[str]]]]:
+        """Returns the chunks confirmed since the last poll. Poll errors are retried on the next poll."""
+        self.last_poll = time.monotonic()
+        _metrics.count("AckPolls")
+        done = []
+        for channel, acks in list(self.pending.items()):
+            try:
+                with _metrics.time("AckPoll"):
+                    r = _http.request(
+                        "POST",
+                        f"{HEC_URL}/services/collector/ack?{urlencode({'channel': channel})}",
+                        headers={
+                            "Authorization": f"Splunk {_token.get()}",
+                            "Content-Type": "application/json",
+                            "X-Splunk-Request-Channel": channel,
+                        },
+                        body=_json_dumps({"acks": list(acks)}),
+                        timeout=_deadline.http_timeout(connect=5.0, read=10.0),
+                        retries=False,
+                    )
+                if r.status != 200:
+                    print(f"HEC ack poll on {channel} returned {r.status}: {r.data[:512]!r}")
+                    continue
+                status = _json_loads(r.data).get("acks", {})
+            except Exception as e:
+                print(f"HEC ack poll on {channel} failed: {e}")
+                continue
+            for ack_id, ok in status.items():
+                if ok and int(ack_id) in acks:
+                    done.append(acks.pop(int(ack_id)))
+            if not acks:
+                del self.pending[channel]
+        return done
+
+    def drain(self) -> List[Tuple[int, Set[str], List[Optional[str]]]]:
+        """Removes and returns everything still unacknowledged."""
+        left = [entry for acks in self.pending.values() for entry in acks.values()]
+        self.pending.clear()
+        return left
+
+def _send_chunks(chunks: Iterable[_Chunk], failed: Set[str], stats: Dict[str, int]) -> None:
+    """
+    Posts chunks from the shared worker pool with at most HEC_CONCURRENCY in
+    flight. Serialization of the next chunk overlaps with the POSTs already
+    running, and a slow or throttled chunk only holds up its own worker.
+    With HEC_ACK, acks are polled between submissions and drained at the end.
+    Sequence numbers of every failed or unacknowledged chunk are added to
+    `failed`; delivered event and byte counts are accumulated in `stats`.
+    """
+    inflight: Dict[Future, Tuple[_Chunk, str]] = {}
+    acks = _AckTracker()
+
+    def _acked(confirmed: List[Tuple[int, Set[str], List[Optional[str]]]]) -> None:
+        for count, _, ids in confirmed:
+            stats["events"] += count
+            _dedupe.add(ids)
+
+    def _reap(done) -> None:
+        for fut in done:
+            chunk, channel = inflight.pop(fut)
+            exc = fut.exception()
+            if exc is not None:
+                print(f"HEC chunk of {len(chunk.lines)} events failed: {exc}")
+                failed.update(chunk.seqs)
+                _metrics.count("FailedChunks")
+                continue
+            _metrics.count("Chunks")
+            sent, ack_id = fut.result()
+            stats["bytes_raw"] += chunk.size - 1
+            stats["bytes_sent"] += sent
+            if ack_id is None:
+                stats["events"] += len(chunk.lines)
+                _dedupe.add(chunk.ids)
+            else:
+                acks.add(channel, ack_id, chunk)
+
+    for chunk in chunks:
+        if len(inflight) >= HEC_CONCURRENCY:
+            # Time spent here means the network, not the CPU, is the bottleneck.
+            with _metrics.time("PoolWait"):
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            _reap(done)
+        if acks and time.monotonic() - acks.last_poll >= HEC_ACK_POLL_SEC:
+            _acked(acks.poll())
+        if _deadline.expired():
+            # Records past the deadline are skipped upstream; this catches chunks already packed.
+            _metrics.count("DeadlineSkippedChunks")
+            failed.update(chunk.seqs)
+            continue
+        channel = next(_channels)
+        inflight[_pool.submit(_post_hec, chunk.body(), chunk.route, channel)] = (chunk, channel)
+    with _metrics.time("PoolWait"):
+        done = wait(inflight).done
+    _reap(done)
+
+    ack_deadline = min(time.monotonic() + HEC_ACK_TIMEOUT_SEC, _deadline.at)
+    while acks and time.monotonic() < ack_deadline:
+        with _metrics.time("AckWait"):
+            time.sleep(max(0.0, acks.last_poll + HEC_ACK_POLL_SEC - time.monotonic()))
+        _acked(acks.poll())
+    for count, seqs, _ in acks.drain():
+        print(f"HEC chunk of {count} events was not acknowledged in time")
+        failed.update(seqs)
+
+_cold_start = True
 
 def handler(event, context):
-    # event["Records"] → list of Kinesis records
-    batch: List[Dict[str, Any]] = []
-    for rec in event.get("Records", []):
-        payload = rec["kinesis"]["data"]
-        decoded = _decode_record(payload)
-        batch.extend(_to_splunk_events(decoded))
-
-    # Split large batches to avoid 413s. ~1-2k events per POST is safe; tune as needed.
-    MAX = 2000
-    for i in range(0, len(batch), MAX):
-        _post_hec(batch[i : i + MAX])
-
-    return {"ok": True, "events": len(batch)}
\ No newline at end of file
+    global _metrics, _cold_start, _deadline
+    _metrics = Metrics(METRICS_ENABLED and random.random() < METRICS_SAMPLE_RATE)
+    _deadline = Deadline(context)
+    invocation_start = time.perf_counter()
+
+    # event["Records"] → list of Kinesis records; events stream straight into
+    # byte-bounded chunks instead of being collected up front.
+    records = event.get("Records", [])
+    failed: Set[str] = set()
+    # bytes_raw is the uncompressed body size, bytes_sent what went over the wire (gzip or not)
+    stats = {"events": 0, "bytes_raw": 0, "bytes_sent": 0}
+    with _metrics.time("Total"):
+        _send_chunks(_iter_chunks(_iter_events(records, failed)), failed, stats)
+
+    # Partial batch response (requires ReportBatchItemFailures on the event
+    # source mapping): only records that fed a failed chunk are retried.
+    failures = [
+        {"itemIdentifier": rec["kinesis"]["sequenceNumber"]}
+        for rec in records
+        if rec["kinesis"]["sequenceNumber"] in failed
+    ]
+
+    _metrics.count("Records", len(records))
+    _metrics.count("FailedRecords", len(failures))
+    _metrics.count("Events", stats["events"])
+    _metrics.count("BytesRaw", stats["bytes_raw"])
+    _metrics.count("BytesSent", stats["bytes_sent"])
+    if _dedupe.enabled:
+        _metrics.count("DedupeEntries", len(_dedupe))
+        _metrics.count("DedupeCacheBytes", _dedupe.memory_bytes())
+    if _cold_start:
+        _cold_start = False
+        report = {
+            "coldStart": True,
+            "initMs": round(_INIT_MS, 1),
+            "tokenFetchMs": round(_token.fetch_ms, 1) if _token.fetch_ms is not None else None,
+            "firstInvocationMs": round((time.perf_counter() - invocation_start) * 1000, 1),
+        }
+        print(json.dumps(report))
+        _metrics.add_time("Init", _INIT_MS / 1000.0)
+        if _token.fetch_ms is not None:
+            _metrics.add_time("TokenFetch", _token.fetch_ms / 1000.0)
+    _metrics.emit(context)
+    return {"batchItemFailures": failures, **stats}
+
+# Module import (container init) time, reported on the first invocation.
+_INIT_MS = (time.perf_counter() - _INIT_START) * 1000
\ No newline at end of file
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Replay archived Kinesis records into Splunk HEC through kinesis-lambda.py's
+own decode/transform and sender code, e.g. to backfill after an HEC outage.
+
+Input files hold one JSON document per line, plain or gzipped (detected by
+magic bytes). A line may be a Lambda Kinesis record ({"kinesis": {"data": ...}}),
+a Kinesis API record ({"Data": ..., "SequenceNumber": ...}) or a whole Lambda
+event ({"Records": [...]}, which is what `kinesis-bench.py gen` writes).
+
+Records are grouped into batches of --batch-records. Batches are decoded,
+filtered and serialized in a process pool (several batches ahead of the
+sender), then posted in order by the Lambda's _send_chunks() with
+--connections POSTs in flight and an optional events/bytes per second cap.
+After each batch a checkpoint is written, so an interrupted run resumes
+after the last completed batch; records that still fail after
+--batch-retries go to --failed-out, which is itself valid replay input.
+
+HEC settings (SPLUNK_HEC_URL, SPLUNK_HEC_TOKEN or SPLUNK_HEC_TOKEN_SECRET_ARN,
+SPLUNK_INDEX, FILTER_RULES, HEC_GZIP, HEC_ACK, ...) come from the environment
+exactly as for the Lambda; --hec-url and --token override the first two.
+
+Examples:
+  python3 kinesis-replay.py --hec-url https://http-inputs.example:8088 --token $TOKEN archive/*.jsonl.gz
+  python3 kinesis-replay.py --stand-in --workers 4 --connections 8 --max-events-per-sec 50000 dump.jsonl
+"""
+
+import argparse
+import collections
+import gzip
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def _load(path, name):
+    spec = importlib.util.spec_from_file_location(name, path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+# --------------------------
+# Input
+# --------------------------
+def _open_text(path):
+    f = open(path, "rb")
+    magic = f.read(2)
+    f.seek(0)
+    if magic == b"\x1f\x8b":
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=f), encoding="utf-8")
+    return io.TextIOWrapper(f, encoding="utf-8")
+
+def _records_in(doc):
+    """Normalizes one input document to a list of {"kinesis": {"data", "sequenceNumber"}} records."""
+    if not isinstance(doc, dict):
+        raise ValueError(f"expected a JSON object, got {type(doc).__name__}")
+    if "Records" in doc:
+        return [r for r in doc["Records"] if isinstance(r, dict) and "kinesis" in r]
+    if "kinesis" in doc:
+        return [doc]
+    if "Data" in doc:
+        return [{"kinesis": {"data": doc["Data"], "sequenceNumber": str(doc.get("SequenceNumber", ""))}}]
+    raise ValueError("not a Kinesis record or Lambda event")
+
+class _Batch:
+    """Consecutive records of one file; `line` is the last input line it covers."""
+
+    __slots__ = ("path", "line", "last", "records")
+
+    def __init__(self, path):
+        self.path = path
+        self.line = 0
+        self.last = False
+        self.records = {}  # synthetic sequence number -> original record
+
+def _iter_batches(paths, checkpoint, batch_records):
+    """
+    Yields _Batch objects in file order, skipping whatever the checkpoint
+    says is done. Sequence numbers are replaced by "<line>:<index>" so they
+    stay unique across shards and files.
+    """
+    for path in paths:
+        state = checkpoint["files"].get(path, {})
+        if state.get("done"):
+            continue
+        skip = state.get("line", 0)
+        batch = _Batch(path)
+        with _open_text(path) as f:
+            for line_no, text in enumerate(f, 1):
+                if line_no <= skip or not text.strip():
+                    batch.line = max(batch.line, line_no)
+                    continue
+                try:
+                    records = _records_in(json.loads(text))
+                except ValueError as e:
+                    print(f"{path}:{line_no}: skipped ({e})", file=sys.stderr)
+                    records = []
+                for i, rec in enumerate(records):
+                    batch.records[f"{line_no}:{i}"] = rec
+                batch.line = line_no
+                if len(batch.records) >= batch_records:
+                    yield batch
+                    batch = _Batch(path)
+                    batch.line = line_no
+        batch.last = True
+        yield batch
+
+# --------------------------
+# Decode/transform workers
+# --------------------------
+_worker_lambda = None
+
+def _init_worker(lambda_path):
+    global _worker_lambda
+    # Ctrl-C reaches the whole process group; only the parent should act on it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_lambda = _load(lambda_path, "replay_lambda")
+
+def _transform(pairs):
+    """Runs in a worker: (seq, data) pairs -> ([(seq, route, event_id, line)], failed seqs)."""
+    records = [{"kinesis": {"sequenceNumber": seq, "data": data}} for seq, data in pairs]
+    failed = set()
+    lines = list(_worker_lambda._iter_events(records, failed))
+    return lines, sorted(failed)
+
+# --------------------------
+# Sending
+# --------------------------
+class _RateLimiter:
+    """Token buckets on events/sec and bytes/sec (0 = unlimited), one second of burst."""
+
+    def __init__(self, events_per_sec, bytes_per_sec):
+        self.rates = (events_per_sec, bytes_per_sec)
+        self.tokens = [float(events_per_sec), float(bytes_per_sec)]
+        self.at = time.monotonic()
+
+    def acquire(self, events, nbytes):
+        while True:
+            now = time.monotonic()
+            elapsed, self.at = now - self.at, now
+            wait = 0.0
+            for i, (rate, need) in enumerate(zip(self.rates, (events, nbytes))):
+                if not rate:
+                    continue
+                self.tokens[i] = min(float(rate), self.tokens[i] + elapsed * rate)
+                # A chunk bigger than one second's budget may go once the bucket is full.
+                need = min(need, rate)
+                if self.tokens[i] < need:
+                    wait = max(wait, (need - self.tokens[i]) / rate)
+            if wait <= 0:
+                for i, (rate, need) in enumerate(zip(self.rates, (events, nbytes))):
+                    if rate:
+                        self.tokens[i] -= need
+                return
+            time.sleep(wait)
+
+    def throttle(self, chunks):
+        for chunk in chunks:
+            self.acquire(len(chunk.lines), chunk.size)
+            yield chunk
+
+class _AttemptContext:
+    """The part of a Lambda context Deadline reads, so each send attempt gets a finite deadline."""
+
+    def __init__(self, timeout_sec):
+        self.at = time.monotonic() + timeout_sec
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.at - time.monotonic()) * 1000))
+
+def _send(mod, lines, limiter, retries, timeout_sec):
+    """
+    Posts lines, resending records whose chunks failed up to `retries` times.
+    Each attempt runs against a deadline timeout_sec away, as an invocation
+    would; chunks still unsent then count as failed. Returns (stats, failed seqs).
+    """
+    totals = {"events": 0, "bytes_raw": 0, "bytes_sent": 0}
+    failed = set()
+    for attempt in range(retries + 1):
+        if attempt:
+            # Give HEC (and the module's circuit breaker) time to recover.
+            time.sleep(min(60.0, 5.0 * 2 ** (attempt - 1)))
+            lines = [entry for entry in lines if entry[0] in failed]
+            print(f"  retrying {len(failed)} records ({len(lines)} events), attempt {attempt + 1}/{retries + 1}")
+        failed = set()
+        stats = {"events": 0, "bytes_raw": 0, "bytes_sent": 0}
+        mod._deadline = mod.Deadline(_AttemptContext(timeout_sec))
+        mod._send_chunks(limiter.throttle(mod._iter_chunks(lines)), failed, stats)
+        for k, v in stats.items():
+            totals[k] += v
+        if not failed:
+            break
+    return totals, failed
+
+# --------------------------
+# Checkpoint
+# --------------------------
+def _read_checkpoint(path, restart):
+    if restart or not os.path.exists(path):
+        return {"files": {}, "events": 0, "failed_records": 0}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def _write_checkpoint(path, checkpoint):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+# --------------------------
+# Main
+# --------------------------
+def _replay(args):
+    paths = [os.path.abspath(p) for p in args.files]
+    if args.stand_in:
+        bench = _load(os.path.join(HERE, "kinesis-bench.py"), "kinesis_bench")
+        srv = bench.start_server(latency_ms=args.stand_in_latency_ms, error_rate=args.stand_in_error_rate)
+        args.hec_url = srv.url
+        os.environ.setdefault("SPLUNK_HEC_TOKEN", "00000000-0000-0000-0000-000000000000")
+        print(f"HEC stand-in at {srv.url}")
+    if args.hec_url:
+        os.environ["SPLUNK_HEC_URL"] = args.hec_url
+    if args.token:
+        os.environ["SPLUNK_HEC_TOKEN"] = args.token
+    if not os.environ.get("SPLUNK_HEC_URL"):
+        raise SystemExit("SPLUNK_HEC_URL (or --hec-url / --stand-in) is required")
+    os.environ["HEC_CONCURRENCY"] = str(args.connections)
+    # The checkpoint is what makes replays safe to repeat; the Lambda's dedupe cache is per process.
+    os.environ["DEDUPE_CACHE_SIZE"] = "0"
+
+    lambda_path = os.path.abspath(args.lambda_file)
+    pool = multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(lambda_path,))
+    mod = _load(lambda_path, "replay_lambda")
+    limiter = _RateLimiter(args.max_events_per_sec, args.max_bytes_per_sec)
+    checkpoint = _read_checkpoint(args.checkpoint, args.restart)
+    failed_out = open(args.failed_out, "a", encoding="utf-8")
+
+    start = time.monotonic()
+    run = {"events": 0, "bytes_sent": 0, "records": 0, "failed": 0}
+    last_report = start
+
+    def finish(batch, result):
+        nonlocal last_report
+        lines, decode_failed = result.get()
+        stats, send_failed = _send(mod, lines, limiter, args.batch_retries, args.batch_timeout) if lines else ({"events": 0, "bytes_sent": 0}, set())
+        failed = set(decode_failed) | send_failed
+        for seq in sorted(failed):
+            rec = batch.records[seq]
+            failed_out.write(json.dumps({"source": f"{batch.path}:{seq}", **rec}) + "\n")
+        failed_out.flush()
+
+        state = checkpoint["files"].setdefault(batch.path, {})
+        state["line"] = batch.line
+        state["done"] = batch.last
+        checkpoint["events"] += stats["events"]
+        checkpoint["failed_records"] += len(failed)
+        _write_checkpoint(args.checkpoint, checkpoint)
+
+        run["events"] += stats["events"]
+        run["bytes_sent"] += stats["bytes_sent"]
+        run["records"] += len(batch.records)
+        run["failed"] += len(failed)
+        now = time.monotonic()
+        if now - last_report >= args.progress_sec or batch.last:
+            last_report = now
+            elapsed = now - start
+            print(f"{os.path.basename(batch.path)}:{batch.line}  records {run['records']}  "
+                  f"events {run['events']} ({run['events'] / elapsed:.0f}/s, "
+                  f"{run['bytes_sent'] / elapsed / 1e6:.1f} MB/s sent)  failed records {run['failed']}")
+
+    window = collections.deque()
+    try:
+        for batch in _iter_batches(paths, checkpoint, args.batch_records):
+            pairs = [(seq, rec["kinesis"]["data"]) for seq, rec in batch.records.items()]
+            window.append((batch, pool.apply_async(_transform, (pairs,))))
+            # Keep the workers a few batches ahead of the sender, but no further.
+            if len(window) > args.workers * 2:
+                finish(*window.popleft())
+        while window:
+            finish(*window.popleft())
+    except KeyboardInterrupt:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        print(f"\nInterrupted; rerun the same command to resume from {args.checkpoint}")
+        pool.terminate()
+        raise SystemExit(130)
+    finally:
+        failed_out.close()
+        pool.close()
+
+    elapsed = time.monotonic() - start
+    print(f"Done: {run['records']} records, {run['events']} events in {elapsed:.1f}s "
+          f"({run['events'] / elapsed if elapsed else 0:.0f} events/s), {run['failed']} failed records"
+          + (f" written to {args.failed_out}" if run["failed"] else ""))
+    if args.stand_in:
+        print(f"HEC stand-in: {srv.stats}")
+    return 1 if run["failed"] else 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+", help="JSONL or gzipped JSONL files of Kinesis records")
+    parser.add_argument("--hec-url", help="overrides SPLUNK_HEC_URL, e.g. https://host:8088")
+    parser.add_argument("--token", help="overrides SPLUNK_HEC_TOKEN")
+    parser.add_argument("--stand-in", action="store_true", help="send to kinesis-bench.py's local HEC stand-in")
+    parser.add_argument("--stand-in-latency-ms", type=float, default=5.0)
+    parser.add_argument("--stand-in-error-rate", type=float, default=0.0, help="fraction of stand-in POSTs answered with 503")
+    parser.add_argument("--lambda", dest="lambda_file", default=os.path.join(HERE, "kinesis-lambda.py"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="decode/transform processes")
+    parser.add_argument("--connections", type=int, default=8, help="HEC POSTs in flight")
+    parser.add_argument("--batch-records", type=int, default=500, help="records per batch/checkpoint")
+    parser.add_argument("--batch-retries", type=int, default=3, help="resends of a batch's failed records")
+    parser.add_argument("--batch-timeout", type=float, default=900.0,
+                        help="seconds each send attempt of a batch may take, like the Lambda timeout")
+    parser.add_argument("--max-events-per-sec", type=float, default=0, help="0 = unlimited")
+    parser.add_argument("--max-bytes-per-sec", type=float, default=0, help="uncompressed body bytes, 0 = unlimited")
+    parser.add_argument("--checkpoint", default="kinesis-replay.checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--failed-out", default="kinesis-replay.failed.jsonl")
+    parser.add_argument("--progress-sec", type=float, default=10.0)
+    args = parser.parse_args()
+    sys.exit(_replay(args))
+
+if __name__ == "__main__":
+    main()
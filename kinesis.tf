@@ -234,6 +234,7 @@ resource "aws_security_group" "lambda_sg" {
 # --------------------------
 # Package Lambda from local file
 # --------------------------
+# lambda/ holds kinesis-lambda.py as app.py plus kinesis_common.py, which it imports.
 data "archive_file" "lambda_zip" {
   type        = "zip"
   source_dir  = "${path.module}/lambda"
@@ -281,5 +282,6 @@ resource "aws_lambda_event_source_mapping" "kinesis_trigger" {
   parallelization_factor             = var.lambda_parallelization_factor
   maximum_retry_attempts             = var.lambda_max_retry
   bisect_batch_on_function_error     = true
+  function_response_types            = ["ReportBatchItemFailures"]
   tumbling_window_in_seconds         = 0
 }
\ No newline at end of file
@@ -0,0 +1,753 @@
+"""
+Pieces shared by the Kinesis -> Splunk HEC Lambdas (kinesis-lambda.py and
+kinesis-claude-lambda.py): the JSON codec, EMF metrics, the invocation
+deadline, HEC retries and circuit breaker, the dedupe LRU, the filter rule
+engine and the streaming CloudWatch Logs decoder.
+
+Ship this file next to the handler in the deployment package; both handlers
+import it as a top-level module.
+"""
+
+import codecs
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+import urllib3
+
+# Retries: full-jitter exponential backoff (BASE * 2^attempt, capped at MAX) for 5xx
+# and network errors, never sleeping past the invocation deadline. New work stops
+# DEADLINE_MARGIN_SEC before the Lambda timeout so undelivered records can still be
+# returned as batchItemFailures. After HEC_BREAKER_THRESHOLD consecutive failed
+# attempts (0 disables) the breaker fails chunks fast for HEC_BREAKER_COOLDOWN_SEC,
+# then lets one probe through; its state survives across warm invocations.
+HEC_BACKOFF_BASE_SEC     = float(os.environ.get("HEC_BACKOFF_BASE_SEC", "0.5"))
+HEC_BACKOFF_MAX_SEC      = float(os.environ.get("HEC_BACKOFF_MAX_SEC", "8"))
+HEC_BREAKER_THRESHOLD    = int(os.environ.get("HEC_BREAKER_THRESHOLD", "5"))
+HEC_BREAKER_COOLDOWN_SEC = float(os.environ.get("HEC_BREAKER_COOLDOWN_SEC", "10"))
+DEADLINE_MARGIN_SEC      = float(os.environ.get("DEADLINE_MARGIN_SEC", "3"))
+
+# CloudWatch namespace of the Embedded Metric Format line (see Metrics).
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "KinesisToSplunk")
+
+# Records whose gzip trailer says they inflate to at least STREAM_DECODE_MIN_BYTES
+# are decompressed and parsed incrementally, one log event at a time, so memory
+# stays near the compressed size instead of several copies of the expanded
+# payload. Smaller records keep the faster whole-payload decode; 0 disables streaming.
+STREAM_DECODE_MIN_BYTES = int(os.environ.get("STREAM_DECODE_MIN_BYTES", str(4 * 1024 * 1024)))
+
+# Optional duplicate suppression across warm invocations. IDs of log events HEC
+# accepted (with HEC_ACK: acknowledged) go into an LRU of DEDUPE_CACHE_SIZE entries
+# (0 disables; roughly 250 bytes each), and events found there are skipped before
+# filtering or serialization, so a replayed or bisected batch only resends what
+# did not get through the first time.
+DEDUPE_CACHE_SIZE = int(os.environ.get("DEDUPE_CACHE_SIZE", "0"))
+
+# Drop/sample/route rules, loaded once per container from FILTER_RULES (a JSON array)
+# or, when that is unset, from FILTER_RULES_FILE if it exists (relative paths resolve
+# next to this file, so the file can ship in the deployment package). See Rule.
+FILTER_RULES      = os.environ.get("FILTER_RULES", "").strip()
+FILTER_RULES_FILE = os.environ.get("FILTER_RULES_FILE", "filter_rules.json")
+
+# --------------------------
+# JSON codec
+# --------------------------
+# orjson when installed, then ujson, then stdlib; JSON_CODEC=orjson|ujson|json
+# pins one. Every backend emits compact UTF-8 (non-ASCII is not \u-escaped) with
+# shortest round-trip floats, though not always spelled alike (orjson writes
+# 2.5e-7 where stdlib writes 2.5e-07). Objects a fast backend refuses (lone
+# surrogates, ints wider than 64 bits, non-str keys) fall back to stdlib, still
+# UTF-8 with only the lone surrogates \u-escaped, so a piece that falls back
+# encodes the same as it would inside a whole object that falls back. Log
+# messages are decoded with json_loads_exact; see exact_loads.
+JSON_CODEC = os.environ.get("JSON_CODEC", "auto").lower()
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def load_codec(name: str) -> Tuple[str, Callable[[Any], Any], Callable[[Any], bytes]]:
+    """(backend name, loads, dumps) for JSON_CODEC `name`; dumps returns UTF-8 bytes."""
+    if name in ("auto", "orjson"):
+        try:
+            import orjson
+            return "orjson", orjson.loads, orjson.dumps
+        except ImportError:
+            if name == "orjson":
+                raise
+    if name in ("auto", "ujson"):
+        try:
+            import ujson
+
+            def _ujson_dumps(obj: Any) -> bytes:
+                return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+
+            return "ujson", ujson.loads, _ujson_dumps
+        except ImportError:
+            if name == "ujson":
+                raise
+    return "json", json.loads, _stdlib_dumps
+
+JSON_BACKEND, json_loads, _fast_dumps = load_codec(JSON_CODEC)
+
+# Lone surrogates (str built from "\ud800"-style escapes) have no UTF-8 encoding.
+_SURROGATE = re.compile("[\ud800-\udfff]")
+
+def _escape_surrogate(m: "re.Match[str]") -> str:
+    return f"\\u{ord(m.group()):04x}"
+
+def json_dumps(obj: Any) -> bytes:
+    try:
+        return _fast_dumps(obj)
+    except (TypeError, ValueError, OverflowError):
+        text = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+        return _SURROGATE.sub(_escape_surrogate, text).encode("utf-8")
+
+# Digits map to "0" and everything else to " ", so finding a run of 19 or more
+# digits (an integer that may not fit in 64 bits) is one substring search.
+_DIGIT_RUNS = bytes(0x30 if 0x30 <= b <= 0x39 else 0x20 for b in range(256))
+_WIDE_INT = b"0" * 19
+
+def exact_loads(loads: Callable[[Any], Any]) -> Callable[[str], Any]:
+    """
+    Wraps a backend's loads so log message text decodes to what stdlib
+    json.loads returns. orjson reads integers wider than 64 bits as floats and
+    rejects NaN, Infinity and out-of-range floats: text that may hold a wide
+    integer goes straight to stdlib, and JSON the fast backend refuses is
+    retried with it. Record envelopes and HEC replies hold neither, so they
+    keep the plain backend.
+    """
+    if loads is json.loads:
+        return loads
+
+    def _loads(text: str) -> Any:
+        if _WIDE_INT in text.encode("utf-8", "surrogatepass").translate(_DIGIT_RUNS):
+            return json.loads(text)
+        try:
+            return loads(text)
+        except ValueError:
+            if text.lstrip()[:1] not in ("{", "["):
+                raise
+            return json.loads(text)
+
+    return _loads
+
+json_loads_exact = exact_loads(json_loads)
+
+# --------------------------
+# Metrics
+# --------------------------
+class Metrics:
+    """
+    Stage timings (seconds) and counters for one invocation, emitted as one
+    EMF line. Worker threads add to the same instance, so updates take a lock
+    and HttpPost/Compress/RetrySleep are summed across threads. When disabled
+    every method is a no-op.
+    """
+
+    def __init__(self, enabled: bool) -> None:
+        self.enabled = enabled
+        self.timings: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        if self.enabled:
+            with self._lock:
+                self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1) -> None:
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed_iter(self, stage: str, it: Iterable[Any]) -> Iterator[Any]:
+        """Charges only the time spent producing each item, not the consumer's."""
+        it = iter(it)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def emit(self, context: Any) -> None:
+        if not self.enabled:
+            return
+        values: Dict[str, Any] = {f"{k}Ms": round(v * 1000.0, 3) for k, v in self.timings.items()}
+        values.update(self.counters)
+        units = [
+            {"Name": k, "Unit": "Milliseconds" if k.endswith("Ms") else ("Bytes" if "Bytes" in k else "Count")}
+            for k in values
+        ]
+        function_name = getattr(context, "function_name", None) or os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "unknown")
+        print(json.dumps({
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["FunctionName"]],
+                    "Metrics": units,
+                }],
+            },
+            "FunctionName": function_name,
+            **values,
+        }, separators=(",", ":")))
+
+# --------------------------
+# Retry scheduling
+# --------------------------
+T = TypeVar("T")
+
+class Retryable(Exception):
+    """An attempt that may succeed if repeated. immediate=True means HEC answered; retry at once, without backoff."""
+
+    def __init__(self, message: str, immediate: bool = False) -> None:
+        super().__init__(message)
+        self.immediate = immediate
+
+class Deadline:
+    """The invocation's Lambda timeout minus DEADLINE_MARGIN_SEC (unbounded without a context)."""
+
+    def __init__(self, context: Any = None) -> None:
+        remaining_ms = getattr(context, "get_remaining_time_in_millis", None)
+        self.at = float("inf")
+        if remaining_ms is not None:
+            self.at = time.monotonic() + remaining_ms() / 1000.0 - DEADLINE_MARGIN_SEC
+
+    def remaining(self) -> float:
+        return self.at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def http_timeout(self, connect: float, read: float) -> urllib3.Timeout:
+        left = max(self.remaining(), 0.5)
+        return urllib3.Timeout(connect=min(connect, left), read=min(read, left))
+
+class CircuitBreaker:
+    """
+    Shared by all chunks in a warm container. Opens after HEC_BREAKER_THRESHOLD
+    consecutive failed attempts, rejects calls for HEC_BREAKER_COOLDOWN_SEC,
+    then admits a single probe (half-open) whose outcome closes or re-opens it.
+    Callers arriving while the probe is in flight wait for its outcome; a
+    probe that ends without one is released so the next caller can probe.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self._prober: Optional[int] = None  # thread running the half-open probe
+
+    def allow(self, wait: float) -> bool:
+        with self._cond:
+            if self.probing:
+                # Without a Lambda deadline `wait` is inf, which Condition.wait rejects;
+                # the probe's own HTTP timeouts bound an untimed wait.
+                timeout = None if wait == float("inf") else max(wait, 0.0)
+                self._cond.wait_for(lambda: not self.probing, timeout=timeout)
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < HEC_BREAKER_COOLDOWN_SEC:
+                return False
+            self.probing = True
+            self._prober = threading.get_ident()
+            return True
+
+    def release(self) -> None:
+        """Ends the calling thread's probe, if it holds one, leaving the breaker open."""
+        with self._cond:
+            if self.probing and self._prober == threading.get_ident():
+                self.probing = False
+                self._cond.notify_all()
+
+    def success(self) -> None:
+        with self._cond:
+            if self.opened_at is not None:
+                print("HEC circuit breaker closed")
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            self._cond.notify_all()
+
+    def failure(self) -> None:
+        with self._cond:
+            self.failures += 1
+            if HEC_BREAKER_THRESHOLD and (self.probing or self.failures >= HEC_BREAKER_THRESHOLD):
+                if self.opened_at is None:
+                    print(f"HEC circuit breaker opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+                self.probing = False
+                self._cond.notify_all()
+
+def retry_call(attempt: Callable[[], T], max_attempts: int, deadline: Deadline,
+               breaker: CircuitBreaker, metrics: Metrics) -> T:
+    """
+    Runs `attempt` until it succeeds or raises a non-retryable error, giving
+    up after max_attempts, when the breaker is open, or when the next
+    backoff would run past the invocation deadline.
+    """
+    last: Optional[Exception] = None
+    gate = True
+    try:
+        for n in range(max_attempts):
+            cause = f", last error: {last}" if last else ""
+            if deadline.expired():
+                raise TimeoutError(f"invocation deadline reached{cause}")
+            if gate and not breaker.allow(wait=deadline.remaining()):
+                metrics.count("BreakerRejected")
+                raise RuntimeError(f"HEC circuit breaker open{cause}")
+            try:
+                result = attempt()
+            except Retryable as e:
+                last = e
+                gate = not e.immediate
+                if e.immediate:
+                    # HEC answered (e.g. 401 before a token refresh), which settles a probe.
+                    breaker.success()
+                    continue
+                breaker.failure()
+                if n == max_attempts - 1:
+                    break
+                delay = random.uniform(0.0, min(HEC_BACKOFF_MAX_SEC, HEC_BACKOFF_BASE_SEC * (2 ** n)))
+                if delay >= deadline.remaining():
+                    raise TimeoutError(f"no time left before the invocation deadline to retry: {e}")
+                metrics.count("Retries")
+                with metrics.time("RetrySleep"):
+                    time.sleep(delay)
+                continue
+            except Exception:
+                # HEC answered; the request itself was rejected.
+                breaker.success()
+                raise
+            breaker.success()
+            return result
+    finally:
+        # Whatever ended the call, never leave a half-open probe hanging.
+        breaker.release()
+    raise RuntimeError(f"HEC retries exhausted after {max_attempts} attempts, last error: {last}")
+
+# --------------------------
+# Duplicate suppression
+# --------------------------
+class DedupeCache:
+    """
+    LRU of delivered CloudWatch Logs event IDs, kept across warm invocations.
+    IDs are kept as the strings they arrive as: converting the 56-digit IDs to
+    ints would save ~50 bytes an entry but costs more than the lookup itself.
+    Only the handler thread touches it, so there is no lock.
+    """
+
+    # Linked-list node per OrderedDict entry on 64-bit CPython; not in getsizeof().
+    NODE_BYTES = 56
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.enabled = size > 0
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+        self._key_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def seen(self, event_id: Optional[str]) -> bool:
+        if event_id and event_id in self._ids:
+            self._ids.move_to_end(event_id)
+            return True
+        return False
+
+    def add(self, event_ids: Iterable[Optional[str]]) -> None:
+        ids = self._ids
+        for event_id in event_ids:
+            if not event_id:
+                continue
+            if event_id in ids:
+                ids.move_to_end(event_id)
+                continue
+            ids[event_id] = None
+            self._key_bytes += sys.getsizeof(event_id)
+            if len(ids) > self.size:
+                old, _ = ids.popitem(last=False)
+                self._key_bytes -= sys.getsizeof(old)
+
+    def memory_bytes(self) -> int:
+        return sys.getsizeof(self._ids) + self._key_bytes + self.NODE_BYTES * len(self._ids)
+
+# --------------------------
+# Filter rules
+# --------------------------
+DROP: Any = object()      # verdict: discard the event
+UNPARSED: Any = object()  # the message has not been JSON-parsed yet
+
+def trie_pattern(words: Iterable[str]) -> str:
+    """
+    A regex matching any of words, factored into a character trie. re tries
+    alternatives one by one, so a flat a|b|c|... gets slower with every word;
+    the trie keeps the search cost about the same however many words there are.
+    """
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = None
+
+    def emit(node: Dict[str, Any]) -> str:
+        if "" in node:
+            return ""  # a shorter word already matched; nothing longer is needed
+        alts = [re.escape(ch) + emit(child) for ch, child in node.items()]
+        return alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+
+    return emit(trie)
+
+class Rule:
+    """
+    One compiled rule. Every predicate it sets must match:
+
+        {"logGroup": "/aws/lambda/api-*",       exact name, or prefix with a trailing "*"
+         "logStreamPrefix": "2024/",
+         "contains": "GET /health",             plain substring of the message
+         "regex": "level=(DEBUG|TRACE)",        re.search on the message
+         "field": "detail.level",               dotted path into a JSON message...
+         "equals": "DEBUG",                     ...and the value(s) it must have
+         "action": "drop" | "sample" | "route",
+         "percent": 5,                          sample: share of events kept
+         "index": "...", "sourcetype": "..."}   sample/route: where kept events go
+
+    The record's prefilter only knows a rule's "contains" text (or a field
+    rule's JSON value), so give a regex rule a "contains" with text every
+    match has, e.g. {"contains": "level=", "regex": "level=(DEBUG|TRACE)"};
+    a regex rule without one is checked against every event.
+
+    Sampling hashes the event id, so a replayed record keeps the same events.
+    Kept events get the verdict (index, sourcetype), either of which may be
+    None to keep the handler's default.
+    """
+
+    __slots__ = ("log_group", "stream_prefix", "contains", "regex", "field", "equals",
+                 "literal", "json_literal", "action", "threshold", "route")
+
+    def __init__(self, spec: Dict[str, Any]) -> None:
+        self.action = spec.get("action", "drop")
+        if self.action not in ("drop", "sample", "route"):
+            raise ValueError(f"Unknown filter rule action {self.action!r}")
+        self.log_group: Optional[str] = spec.get("logGroup")
+        self.stream_prefix: Optional[str] = spec.get("logStreamPrefix")
+        self.contains: Optional[str] = spec.get("contains")
+        pattern = spec.get("regex")
+        self.regex = re.compile(pattern) if pattern else None
+        field = spec.get("field")
+        self.field = field.split(".") if field else None
+        if self.field and "equals" not in spec:
+            raise ValueError(f"Filter rule on field {field!r} has no 'equals'")
+        equals = spec.get("equals")
+        self.equals = tuple(equals) if isinstance(equals, list) else (equals,)
+        # Sample threshold in hundredths of a percent, compared against crc32 % 10000.
+        self.threshold = int(float(spec.get("percent", 100)) * 100)
+        index, sourcetype = spec.get("index"), spec.get("sourcetype")
+        self.route = (index or None, sourcetype or None) if (index or sourcetype) else None
+        if self.action == "route" and self.route is None:
+            raise ValueError("Filter rule with action 'route' needs an index or sourcetype")
+
+        # Text every message this rule can match must contain, so the rule can be
+        # skipped by the record's combined prefilter. None when there is none.
+        self.literal: Optional[str] = None
+        self.json_literal = False
+        if self.contains:
+            self.literal = self.contains
+        elif self.field:
+            # The quoted value, else the quoted key, if JSON would not escape it.
+            for text in (equals, self.field[-1]):
+                if isinstance(text, str) and json.dumps(text) == f'"{text}"':
+                    self.literal = f'"{text}"'
+                    self.json_literal = True
+                    break
+
+    @property
+    def per_event(self) -> bool:
+        return bool(self.contains or self.regex or self.field)
+
+    def matches_record(self, log_group: str, log_stream: str) -> bool:
+        if self.log_group is not None:
+            if self.log_group.endswith("*"):
+                if not log_group.startswith(self.log_group[:-1]):
+                    return False
+            elif log_group != self.log_group:
+                return False
+        return self.stream_prefix is None or log_stream.startswith(self.stream_prefix)
+
+    def matches_event(self, message: str, parsed: Any, parse: Callable[[str], Any]) -> Tuple[bool, Any]:
+        """Returns (matched, parsed); parsed is filled in with parse(message) if this rule needed it."""
+        if self.contains and self.contains not in message:
+            return False, parsed
+        if self.regex is not None and self.regex.search(message) is None:
+            return False, parsed
+        if self.field:
+            if parsed is UNPARSED:
+                parsed = parse(message)
+            value = parsed
+            for key in self.field:
+                if not isinstance(value, dict) or key not in value:
+                    return False, parsed
+                value = value[key]
+            if value not in self.equals:
+                return False, parsed
+        return True, parsed
+
+    def verdict(self, event: Dict[str, Any]) -> Any:
+        if self.action == "drop":
+            return DROP
+        if self.action == "sample":
+            key = event.get("id") or event.get("message", "")
+            if zlib.crc32(key.encode("utf-8")) % 10000 >= self.threshold:
+                return DROP
+        return self.route
+
+class RecordRules:
+    """
+    The rules that apply to one (logGroup, logStream), in order; the first
+    match wins. Event-level rules with a required literal are screened by one
+    trie search over all those literals, so an event that contains none of
+    them is only checked against the rules without one. Rules after the first
+    record-wide rule can never match and are cut off; that rule becomes the
+    fallback verdict.
+
+    A field rule's literal is the JSON spelling of its value or key, but a
+    message may escape the same string (e.g. "\\/healthz" or "\\u002fhealthz"),
+    so a message with a backslash in it keeps its field rules when screened out.
+    """
+
+    __slots__ = ("rules", "unscreened", "escaped", "fallback", "prefilter", "parse")
+
+    def __init__(self, rules: List[Rule], parse: Callable[[str], Any]) -> None:
+        self.parse = parse
+        self.rules: List[Rule] = []
+        self.fallback: Optional[Rule] = None
+        for rule in rules:
+            if not rule.per_event:
+                self.fallback = rule
+                break
+            self.rules.append(rule)
+        literals = [r.literal for r in self.rules if r.literal]
+        self.unscreened = [r for r in self.rules if not r.literal]
+        self.escaped = [r for r in self.rules if not r.literal or r.json_literal]
+        self.prefilter = re.compile(trie_pattern(literals)) if literals else None
+
+    @property
+    def drops_all(self) -> bool:
+        return not self.rules and self.fallback is not None and self.fallback.action == "drop"
+
+    def evaluate(self, event: Dict[str, Any], message: str) -> Tuple[Any, Any]:
+        """Returns (verdict, parsed): None, DROP or (index, sourcetype), plus any parsed message."""
+        parsed = UNPARSED
+        rules = self.rules
+        if self.prefilter is not None and self.prefilter.search(message) is None:
+            rules = self.escaped if "\\" in message else self.unscreened
+        for rule in rules:
+            matched, parsed = rule.matches_event(message, parsed, self.parse)
+            if matched:
+                return rule.verdict(event), parsed
+        if self.fallback is not None:
+            return self.fallback.verdict(event), parsed
+        return None, parsed
+
+class RuleSet:
+    """
+    All configured rules; per-record selections are cached by (logGroup,
+    logStream). `parse` decodes a message for field rules; whatever it
+    returns is handed back from RecordRules.evaluate for reuse.
+    """
+
+    CACHE_SIZE = 4096
+
+    def __init__(self, specs: List[Dict[str, Any]], parse: Callable[[str], Any]) -> None:
+        self.rules = [Rule(spec) for spec in specs]
+        self.parse = parse
+        self._cache: Dict[Tuple[str, str], Optional[RecordRules]] = {}
+
+    def for_record(self, log_group: str, log_stream: str) -> Optional[RecordRules]:
+        """None when no rule can apply to the record, which is the fast path."""
+        if not self.rules:
+            return None
+        key = (log_group, log_stream)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        selected: Optional[RecordRules] = RecordRules(
+            [r for r in self.rules if r.matches_record(log_group, log_stream)], self.parse
+        )
+        if not selected.rules and selected.fallback is None:
+            selected = None
+        if len(self._cache) >= self.CACHE_SIZE:
+            self._cache.clear()
+        self._cache[key] = selected
+        return selected
+
+def load_rules() -> List[Dict[str, Any]]:
+    """The configured rule specs from FILTER_RULES or FILTER_RULES_FILE; [] when there are none."""
+    if FILTER_RULES:
+        return json.loads(FILTER_RULES)
+    path = FILTER_RULES_FILE
+    if path and not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        return json.load(f)
+
+# --------------------------
+# Streaming decode
+# --------------------------
+_WS = re.compile(r"[ \t\n\r]*")
+
+class StreamDecoder:
+    """
+    Incremental decoder for one gzipped CloudWatch Logs payload. The gzip
+    stream is inflated READ_BYTES at a time and the top-level object is
+    walked by hand: header fields are decoded as they come, and logEvents
+    becomes a generator that decodes one event per step with
+    JSONDecoder.raw_decode. Only the compressed input, one inflated window
+    and the event being decoded are held at once.
+
+    logEvents stays lazy only if every key in `header_keys` came before it;
+    decompressed bytes are counted on `metrics` once the payload is consumed.
+    """
+
+    READ_BYTES = 256 * 1024
+
+    def __init__(self, raw: bytes, header_keys: FrozenSet[str], metrics: Metrics) -> None:
+        self._raw = memoryview(raw)
+        self._in_pos = 0
+        self._inflate = zlib.decompressobj(wbits=31)  # gzip header and trailer
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._header_keys = header_keys
+        self._metrics = metrics
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.size = 0  # decompressed bytes so far
+
+    def _more(self) -> bool:
+        """Appends the next inflated window to buf; False once input is exhausted."""
+        d = self._inflate
+        if d.unconsumed_tail:
+            data = d.decompress(d.unconsumed_tail, self.READ_BYTES)
+        elif self._in_pos < len(self._raw) and not d.eof:
+            piece = self._raw[self._in_pos:self._in_pos + self.READ_BYTES]
+            self._in_pos += len(piece)
+            data = d.decompress(piece, self.READ_BYTES)
+        elif not self.eof:
+            data = d.flush()
+            self.eof = True
+        else:
+            return False
+        self.size += len(data)
+        self.buf = self.buf[self.pos:] + self._utf8.decode(data, final=self.eof)
+        self.pos = 0
+        return True
+
+    def _peek(self) -> str:
+        """Next non-whitespace character, reading more as needed; "" at end of input."""
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                return ""
+
+    def _expect(self, chars: str) -> str:
+        ch = self._peek()
+        if not ch or ch not in chars:
+            raise ValueError(f"Expected one of {chars!r} at decompressed offset {self.size - len(self.buf) + self.pos}")
+        self.pos += 1
+        return ch
+
+    def _value(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self.buf, self.pos)
+                # A value ending exactly at the window edge may continue (e.g. a number).
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._more()
+
+    def _members(self, record: Dict[str, Any], first: bool) -> bool:
+        """
+        Decodes "key": value pairs into record up to the closing brace. Returns
+        True instead if it stopped just inside the logEvents array.
+        """
+        while True:
+            if first:
+                first = False
+                if self._peek() == "}":
+                    self.pos += 1
+                    return False
+            elif self._expect(",}") == "}":
+                return False
+            key = self._value()
+            self._expect(":")
+            if key == "logEvents" and self._peek() == "[":
+                self.pos += 1
+                return True
+            record[key] = self._value()
+
+    def _items(self) -> Iterator[Any]:
+        if self._peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(",]") == "]":
+                return
+
+    def _stream(self, record: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        yield from self._items()
+        while self._members(record, False):
+            for _ in self._items():
+                pass  # a second logEvents array; too late to use, so skip it
+        self._metrics.count("BytesDecompressed", self.size)
+
+    def parse(self) -> Dict[str, Any]:
+        """The record with logEvents as a lazy iterator (a list if the header came after it)."""
+        self._expect("{")
+        record: Dict[str, Any] = {}
+        if self._members(record, True):
+            if self._header_keys <= record.keys():
+                record["logEvents"] = self._stream(record)
+                return record
+            # Out of the usual order; materialize so the header is complete first.
+            record["logEvents"] = list(self._items())
+            while self._members(record, False):
+                record["logEvents"] = list(self._items())
+        self._metrics.count("BytesDecompressed", self.size)
+        return record
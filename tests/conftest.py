@@ -0,0 +1,15 @@
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The Lambdas import kinesis_common as a top-level module, as they do when deployed.
+sys.path.insert(0, ROOT)
+
+def load_script(filename, name=None):
+    """Imports one of the hyphen-named scripts at the repo root as a module."""
+    name = name or filename[:-3].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, filename))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
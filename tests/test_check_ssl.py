@@ -0,0 +1,235 @@
+import asyncio
+import datetime
+import hashlib
+import ipaddress
+import socket
+import ssl
+import time
+
+import pytest
+
+from conftest import load_script
+
+x509 = pytest.importorskip("cryptography.x509")
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+@pytest.fixture(scope="module")
+def chk():
+    return load_script("check-ssl-jump-host.py")
+
+def _self_signed(directory, name, cn="localhost"):
+    """Writes a self-signed cert for localhost/127.0.0.0/8 and its key; returns (cert path, key path, DER)."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(NameOID.ORGANIZATION_NAME, f"Test {name}"),
+                         x509.NameAttribute(NameOID.COMMON_NAME, cn)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(subject).issuer_name(subject).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=30))
+            .add_extension(x509.SubjectAlternativeName([
+                x509.DNSName(cn), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .sign(key, hashes.SHA256()))
+    cert_path, key_path = directory / f"{name}.pem", directory / f"{name}.key"
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                           serialization.NoEncryption()))
+    return str(cert_path), str(key_path), cert.public_bytes(serialization.Encoding.DER)
+
+async def _serve(cert=None, host="127.0.0.1", port=0):
+    """A TLS server answering handshakes on host, or with cert=None a TCP server that never speaks."""
+    ctx = None
+    if cert:
+        ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ctx.load_cert_chain(cert[0], cert[1])
+
+    async def handle(reader, writer):
+        await reader.read()
+        writer.close()
+
+    return await asyncio.start_server(handle, host, port, ssl=ctx)
+
+def _port(server):
+    return server.sockets[0].getsockname()[1]
+
+@pytest.fixture(scope="module")
+def certs(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("certs")
+    return {name: _self_signed(directory, name) for name in ("a", "b")}
+
+def test_probe_reads_trusted_certificate(chk, certs):
+    async def main():
+        async with await _serve(certs["a"]) as server:
+            ctx = ssl.create_default_context(cafile=certs["a"][0])
+            return await chk.probe("localhost", _port(server), ctx=ctx, ip="127.0.0.1")
+
+    result = asyncio.run(main())
+    assert result["error"] == ""
+    assert result["ip"] == "127.0.0.1"
+    assert result["issuer"] == "Test a" and result["common_name"] == "localhost"
+    assert result["sans"] == ["localhost"]
+    assert result["fingerprint"] == hashlib.sha256(certs["a"][2]).hexdigest()
+    assert ssl.cert_time_to_seconds(result["not_after"]) > 0
+
+def test_probe_reports_untrusted_certificate(chk, certs):
+    async def main():
+        async with await _serve(certs["a"]) as server:
+            return await chk.probe("localhost", _port(server), ip="127.0.0.1")
+
+    result = asyncio.run(main())
+    assert result["error"].startswith("handshake: ") and "CERTIFICATE_VERIFY_FAILED" in result["error"]
+    assert result["fingerprint"] == ""
+
+def test_probe_reports_handshake_timeout(chk):
+    async def main():
+        async with await _serve() as server:
+            return await chk.probe("localhost", _port(server), ip="127.0.0.1", handshake_timeout=0.2)
+
+    assert asyncio.run(main())["error"] == "handshake timeout"
+
+def test_probe_reports_refused_connection(chk):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    result = asyncio.run(chk.probe("localhost", port, ip="127.0.0.1"))
+    assert result["error"].startswith("connect: ")
+
+def test_scan_probes_every_target(chk, certs):
+    async def main():
+        async with await _serve(certs["a"]) as good, await _serve(certs["b"]) as other:
+            ctx = ssl.create_default_context(cafile=certs["a"][0])
+            targets = [("localhost", _port(good)), ("localhost", _port(other))] * 3
+            return [r async for r in chk.scan(targets, concurrency=2, ctx=ctx, ip="127.0.0.1")]
+
+    results = asyncio.run(main())
+    assert len(results) == 6
+    assert sum(not r["error"] for r in results) == 3
+    assert {r["fingerprint"] for r in results if not r["error"]} == {hashlib.sha256(certs["a"][2]).hexdigest()}
+
+async def _all_ips(chk, monkeypatch, certs, ctx):
+    """MultiIpProber over 127.0.0.1 and 127.0.0.2 serving certs[0] and certs[1] on one port."""
+    async with await _serve(certs[0], "127.0.0.1") as first:
+        port = _port(first)
+        async with await _serve(certs[1], "127.0.0.2", port):
+            prober = chk.MultiIpProber(4)
+
+            async def resolve(fqdn):
+                return ["127.0.0.1", "127.0.0.2"]
+
+            monkeypatch.setattr(prober, "resolve", resolve)
+            return sorted(await prober("localhost", port, ctx=ctx), key=lambda r: r["ip"])
+
+def test_all_ips_counts_unverified_certificate_as_variant(chk, certs, monkeypatch):
+    ctx = ssl.create_default_context(cafile=certs["a"][0])
+    ok, unverified = asyncio.run(_all_ips(chk, monkeypatch, (certs["a"], certs["b"]), ctx))
+    assert ok["error"] == "" and ok["fingerprint"] == hashlib.sha256(certs["a"][2]).hexdigest()
+    assert "CERTIFICATE_VERIFY_FAILED" in unverified["error"]
+    assert unverified["fingerprint"] == hashlib.sha256(certs["b"][2]).hexdigest()
+    assert ok["variants"] == unverified["variants"] == 2
+
+def _chain(directory):
+    """A leaf for localhost issued via an intermediate; returns (root path, (full chain, key), (leaf only, key))."""
+    def issue(cn, key, issuer=None, issuer_key=None, ca=True):
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        builder = (x509.CertificateBuilder()
+                   .subject_name(name).issuer_name(issuer.subject if issuer else name).public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=30))
+                   .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True))
+        if not ca:
+            builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(cn)]), critical=False)
+        return builder.sign(issuer_key or key, hashes.SHA256())
+
+    keys = [ec.generate_private_key(ec.SECP256R1()) for _ in range(3)]
+    root = issue("Test root", keys[0])
+    intermediate = issue("Test intermediate", keys[1], root, keys[0])
+    leaf = issue("localhost", keys[2], intermediate, keys[1], ca=False)
+    pem = lambda *certs: b"".join(c.public_bytes(serialization.Encoding.PEM) for c in certs)
+    paths = {}
+    for name, data in (("root.pem", pem(root)), ("full.pem", pem(leaf, intermediate)), ("leaf.pem", pem(leaf)),
+                       ("leaf.key", keys[2].private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                                          serialization.NoEncryption()))):
+        (directory / name).write_bytes(data)
+        paths[name] = str(directory / name)
+    return paths["root.pem"], (paths["full.pem"], paths["leaf.key"]), (paths["leaf.pem"], paths["leaf.key"])
+
+def test_all_ips_same_certificate_verified_on_one_address_only(chk, tmp_path, monkeypatch):
+    # 127.0.0.2 serves the same leaf without its intermediate, so it fails verification.
+    root, full, leaf_only = _chain(tmp_path)
+    ctx = ssl.create_default_context(cafile=root)
+    ok, unverified = asyncio.run(_all_ips(chk, monkeypatch, (full, leaf_only), ctx))
+    assert ok["error"] == "" and "CERTIFICATE_VERIFY_FAILED" in unverified["error"]
+    assert ok["fingerprint"] == unverified["fingerprint"]
+    assert ok["variants"] == unverified["variants"] == 2
+
+def _result(chk, fqdn, ip, issuer, fingerprint="ab" * 32, error=""):
+    result = dict.fromkeys(chk.FIELDS, "")
+    result.update(fqdn=fqdn, port=443, ip=ip, issuer=issuer, sans=[], fingerprint=fingerprint, error=error,
+                  not_after="Jan  1 00:00:00 2030 GMT")
+    return result
+
+@pytest.fixture
+def inventory(chk):
+    inv = chk.CertInventory(":memory:")
+    for fqdn, issuer in (("a.example", "DigiCert Global G1 TLS RSA"), ("b.example", "DigiCert Global G2"),
+                         ("c.example", "Amazon RSA 2048 M01")):
+        inv.record(_result(chk, fqdn, "10.0.0.1", issuer), 0.0)
+    yield inv
+    inv.close()
+
+@pytest.mark.parametrize("text, expected", [
+    ("G1", ["a.example"]),
+    ("digicert glob", ["a.example", "b.example"]),
+    ("Amazon", ["c.example"]),
+    ("G3", []),
+    ("", ["a.example", "b.example", "c.example"]),
+])
+def test_inventory_by_issuer(inventory, text, expected):
+    assert [r["fqdn"] for r in inventory.by_issuer(text)] == expected
+
+def test_inventory_by_issuer_uses_index(inventory):
+    statements = []
+    inventory.db.set_trace_callback(statements.append)
+    list(inventory.by_issuer("G1"))
+    inventory.db.set_trace_callback(None)
+    plan = [row[3] for row in inventory.db.execute("EXPLAIN QUERY PLAN " + statements[-1])]
+    assert any("issuer_terms USING PRIMARY KEY (term>? AND term<?)" in step for step in plan)
+    assert not any(step.startswith("SCAN") for step in plan)
+
+def test_inventory_indexes_issuers_written_before_issuer_terms(chk, tmp_path):
+    path = str(tmp_path / "old.db")
+    inv = chk.CertInventory(path)
+    inv.record(_result(chk, "a.example", "10.0.0.1", "DigiCert Global G1"), 0.0)
+    inv.db.execute("DELETE FROM issuer_terms")
+    inv.db.execute("PRAGMA user_version = 0")
+    inv.close()
+    inv = chk.CertInventory(path)
+    assert [r["fqdn"] for r in inv.by_issuer("G1")] == ["a.example"]
+    inv.close()
+
+def test_inventory_drops_issuer_terms_of_stale_addresses(chk, inventory):
+    inventory.record(_result(chk, "a.example", "10.0.0.2", "Amazon RSA 2048 M01"), time.time())
+    assert [r["ip"] for r in inventory.rows("fqdn = 'a.example'")] == ["10.0.0.2"]
+    assert [r["fqdn"] for r in inventory.by_issuer("G1")] == []
+    assert inventory.db.execute("SELECT count(*) FROM issuer_terms WHERE ip = '10.0.0.1' AND fqdn = 'a.example'").fetchone()[0] == 0
+
+def test_inventory_answers_report_live_variant_count(chk, inventory):
+    live = [_result(chk, "d.example", "10.0.0.1", "Test", "aa" * 32),
+            _result(chk, "d.example", "10.0.0.2", "Test", "bb" * 32),
+            _result(chk, "d.example", "10.0.0.3", "Test", "bb" * 32)]
+    for r in live:
+        inventory.record(r, 0.0)
+
+    async def probe_fn(*target, **kwargs):
+        raise AssertionError("fresh entries must come from the inventory")
+
+    async def main():
+        return [r async for r in chk.inventory_scan([("d.example", 443)], inventory, 3600.0, 0.0, probe_fn=probe_fn)]
+
+    cached = asyncio.run(main())
+    assert len(cached) == 3 and all(r["cached"] for r in cached)
+    assert {r["variants"] for r in cached} == {chk.count_variants(live)} == {2}
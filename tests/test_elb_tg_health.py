@@ -0,0 +1,49 @@
+import pytest
+
+from conftest import load_script
+
+@pytest.fixture(scope="module")
+def elb():
+    return load_script("elb-tg-health.py")
+
+ARN = "arn:aws:elasticloadbalancing:us-east-1:123456789012:targetgroup/tg/1"
+
+@pytest.fixture
+def watcher(elb):
+    events = []
+    w = elb.Watcher({}, None, interval=5.0, max_interval=60.0, emit=events.append)
+    w.groups[ARN] = {"region": "us-east-1", "name": "tg", "lbs": ["lb"], "keys": set(), "baseline": False}
+    w._schedule(ARN, 0.0, 0.0)
+    w.events = events
+    return w
+
+def _poll(w, now, state):
+    w.update(ARN, [{"Target": {"Id": "10.0.0.1", "Port": 443}, "TargetHealth": {"State": state}}], now)
+    return w.groups[ARN]["interval"]
+
+def test_group_with_pending_target_does_not_back_off(watcher):
+    assert _poll(watcher, 0.0, "unhealthy") == 5.0
+    # Unhealthy is not transitional, but the target is still on its way to healthy.
+    assert [_poll(watcher, t, "unhealthy") for t in (5.0, 10.0, 15.0)] == [5.0, 5.0, 5.0]
+    assert _poll(watcher, 20.0, "healthy") == 5.0
+    assert watcher.events[-1]["time_to_healthy"] == 20.0
+    assert [_poll(watcher, t, "healthy") for t in (25.0, 35.0, 55.0)] == [10.0, 20.0, 40.0]
+
+def test_stable_unhealthy_baseline_backs_off(watcher):
+    watcher.groups[ARN]["baseline"] = True
+    assert _poll(watcher, 0.0, "unhealthy") == 5.0
+    # Already unhealthy when watching started: no known start, nothing to measure.
+    assert [_poll(watcher, t, "unhealthy") for t in (5.0, 15.0, 35.0, 75.0)] == [10.0, 20.0, 40.0, 60.0]
+
+def test_target_stuck_unhealthy_backs_off_after_pending_window(watcher):
+    watcher.pending_window = 30.0
+    assert _poll(watcher, 0.0, "unhealthy") == 5.0
+    now, intervals = 0.0, []
+    for _ in range(12):
+        now += intervals[-1] if intervals else 5.0
+        intervals.append(_poll(watcher, now, "unhealthy"))
+    assert intervals[:6] == [5.0] * 5 + [10.0]
+    assert intervals[-1] == 60.0
+    # A late recovery is still measured, from the registration poll.
+    _poll(watcher, now + 60.0, "healthy")
+    assert watcher.events[-1]["time_to_healthy"] == now + 60.0
@@ -0,0 +1,142 @@
+import json
+import threading
+import time
+
+import pytest
+
+import kinesis_common
+from kinesis_common import DROP, CircuitBreaker, Deadline, Metrics, Retryable, RuleSet, retry_call
+
+@pytest.fixture
+def half_open(monkeypatch):
+    """A breaker that has opened and whose cooldown has passed: the next call is the probe."""
+    monkeypatch.setattr(kinesis_common, "HEC_BREAKER_COOLDOWN_SEC", 0.0)
+    breaker = CircuitBreaker()
+    breaker.failures = kinesis_common.HEC_BREAKER_THRESHOLD
+    breaker.opened_at = time.monotonic() - 1.0
+    return breaker
+
+def _call(attempt, breaker, max_attempts=1):
+    return retry_call(attempt, max_attempts, Deadline(), breaker, Metrics(False))
+
+def _unauthorized():
+    raise Retryable("HEC 401: b'Invalid token'", immediate=True)
+
+def test_401_on_last_probe_attempt_releases_the_probe(half_open):
+    with pytest.raises(RuntimeError, match="retries exhausted"):
+        _call(_unauthorized, half_open)
+    assert not half_open.probing
+
+    # The next chunk must not wait out its deadline behind a probe nobody finishes.
+    start = time.monotonic()
+    assert _call(lambda: "ok", half_open) == "ok"
+    assert time.monotonic() - start < 1.0
+    assert half_open.opened_at is None
+
+def test_401_then_refreshed_token_closes_the_breaker(half_open):
+    attempts = iter([_unauthorized, lambda: "ok"])
+    assert _call(lambda: next(attempts)(), half_open, max_attempts=2) == "ok"
+    assert half_open.opened_at is None and not half_open.probing
+
+def test_failed_probe_reopens_the_breaker(half_open):
+    def unavailable():
+        raise Retryable("HEC 503")
+
+    with pytest.raises(RuntimeError):
+        _call(unavailable, half_open)
+    assert half_open.opened_at is not None and not half_open.probing
+
+def test_release_leaves_another_threads_probe_alone(half_open):
+    assert half_open.allow(wait=0)
+    other = threading.Thread(target=half_open.release)
+    other.start()
+    other.join()
+    assert half_open.probing
+    half_open.release()
+    assert not half_open.probing
+
+@pytest.mark.parametrize("message", [
+    '{"path":"/healthz"}',
+    '{"path":"\\/healthz"}',
+    '{"path":"\\u002fhealthz"}',
+    '{"p\\u0061th":"\\/healthz"}',
+])
+def test_field_rule_matches_escaped_json(message):
+    rules = RuleSet([{"field": "path", "equals": "/healthz", "action": "drop"},
+                     {"contains": "ERROR", "action": "route", "index": "errors"}], json.loads)
+    selected = rules.for_record("/aws/lambda/api", "stream")
+    assert selected.evaluate({"message": message}, message)[0] is DROP
+
+def test_prefilter_still_screens_unrelated_messages():
+    rules = RuleSet([{"field": "path", "equals": "/healthz", "action": "drop"}], json.loads)
+    selected = rules.for_record("/aws/lambda/api", "stream")
+    for message in ('{"path":"/orders"}', '{"path":"\\/orders"}', "plain text"):
+        assert selected.evaluate({"message": message}, message)[0] is None
+
+@pytest.mark.parametrize("pattern, message", [
+    (r"level=(DEBUG|TRACE)", "ts=1 level=TRACE msg=x"),
+    (r"(?i)timeout", "upstream TIMEOUT after 3s"),
+    (r"a\u0062c", "xabcx"),
+    (r"[/]healthz", "GET /healthz"),
+])
+def test_regex_rule_without_contains_is_never_screened_out(pattern, message):
+    # The prefilter takes nothing from a regex, so a rule with only one must reach re.search.
+    rules = RuleSet([{"contains": "unrelated", "action": "drop"},
+                     {"regex": pattern, "action": "route", "index": "matched"}], json.loads)
+    selected = rules.for_record("/aws/lambda/api", "stream")
+    assert selected.unscreened == selected.rules[1:]
+    assert selected.evaluate({"message": message}, message)[0] == ("matched", None)
+
+def test_regex_rule_with_contains_is_screened_by_it():
+    rules = RuleSet([{"contains": "level=", "regex": r"level=(DEBUG|TRACE)", "action": "drop"}], json.loads)
+    selected = rules.for_record("/aws/lambda/api", "stream")
+    assert selected.unscreened == [] and selected.prefilter is not None
+    assert selected.evaluate({"message": "level=DEBUG"}, "level=DEBUG")[0] is DROP
+    assert selected.evaluate({"message": "level=INFO"}, "level=INFO")[0] is None
+
+@pytest.mark.parametrize("text", [
+    '{"id":123456789012345678901234567890,"n":-9223372036854775809}',
+    '{"n":18446744073709551615}',
+    '{"v":NaN,"w":Infinity,"x":-Infinity}',
+    '{"big":1e400}',
+    '{"f":2.5e-07,"path":"\\/healthz"}',
+])
+def test_exact_loads_reads_messages_like_stdlib(text):
+    orjson = pytest.importorskip("orjson")
+    loads = kinesis_common.exact_loads(orjson.loads)
+    # Compared as stdlib spells them, so NaN equals NaN and 1 does not equal 1.0.
+    assert json.dumps(loads(text)) == json.dumps(json.loads(text))
+
+def test_exact_loads_still_rejects_plain_text():
+    orjson = pytest.importorskip("orjson")
+    with pytest.raises(ValueError):
+        kinesis_common.exact_loads(orjson.loads)("INFO request 0000000000000000000001 done")
+
+def test_caller_without_deadline_waits_for_probe(half_open):
+    # kinesis-replay.py and local runs have no Lambda context, so Deadline().remaining() is inf.
+    started, finish = threading.Event(), threading.Event()
+    results, errors = {}, []
+
+    def probe():
+        started.set()
+        finish.wait(5.0)
+        return "probe"
+
+    def run(name, attempt):
+        try:
+            results[name] = _call(attempt, half_open)
+        except Exception as e:
+            errors.append(e)
+
+    prober = threading.Thread(target=run, args=("probe", probe))
+    prober.start()
+    assert started.wait(5.0)
+    waiter = threading.Thread(target=run, args=("waiter", lambda: "waiter"))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive() and not errors
+    finish.set()
+    prober.join(5.0)
+    waiter.join(5.0)
+    assert not errors
+    assert results == {"probe": "probe", "waiter": "waiter"}
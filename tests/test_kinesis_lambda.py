@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+
+import pytest
+
+from conftest import load_script
+
+@pytest.fixture(scope="module")
+def lam():
+    os.environ.setdefault("SPLUNK_HEC_TOKEN", "00000000-0000-0000-0000-000000000000")
+    return load_script("kinesis-lambda.py")
+
+MESSAGES = [
+    "plain text",
+    "",
+    'quotes " and \\ backslashes\tand\ncontrol \x01 chars',
+    "unicode jürgen 请求超时 😀  ",
+    '{"level":"INFO","nested":{"a":[1,2,{"b":null}],"t":true,"s":"x"}}',
+    '{"path":"\\/healthz","quoted":"say \\"hi\\"","esc":"\\u00e9\\u002f\\n"}',
+    '{"user":"jürgen","note":"请求","emoji":"\\ud83d\\ude00"}',
+    '{"f":2.5e-07,"g":1e22,"h":0.1,"i":-0.0,"j":1.0,"k":123456789.125}',
+    '{"id":123456789012345678901234567890,"n":-9223372036854775809}',
+    '{"v":NaN,"w":Infinity}',
+    "lone \ud800 surrogate, jürgen",
+    '{"lone":"\\udfff","name":"jürgen"}',
+    "{}",
+    '  {"padded": 1}  ',
+    '{"message":"overridden","logGroup":"other","extra":1}',
+    '["not", "an", "object"]',
+    "{not json}",
+]
+
+def _record(log_group="/aws/lambda/orders"):
+    return {
+        "messageType": "DATA_MESSAGE", "owner": "123456789012", "logGroup": log_group,
+        "logStream": "2024/01/01/[$LATEST]abc",
+        "logEvents": [{"id": f"{i:056d}", "timestamp": 1700000000001 + 37 * i, "message": m}
+                      for i, m in enumerate(MESSAGES)],
+    }
+
+def _before_template(lam, record, index=None, sourcetype=None):
+    """
+    The NDJSON lines the template path replaced: _to_splunk_events as it was,
+    each event then serialized whole with _json_dumps. Only the message parser
+    is today's (exact_loads), so both sides decode messages the same way.
+    """
+    if record.get("messageType") != "DATA_MESSAGE":
+        return
+    owner = record.get("owner")
+    log_group = record.get("logGroup")
+    log_stream = record.get("logStream")
+    common = {
+        "source": lam.SPLUNK_SOURCE or log_group,
+        "sourcetype": sourcetype or lam.SPLUNK_SOURCETYPE,
+        "index": index or lam.SPLUNK_INDEX,
+    }
+    for e in record.get("logEvents", []):
+        evt = {
+            **common,
+            "time": e["timestamp"] / 1000.0,
+            "event": {
+                "message": e.get("message", ""),
+                "owner": owner,
+                "logGroup": log_group,
+                "logStream": log_stream,
+            },
+        }
+        j = lam._parse_message(e.get("message", ""))
+        if j is not None:
+            evt["event"] = {**evt["event"], **j}
+        yield e["id"], lam._json_dumps(evt)
+
+@pytest.mark.parametrize("log_group", ["/aws/lambda/orders", "/aws/lambda/ünïcode \"quoted\""])
+def test_template_matches_previous_serialization(lam, log_group):
+    record = _record(log_group)
+    assert list(lam._to_splunk_lines(record)) == list(_before_template(lam, record))
+
+def test_template_matches_previous_serialization_edge_records(lam):
+    record = _record()
+    record["logEvents"].append({"id": "9" * 56, "timestamp": 1700000000999})  # no message
+    assert list(lam._to_splunk_lines(record)) == list(_before_template(lam, record))
+    record["messageType"] = "CONTROL_MESSAGE"
+    assert list(lam._to_splunk_lines(record)) == [] == list(_before_template(lam, record))
+
+def test_routed_events_match_previous_serialization(lam, monkeypatch):
+    monkeypatch.setattr(lam, "_rules", lam.RuleSet(
+        [{"contains": "", "regex": ".", "action": "route", "index": "routed", "sourcetype": "st:ü"}],
+        lam._parse_message))
+    record = _record()
+    record["logEvents"] = [e for e in record["logEvents"] if e["message"]]
+    assert list(lam._to_splunk_lines(record)) == list(_before_template(lam, record, "routed", "st:ü"))
+
+def test_import_fails_without_token_source(monkeypatch):
+    monkeypatch.delenv("SPLUNK_HEC_TOKEN", raising=False)
+    monkeypatch.delenv("SPLUNK_HEC_TOKEN_SECRET_ARN", raising=False)
+    with pytest.raises(RuntimeError, match="SPLUNK_HEC_TOKEN_SECRET_ARN"):
+        load_script("kinesis-lambda.py", "kinesis_lambda_no_token")
+
+def test_expired_token_starts_one_refresh(lam):
+    class SlowFlag(lam._TokenCache):
+        """Widens the window between reading and setting _refreshing, as a thread switch there would."""
+
+        def _get_refreshing(self):
+            time.sleep(0.005)
+            return self.__dict__["refreshing"]
+
+        def _set_refreshing(self, value):
+            self.__dict__["refreshing"] = value
+
+        _refreshing = property(_get_refreshing, _set_refreshing)
+
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return "token"
+
+    cache = SlowFlag()
+    cache._fetch = fetch
+    cache.get()
+    cache._fetched_at = time.monotonic() - lam.HEC_TOKEN_TTL_SEC - 1.0
+    start = threading.Barrier(8)
+    threads = [threading.Thread(target=lambda: (start.wait(), cache.get())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5.0)
+    deadline = time.monotonic() + 5.0
+    while cache._refreshing and time.monotonic() < deadline:
+        pass
+    assert len(fetches) == 2
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from conftest import load_script
+from kinesis_common import Deadline
+
+@pytest.fixture(scope="module")
+def replay():
+    return load_script("kinesis-replay.py")
+
+RECORD = {"kinesis": {"data": "H4sI", "sequenceNumber": "1"}}
+
+@pytest.mark.parametrize("doc", [123, "x", None, True, [RECORD]])
+def test_records_in_rejects_non_objects(replay, doc):
+    with pytest.raises(ValueError, match="expected a JSON object"):
+        replay._records_in(doc)
+
+def test_records_in_skips_non_object_records(replay):
+    assert replay._records_in({"Records": [RECORD, 7, "kinesis"]}) == [RECORD]
+
+def test_bad_lines_are_skipped_and_reported(replay, tmp_path, capsys):
+    path = tmp_path / "dump.jsonl"
+    path.write_text("\n".join([json.dumps(RECORD), "123", '"x"', "{not json", json.dumps(RECORD)]) + "\n")
+    batches = list(replay._iter_batches([str(path)], {"files": {}}, 100))
+    assert [list(b.records) for b in batches] == [["1:0", "5:0"]]
+    assert batches[0].line == 5 and batches[0].last
+    err = capsys.readouterr().err
+    assert f"{path}:2: skipped" in err and f"{path}:3: skipped" in err and f"{path}:4: skipped" in err
+
+def test_each_send_attempt_has_a_finite_deadline(replay, monkeypatch):
+    # Without one, callers waiting on a half-open circuit breaker got an unbounded wait.
+    monkeypatch.setattr(replay.time, "sleep", lambda seconds: None)
+    seen = []
+
+    class Lambda:
+        _deadline = Deadline()
+
+        @staticmethod
+        def _iter_chunks(lines):
+            return iter(())
+
+        @staticmethod
+        def _send_chunks(chunks, failed, stats):
+            seen.append(Lambda._deadline.remaining())
+            list(chunks)
+            if len(seen) == 1:
+                failed.add("1:0")
+
+    Lambda.Deadline = Deadline
+    stats, failed = replay._send(Lambda, [("1:0", None, None, b"{}")], replay._RateLimiter(0, 0), 1, 30.0)
+    assert not failed
+    assert len(seen) == 2 and all(0 < left <= 30.0 for left in seen)
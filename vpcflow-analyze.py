@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+"""
+Top-talker report over exported VPC flow log files, as an offline and
+unlimited alternative to the Logs Insights query in vpcflow.txt.
+
+Input files are flow log text files as delivered to S3 or exported from
+CloudWatch Logs, plain or gzipped (detected by magic bytes). The field order
+comes from the header line when there is one (default and custom formats),
+otherwise from --format, which takes the flow log format string
+("${version} ${srcaddr} ...") or a plain list of field names. Lines prefixed
+with a CloudWatch export timestamp are recognized.
+
+Files are read in --chunk-mb blocks and parsed straight from the byte buffer
+with NumPy: field boundaries come from the separator positions, addresses
+become uint32 arrays and are classified against the private CIDR set with
+vectorized mask/compare. Flows are then grouped by the --by fields, summing
+flows, packets and bytes. At most --max-keys groups are kept; beyond that the
+smallest are evicted and the report says so.
+
+Each endpoint is private (in --private-cidrs, RFC1918 by default) or public,
+which puts every flow in one of four classes: internal (private -> private),
+egress (private -> public), ingress (public -> private) and public (public ->
+public). `--match public` is the vpcflow.txt query.
+
+Examples:
+  python3 vpcflow-analyze.py --match egress,ingress --top 25 flowlogs/*.log.gz
+  python3 vpcflow-analyze.py --by src,dstport --action REJECT --workers 8 --json export/*.gz
+"""
+
+import argparse
+import gzip
+import ipaddress
+import itertools
+import json
+import multiprocessing
+import re
+import sys
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+DEFAULT_FORMAT = ("version account-id interface-id srcaddr dstaddr srcport dstport "
+                  "protocol packets bytes start end action log-status")
+RFC1918 = "10.0.0.0/8,172.16.0.0/12,192.168.0.0/16"
+
+# Group-by fields and their width in bits in the packed 128-bit key.
+KEY_BITS = {"src": 32, "dst": 32, "srcport": 16, "dstport": 16, "protocol": 8, "action": 8}
+CLASSES = ("public", "ingress", "egress", "internal")  # index = 2 * src private + dst private
+ACTIONS = {0: "-", 1: "ACCEPT", 2: "REJECT"}
+PROTOCOLS = {1: "icmp", 6: "tcp", 17: "udp", 58: "icmpv6"}
+VALUES = ("flows", "packets", "bytes")  # order of the summed columns
+
+_SPACE, _NL, _DOT, _ZERO, _NINE = 32, 10, 46, 48, 57
+# Slack around each block so fixed-width field windows never run off either end.
+_PAD = 20
+_PADDING = np.full(_PAD, _SPACE, np.uint8)
+_TIMESTAMP = re.compile(rb"^\d{4}-\d\d-\d\dT")
+
+# --------------------------
+# Format and input
+# --------------------------
+def _field_names(fmt):
+    names = re.findall(r"\$\{([^}]+)\}", fmt)
+    return names or fmt.split()
+
+def _open_binary(path):
+    f = sys.stdin.buffer if path == "-" else open(path, "rb")
+    if f.peek(2)[:2] == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=f)
+    return f
+
+def _blocks(f, chunk_bytes):
+    """Yields (data, length) where data[:length] is a run of complete lines."""
+    carry = b""
+    while True:
+        data = f.read(chunk_bytes)
+        if not data:
+            break
+        if carry:
+            data = carry + data
+        cut = data.rfind(b"\n") + 1
+        carry = data[cut:]
+        if cut:
+            yield data, cut
+    if carry.strip():
+        yield carry + b"\n", len(carry) + 1
+
+def _layout(first_line, default_names):
+    """Returns (field names, header present) for a file from its first line."""
+    first = first_line.split(b" ", 1)[0]
+    if _TIMESTAMP.match(first):
+        return ["timestamp"] + default_names, False
+    if first and not first[:1].isdigit() and first != b"-":
+        return first_line.decode("ascii", "replace").split(), True
+    return default_names, False
+
+# --------------------------
+# Vectorized parsing
+# --------------------------
+def _split_fields(buf, k):
+    """
+    Field (start, end) offsets as (n, k) arrays for a buffer of complete
+    lines, keeping only lines with exactly k space-separated fields, plus the
+    number of non-blank lines dropped.
+    """
+    seps = np.flatnonzero((buf == _SPACE) | (buf == _NL))
+    starts = np.empty_like(seps)
+    starts[:1] = 0
+    starts[1:] = seps[:-1] + 1
+    line_ends = np.flatnonzero(buf[seps] == _NL)
+    per_line = np.diff(line_ends, prepend=-1)
+    good = per_line == k
+    if good.all():
+        return (starts.reshape(-1, k), seps.reshape(-1, k)), 0
+    blank = (per_line == 1) & (seps[line_ends] == starts[line_ends])
+    keep = np.repeat(good, per_line)
+    return (starts[keep].reshape(-1, k), seps[keep].reshape(-1, k)), int((~good & ~blank).sum())
+
+def _windows(buf, offsets, width):
+    """(n, width) copy of the bytes of buf starting at each offset."""
+    return sliding_window_view(buf, width)[offsets]
+
+def _ipv4_tables():
+    """
+    Per-position digit weights for every valid dotted-quad shape, indexed by a
+    16-bit mask of its dot positions plus the position just past its end.
+    Octet o lands in bits 10*(3-o) and up, so a sum of digit * weight never
+    carries between octets and each can still be checked against 255.
+    """
+    weights = np.zeros((1 << 16, 16), np.uint64)
+    valid = np.zeros(1 << 16, bool)
+    for lengths in itertools.product((1, 2, 3), repeat=4):
+        key, pos, row = 0, 0, np.zeros(16, np.uint64)
+        for octet, length in enumerate(lengths):
+            for i in range(length):
+                row[pos + i] = 10 ** (length - 1 - i) << (10 * (3 - octet))
+            pos += length
+            key |= 1 << pos
+            pos += 1
+        weights[key] = row
+        valid[key] = True
+    return weights, valid
+
+_IPV4_WEIGHTS, _IPV4_VALID = _ipv4_tables()
+
+def _parse_ipv4(buf, start, end):
+    """Dotted quads -> (uint32 addresses, valid mask); "-" and IPv6 come back invalid."""
+    width = end - start
+    chars = _windows(buf, start, 16)
+    column = np.arange(16)
+    marks = ((chars == _DOT) & (column < width[:, None])) | (column == width[:, None])
+    key = np.packbits(marks, axis=1, bitorder="little").view("<u2").ravel()
+    weights = _IPV4_WEIGHTS[key]
+    digits = chars - _ZERO
+    ok = _IPV4_VALID[key] & ((digits < 10) | (weights == 0)).all(axis=1)
+    packed = (digits * weights).sum(axis=1, dtype=np.uint64)
+    octets = [(packed >> np.uint64(10 * (3 - o))) & np.uint64(1023) for o in range(4)]
+    for octet in octets:
+        ok &= octet <= 255
+    addr = ((octets[0] << np.uint64(24)) | (octets[1] << np.uint64(16)) | (octets[2] << np.uint64(8)) | octets[3]).astype(np.uint32)
+    addr[~ok] = 0
+    return addr, ok
+
+def _parse_uint(buf, start, end):
+    """Decimal fields -> uint64 array; "-" and anything non-numeric become 0."""
+    width = min(int((end - start).max()), 19) if len(start) else 0
+    # Right-aligned and zero-padded, so every row has the same place values.
+    lead = width - (end - start)
+    chars = _windows(buf, end - width, width)
+    chars[np.arange(width) < lead[:, None]] = _ZERO
+    digits = chars - _ZERO
+    ok = (end > start) & (lead >= 0) & (digits < 10).all(axis=1)
+    value = digits.astype(np.uint64) @ (np.uint64(10) ** np.arange(width - 1, -1, -1, dtype=np.uint64))
+    value[~ok] = 0
+    return value
+
+def _parse_action(buf, start, end):
+    c = buf[start]
+    return np.where(c == ord("A"), 1, np.where(c == ord("R"), 2, 0)).astype(np.uint8)
+
+class _CidrSet:
+    """IPv4 CIDR membership for uint32 address arrays."""
+
+    # Up to this many networks a mask/compare per network is cheapest; past it,
+    # merged intervals and a binary search per address.
+    MASK_COMPARE_MAX = 16
+
+    def __init__(self, cidrs):
+        nets = sorted(ipaddress.IPv4Network(c.strip(), strict=False) for c in cidrs if c.strip())
+        self.nets = list(ipaddress.collapse_addresses(nets))
+        self.masks = [(np.uint32(int(n.netmask)), np.uint32(int(n.network_address))) for n in self.nets]
+        self.lo = np.array([int(n.network_address) for n in self.nets], np.uint32)
+        self.hi = np.array([int(n.broadcast_address) for n in self.nets], np.uint32)
+
+    def contains(self, addr):
+        if len(self.nets) <= self.MASK_COMPARE_MAX:
+            hit = np.zeros(len(addr), bool)
+            for mask, net in self.masks:
+                hit |= (addr & mask) == net
+            return hit
+        i = np.searchsorted(self.lo, addr, side="right") - 1
+        return (i >= 0) & (addr <= self.hi[np.maximum(i, 0)])
+
+# --------------------------
+# Aggregation
+# --------------------------
+class _TopTalkers:
+    """
+    Sums of flows/packets/bytes per group, keyed by the --by fields packed
+    into two uint64 words. Chunk results are buffered and merged once the
+    buffer passes max_keys; a merge that leaves more than max_keys groups
+    evicts the smallest by `sort`.
+    """
+
+    def __init__(self, by, max_keys, sort):
+        self.by = by
+        self.max_keys = max_keys
+        self.sort = VALUES.index(sort)
+        # Widest first, so no field straddles the two words.
+        self.slots = {}
+        offset = 0
+        for name in sorted(by, key=lambda f: -KEY_BITS[f]):
+            self.slots[name] = (offset // 64, np.uint64(offset % 64))
+            offset += KEY_BITS[name]
+        self.wide = offset > 64
+        self.lo_bits = max(offset - 64, 0)
+        self.pending = []
+        self.pending_rows = 0
+        self.state = None
+        self.evicted = 0
+        self.evicted_max = 0
+
+    def pack(self, columns):
+        n = len(next(iter(columns.values())))
+        words = [np.zeros(n, np.uint64), np.zeros(n, np.uint64)]
+        for name, (word, shift) in self.slots.items():
+            words[word] |= columns[name].astype(np.uint64) << shift
+        return words
+
+    def unpack(self, hi, lo):
+        out = {}
+        for name, (word, shift) in self.slots.items():
+            mask = (1 << KEY_BITS[name]) - 1
+            out[name] = (int((hi, lo)[word]) >> int(shift)) & mask
+        return out
+
+    def _order(self, hi, lo):
+        if not self.wide:
+            return np.argsort(hi)
+        # Dense ranks of hi usually leave room for lo in one word, and one
+        # argsort of that beats lexsort's two stable passes.
+        uniq, rank = np.unique(hi, return_inverse=True)
+        if len(uniq) <= 1 << (64 - self.lo_bits):
+            return np.argsort((rank.astype(np.uint64) << np.uint64(self.lo_bits)) | lo)
+        return np.lexsort((lo, hi))
+
+    def _group(self, hi, lo, values):
+        order = self._order(hi, lo)
+        hi, lo = hi[order], lo[order]
+        boundary = np.empty(len(hi), bool)
+        boundary[:1] = True
+        boundary[1:] = (hi[1:] != hi[:-1]) | (lo[1:] != lo[:-1])
+        starts = np.flatnonzero(boundary)
+        return hi[starts], lo[starts], [np.add.reduceat(v[order], starts) for v in values]
+
+    def add(self, columns, packets, nbytes):
+        if not len(packets):
+            return
+        hi, lo = self.pack(columns)
+        flows = np.ones(len(hi), np.uint64)
+        group = self._group(hi, lo, [flows, packets, nbytes])
+        self.add_groups(*group)
+
+    def add_groups(self, hi, lo, values):
+        self.pending.append((hi, lo, values))
+        self.pending_rows += len(hi)
+        if self.pending_rows > self.max_keys:
+            self._merge()
+
+    def _merge(self):
+        parts = self.pending + ([self.state] if self.state else [])
+        self.pending, self.pending_rows = [], 0
+        if not parts:
+            return
+        hi = np.concatenate([p[0] for p in parts])
+        lo = np.concatenate([p[1] for p in parts])
+        values = [np.concatenate([p[2][i] for p in parts]) for i in range(3)]
+        hi, lo, values = self._group(hi, lo, values)
+        if len(hi) > self.max_keys:
+            keep = np.argpartition(values[self.sort], len(hi) - self.max_keys)[len(hi) - self.max_keys:]
+            dropped = np.ones(len(hi), bool)
+            dropped[keep] = False
+            self.evicted += int(dropped.sum())
+            self.evicted_max = max(self.evicted_max, int(values[self.sort][dropped].max()))
+            hi, lo, values = hi[keep], lo[keep], [v[keep] for v in values]
+        self.state = (hi, lo, values)
+
+    def result(self):
+        self._merge()
+        return self.state
+
+    def absorb(self, other_state, evicted, evicted_max):
+        """Merges another aggregator's result() (e.g. from a worker process)."""
+        if other_state:
+            self.add_groups(*other_state)
+        self.evicted += evicted
+        self.evicted_max = max(self.evicted_max, evicted_max)
+
+    def top(self, n):
+        state = self.result()
+        if not state:
+            return []
+        hi, lo, values = state
+        order = np.argsort(values[self.sort])[::-1][:n]
+        rows = []
+        for i in order:
+            row = self.unpack(hi[i], lo[i])
+            row.update(flows=int(values[0][i]), packets=int(values[1][i]), bytes=int(values[2][i]))
+            rows.append(row)
+        return rows
+
+# --------------------------
+# Per-file analysis
+# --------------------------
+def _new_counts():
+    return {"bytes_read": 0, "lines": 0, "malformed": 0, "unparsed": 0, "matched": 0,
+            "classes": {c: {"flows": 0, "bytes": 0} for c in CLASSES}}
+
+def _analyze_block(buf, fields, names, opts, private, agg, counts):
+    n = len(fields[0])
+    counts["lines"] += n
+
+    def col(name):
+        i = names.index(name)
+        return fields[0][:, i] + _PAD, fields[1][:, i] + _PAD
+
+    def number(name):
+        return _parse_uint(buf, *col(name)) if name in names else np.zeros(n, np.uint64)
+
+    src_field, dst_field = ("pkt-srcaddr", "pkt-dstaddr") if opts["pkt_addr"] else ("srcaddr", "dstaddr")
+    src, src_ok = _parse_ipv4(buf, *col(src_field))
+    dst, dst_ok = _parse_ipv4(buf, *col(dst_field))
+    valid = src_ok & dst_ok
+    counts["unparsed"] += int(n - valid.sum())
+
+    cls = private.contains(src).astype(np.uint8) * 2 + private.contains(dst)
+    nbytes = number("bytes")
+    for i, name in enumerate(CLASSES):
+        hit = valid & (cls == i)
+        counts["classes"][name]["flows"] += int(hit.sum())
+        counts["classes"][name]["bytes"] += int(nbytes[hit].sum())
+
+    keep = valid & np.isin(cls, opts["match"])
+    action = _parse_action(buf, *col("action")) if "action" in names else np.zeros(n, np.uint8)
+    if opts["action"]:
+        keep &= action == opts["action"]
+    counts["matched"] += int(keep.sum())
+
+    columns = {"src": src, "dst": dst, "action": action}
+    for name in ("srcport", "dstport", "protocol"):
+        if name in opts["by"]:
+            columns[name] = number(name)
+    columns = {name: columns[name][keep] for name in opts["by"]}
+    agg.add(columns, number("packets")[keep], nbytes[keep])
+
+def _analyze_file(path, opts, agg, counts):
+    default_names = _field_names(opts["format"])
+    names = None
+    with _open_binary(path) as f:
+        for data, length in _blocks(f, opts["chunk_bytes"]):
+            counts["bytes_read"] += length
+            start = 0
+            if names is None:
+                names, header = _layout(data[:data.find(b"\n")], default_names)
+                missing = {"pkt-srcaddr", "pkt-dstaddr"} if opts["pkt_addr"] else {"srcaddr", "dstaddr"}
+                if missing - set(names):
+                    raise SystemExit(f"{path}: format has no {' / '.join(sorted(missing - set(names)))} field")
+                if header:
+                    start = data.find(b"\n") + 1
+            block = np.frombuffer(data, np.uint8, count=length)[start:]
+            fields, malformed = _split_fields(block, len(names))
+            counts["malformed"] += malformed
+            buf = np.concatenate((_PADDING, block, _PADDING))
+            _analyze_block(buf, fields, names, opts, opts["private"], agg, counts)
+
+def _merge_counts(into, counts):
+    for k, v in counts.items():
+        if k == "classes":
+            for c, totals in v.items():
+                for t, x in totals.items():
+                    into[k][c][t] += x
+        else:
+            into[k] += v
+
+def _worker(job):
+    path, opts = job
+    agg = _TopTalkers(opts["by"], opts["max_keys"], opts["sort"])
+    counts = _new_counts()
+    _analyze_file(path, opts, agg, counts)
+    return agg.result(), agg.evicted, agg.evicted_max, counts
+
+# --------------------------
+# Report
+# --------------------------
+def _cell(name, value):
+    if name in ("src", "dst"):
+        return str(ipaddress.IPv4Address(value))
+    if name == "protocol":
+        return PROTOCOLS.get(value, str(value))
+    if name == "action":
+        return ACTIONS[value]
+    return str(value)
+
+def _print_table(rows, by, counts, agg, elapsed):
+    gb = counts["bytes_read"] / 1e9
+    print(f"{counts['lines']} flow records ({gb:.2f} GB) in {elapsed:.1f}s ({gb / elapsed * 60 if elapsed else 0:.1f} GB/min); "
+          f"{counts['malformed']} malformed lines, {counts['unparsed']} without IPv4 addresses (NODATA, IPv6), "
+          f"{counts['matched']} matched")
+    for c in CLASSES:
+        print(f"  {c:9} {counts['classes'][c]['flows']:>12} flows {counts['classes'][c]['bytes']:>18} bytes")
+    if agg.evicted:
+        print(f"Approximate: {agg.evicted} smaller groups evicted (largest had {agg.evicted_max} {VALUES[agg.sort]}); "
+              f"raise --max-keys for exact totals")
+    print()
+    header = list(by) + ["flows", "packets", "bytes"]
+    table = [[_cell(name, row[name]) for name in header] for row in rows]
+    widths = [max([len(h)] + [len(r[i]) for r in table]) for i, h in enumerate(header)]
+    print("  ".join(h.ljust(w) for h, w in zip(header, widths)))
+    for r in table:
+        print("  ".join(v.rjust(w) if h in ("flows", "packets", "bytes") else v.ljust(w) for v, h, w in zip(r, header, widths)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+", help="flow log files, plain or gzipped (- for stdin)")
+    parser.add_argument("--format", default=DEFAULT_FORMAT, help="field order for files without a header line")
+    parser.add_argument("--pkt-addr", action="store_true", help="use pkt-srcaddr/pkt-dstaddr (custom formats) instead of srcaddr/dstaddr")
+    parser.add_argument("--by", default="src,dst,dstport,protocol,action", help=f"group-by fields from {','.join(KEY_BITS)}")
+    parser.add_argument("--match", default="all", help=f"flow classes to report, from {','.join(CLASSES)} or all")
+    parser.add_argument("--private-cidrs", default=RFC1918, help="comma-separated IPv4 CIDRs treated as private")
+    parser.add_argument("--action", choices=("ACCEPT", "REJECT"))
+    parser.add_argument("--sort", choices=VALUES, default="bytes")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--max-keys", type=int, default=1_000_000, help="bound on groups held in memory (roughly 200 bytes each while merging)")
+    parser.add_argument("--chunk-mb", type=float, default=16, help="uncompressed bytes parsed per block")
+    parser.add_argument("--workers", type=int, default=1, help="processes, one file at a time each")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    by = [f.strip() for f in args.by.split(",") if f.strip()]
+    if not by or set(by) - set(KEY_BITS):
+        parser.error(f"--by takes fields from {','.join(KEY_BITS)}")
+    match = CLASSES if args.match == "all" else [m.strip() for m in args.match.split(",")]
+    if set(match) - set(CLASSES):
+        parser.error(f"--match takes classes from {','.join(CLASSES)} or all")
+    opts = {
+        "format": args.format, "pkt_addr": args.pkt_addr, "by": by,
+        "match": np.array([CLASSES.index(m) for m in match], np.uint8),
+        "private": _CidrSet(args.private_cidrs.split(",")),
+        "action": {"ACCEPT": 1, "REJECT": 2}.get(args.action, 0),
+        "sort": args.sort, "max_keys": args.max_keys, "chunk_bytes": int(args.chunk_mb * 2 ** 20),
+    }
+
+    start = time.monotonic()
+    agg = _TopTalkers(by, args.max_keys, args.sort)
+    counts = _new_counts()
+    if args.workers > 1 and len(args.files) > 1:
+        with multiprocessing.Pool(args.workers) as pool:
+            for state, evicted, evicted_max, file_counts in pool.imap_unordered(_worker, [(p, opts) for p in args.files]):
+                agg.absorb(state, evicted, evicted_max)
+                _merge_counts(counts, file_counts)
+    else:
+        for path in args.files:
+            _analyze_file(path, opts, agg, counts)
+    rows = agg.top(args.top)
+    elapsed = time.monotonic() - start
+
+    if args.json:
+        json.dump({"counts": counts, "evicted": agg.evicted, "evicted_max": agg.evicted_max,
+                   "top": [{k: (_cell(k, v) if k in by else v) for k, v in row.items()} for row in rows]},
+                  sys.stdout, indent=2)
+        print()
+    else:
+        _print_table(rows, by, counts, agg, elapsed)
+
+if __name__ == "__main__":
+    main()